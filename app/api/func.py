@@ -1,42 +1,151 @@
 import datetime
+import json
+import time
 import uuid
-from typing import List, Tuple, Dict, Union, Optional
+from typing import List, Tuple, Dict, Union, Optional, NamedTuple, Sequence
 
 from flask import current_app
-from sqlalchemy import select, update
+from sqlalchemy import select, update, delete, and_, or_, not_, insert, bindparam, literal, func, true
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import Select, Insert, Executable
+from sqlalchemy.sql.elements import ColumnElement
 
 from app.extensions import db
+from app.models.callback import Callback
+from app.models.callback_dead_letter import CallbackDeadLetter
+from app.models.change_event import ChangeEvent
 from app.models.state import State
+from app.models.state_archive import StateArchive
 from app.models.scope import Scope, Mode
 from app.models.user import User, Role
 from app.models.valid import Valid
 from app.models.usage import Usage, Type
-from app.util.util import now, generate_api_key, simple_hash_str, hash_salt_pw_str, check_pw_str
+from app.models.usage_archive import usage_archive_table, usage_archive_tables, usage_archive_month
+from app.models.usage_rollup import UsageRollup, Period
+from app.models.worker_metrics import WorkerMetrics
+from app.util.batch_recorder import BatchRecorder
+from app.util.cache import LRUTTLCache
+from app.util.executor import BoundedExecutor
+from app.util.metrics import REGISTRY, SET_STATE_RESULTS, GET_STATE_RESULTS, HEALTH_CHECK_RESULTS
+from app.util.notify import ActorNotifier, WaitSlots
+from app.util.state_store import ActorStateStore, TS_MIN, TS_MAX
+from app.util.util import now, generate_api_key, simple_hash_str, hash_salt_pw_str, check_pw_str, \
+    cached_check_pw_str
+from app.util.webhook import WebhookDispatcher, WebhookJob
 
-QUERY_COUNTER: int = 0
-MODULO: int = 100
+PRINCIPAL_CACHE: Optional[LRUTTLCache] = None
+ACTOR_NOTIFIER: Optional[ActorNotifier] = None
+BCRYPT_POOL: Optional[BoundedExecutor] = None
 
-TS_MIN = datetime.datetime(1, 1, 1, 0, 0, 0, 0, tzinfo=datetime.timezone.utc)
-TS_MAX = datetime.datetime(9999, 12, 31, 0, 0, 0, 0, tzinfo=datetime.timezone.utc)
+SET_STATE_DURATION = datetime.timedelta(seconds=10)
 
+# kinds of change events exchanged between worker processes
+CHANGE_STATE = 'state'
+CHANGE_PRINCIPAL = 'principal'
 
-def check_and_increment():
-    global QUERY_COUNTER
-    if QUERY_COUNTER > 1000 * MODULO:
-        QUERY_COUNTER = 0
-    else:
-        QUERY_COUNTER += 1
-    return QUERY_COUNTER % MODULO == 0
+# getStates result for actors the caller has no read scope on
+FORBIDDEN = 'forbidden'
 
 
-def get_user_id_from_api_key(api_key: str) -> Optional[uuid.UUID]:
-    query = select(User.id).where(User.api_key == simple_hash_str(api_key))
+def principal_cache() -> LRUTTLCache:
+    global PRINCIPAL_CACHE
+    if PRINCIPAL_CACHE is None:
+        PRINCIPAL_CACHE = LRUTTLCache()
+    return PRINCIPAL_CACHE
+
+
+def init_principal_cache(maxsize: int, ttl: float) -> None:
+    """ (re-)creates the principal cache, dropping all cached entries """
+    global PRINCIPAL_CACHE
+    PRINCIPAL_CACHE = LRUTTLCache(maxsize=maxsize, ttl=ttl)
+
+
+def bcrypt_pool() -> BoundedExecutor:
+    global BCRYPT_POOL
+    if BCRYPT_POOL is None:
+        BCRYPT_POOL = BoundedExecutor(max_workers=2, max_pending=16, name='bcrypt')
+    return BCRYPT_POOL
+
+
+def init_bcrypt_pool(max_workers: int, max_pending: int) -> BoundedExecutor:
+    """ (re-)creates the worker pool for password hashing and verification """
+    global BCRYPT_POOL
+    BCRYPT_POOL = BoundedExecutor(max_workers=max_workers, max_pending=max_pending, name='bcrypt')
+    return BCRYPT_POOL
+
+
+def run_bcrypt(fn, *args):
+    """ runs a bcrypt function on the bounded pool; raises TimeoutError if the pool is saturated or no result is
+    available within BCRYPT_TIMEOUT seconds """
+    return bcrypt_pool().run(fn, *args, timeout=current_app.config.get('BCRYPT_TIMEOUT', 5))
+
+
+def actor_notifier() -> ActorNotifier:
+    global ACTOR_NOTIFIER
+    if ACTOR_NOTIFIER is None:
+        ACTOR_NOTIFIER = ActorNotifier()
+    return ACTOR_NOTIFIER
+
+
+def wait_slots() -> WaitSlots:
+    """ long-poll slots of the current app, see LONG_POLL_MAX_WAITERS """
+    return current_app.extensions['wait_slots']
+
+
+def actor_state_store() -> ActorStateStore:
+    """ in-memory state intervals of the current app, rebuilt from the State table on first use """
+    store = current_app.extensions.get('actor_state_store')
+    if store is None:
+        store = rebuild_actor_state_store()
+    return store
+
+
+def rebuild_actor_state_store() -> ActorStateStore:
+    """ (re-)creates the in-memory store from all State rows that have not ended yet """
+    store = ActorStateStore()
+    query = select(State.user_id, State.begin, State.end).where(or_(State.end.is_(None), State.end >= now()))
+    with current_app.app_context():
+        for actor_id, begin, end in db.session.execute(query):
+            store.add(actor_id, begin, end)
+        current_app.extensions['actor_state_store'] = store
+    return store
+
+
+def get_principal_from_api_key(api_key: str) -> Optional[Tuple[uuid.UUID, Role]]:
+    """ returns (user_id, role) for an api key; results are cached by key hash, unknown keys are not cached """
+    key_hash = simple_hash_str(api_key)
+    principal = principal_cache().get(key_hash)
+    if principal is not None:
+        return principal
+    generation = principal_cache().generation
     with current_app.app_context():
-        user_ids = [user_id for user_id in db.session.execute(query)]
-    if user_ids:
-        if len(user_ids) > 1:
-            log(f'api key "{simple_hash_str(api_key)}" found in more than one user row')
-        return user_ids[0][0]
+        principals = [tuple(principal_tuple) for principal_tuple in db.session.execute(principal_query(key_hash))]
+    return remember_principal(key_hash, principals, generation)
+
+
+def principal_query(key_hash: str) -> Select:
+    return select(User.id, User.role).where(User.api_key == key_hash)
+
+
+def remember_principal(key_hash: str, principals: List[Tuple[uuid.UUID, Role]],
+                       generation: int) -> Optional[Tuple[uuid.UUID, Role]]:
+    """ caches the result of principal_query, run after reading principal_cache().generation; unknown keys are not
+    cached, neither are results that an api key change may have overtaken (their row can be stale) """
+    if principals:
+        if len(principals) > 1:
+            log(f'api key "{key_hash}" found in more than one user row')
+        principal = principals[0]
+        principal_cache().set(key_hash, principal, generation)
+        # noinspection PyTypeChecker
+        return principal
+    return None
+
+
+def get_user_id_from_api_key(api_key: str) -> Optional[uuid.UUID]:
+    principal = get_principal_from_api_key(api_key)
+    if principal is not None:
+        return principal[0]
     return None
 
 
@@ -49,12 +158,15 @@ def get_scopes_from_user_id(user_id: uuid.UUID) -> List[Tuple[uuid.UUID, uuid.UU
 
 
 def get_role_from_user_id(user_id: uuid.UUID) -> List[Role]:
-    query = select(User.role).where(User.id == user_id)
     with current_app.app_context():
-        user_role = [tuple(role_tuple) for role_tuple in db.session.execute(query)][0][0]
+        user_role = [tuple(role_tuple) for role_tuple in db.session.execute(role_query(user_id))][0][0]
     return user_role
 
 
+def role_query(user_id: uuid.UUID) -> Select:
+    return select(User.role).where(User.id == user_id)
+
+
 def get_state_from_actor_id(actor_id: uuid.UUID) \
         -> List[Tuple[uuid.UUID, datetime.datetime, datetime.datetime]]:
     query = select(State.id, State.begin, State.end).where(State.user_id == actor_id)
@@ -95,8 +207,15 @@ def add_scope(user_id: uuid.UUID, actor_id: uuid.UUID, mode: Mode) -> None:
 
 
 def check_user_if_valid(user_id: uuid.UUID) -> bool:
-    valid_rows = get_valid_from_user_id(user_id)
-    return eval_ts_list(valid_rows)
+    query = select(active_exists(Valid.user_id, user_id, Valid.start, Valid.end, now()))
+    with current_app.app_context():
+        return bool(db.session.execute(query).scalar())
+
+
+def check_actor_if_active(actor_id: uuid.UUID) -> bool:
+    query = select(active_exists(State.user_id, actor_id, State.begin, State.end, now()))
+    with current_app.app_context():
+        return bool(db.session.execute(query).scalar())
 
 
 def assert_password_properties(password: str):
@@ -116,7 +235,8 @@ def set_user_password(user_id: uuid.UUID, password: str) -> None:
     assert_password_properties(password)
     # get user
     with current_app.app_context():
-        db.session.query(User).filter(User.id == user_id).update({'password': hash_salt_pw_str(password),
+        hashed_password = run_bcrypt(hash_salt_pw_str, password)
+        db.session.query(User).filter(User.id == user_id).update({'password': hashed_password,
                                                                   'updated_at': now()})
         db.session.commit()
 
@@ -124,32 +244,89 @@ def set_user_password(user_id: uuid.UUID, password: str) -> None:
 def check_password(user_id: uuid.UUID, password: str) -> bool:
     with current_app.app_context():
         query = select(User.password).where(User.id == user_id)
-        return check_pw_str(password, db.session.execute(query).first()[0])
+        hashed_password = db.session.execute(query).first()[0]
+    # cache hits are answered here, they neither wait for nor take a slot of the bcrypt pool
+    result = cached_check_pw_str(password, hashed_password)
+    if result is None:
+        result = run_bcrypt(check_pw_str, password, hashed_password)
+    return result
+
+
+class Authorization(NamedTuple):
+    valid: bool
+    any_scope: bool
+    scope: bool
+    active: bool
+
+
+def active_at(start: ColumnElement, end: ColumnElement, ts: datetime.datetime) -> ColumnElement:
+    """ sql equivalent of eval_ts_list for a single row: NULL start/end are open-ended, end <= start never matches """
+    return and_(or_(start.is_(None), start <= ts),
+                or_(end.is_(None), end >= ts),
+                not_(and_(start.is_not(None), end.is_not(None), end <= start)))
+
+
+def active_exists(owner_column: ColumnElement, owner_id: uuid.UUID, start: ColumnElement, end: ColumnElement,
+                  ts: datetime.datetime) -> ColumnElement:
+    """ sql EXISTS check whether any row of owner_id is active at ts; split on the end column so that an index on
+    (owner, end) only visits open-ended and not yet ended rows instead of the whole history """
+    return or_(select(owner_column).where(owner_column == owner_id, end.is_(None), active_at(start, end, ts)).exists(),
+               select(owner_column).where(owner_column == owner_id, end >= ts, active_at(start, end, ts)).exists())
+
+
+def authorization_query(user_id: uuid.UUID, actor_id: uuid.UUID, mode: Mode, ts: datetime.datetime) -> Select:
+    """ one row: (user valid at ts, user has any scope, user has the scope on the actor) """
+    return select(
+        active_exists(Valid.user_id, user_id, Valid.start, Valid.end, ts),
+        select(Scope.id).where(Scope.user_id == user_id).exists(),
+        select(Scope.id).where(Scope.user_id == user_id, Scope.actor_id == actor_id, Scope.mode == mode).exists())
+
+
+def authorization_from_row(row: Sequence, actor_id: uuid.UUID, ts: datetime.datetime) -> Authorization:
+    return Authorization(*[bool(value) for value in row], actor_state_store().is_active(actor_id, ts))
+
+
+def get_authorization(user_id: uuid.UUID, actor_id: uuid.UUID, mode: Mode) -> Authorization:
+    """ resolves validity of the user and its scopes on the actor in one query, the active state of the actor is
+    answered by the in-memory actor state store """
+    ts_now = now()
+    with current_app.app_context():
+        row = db.session.execute(authorization_query(user_id, actor_id, mode, ts_now)).one()
+    return authorization_from_row(row, actor_id, ts_now)
 
 
 def set_state(actor_id: uuid.UUID, user_id: uuid.UUID) -> None:
+    check_set_state_authorization(get_authorization(user_id, actor_id, Mode.write), user_id, actor_id)
+    start = now()
+    set_actor_state(actor_id, start=start, end=start + SET_STATE_DURATION)
+    push_actor_state(actor_id, start, start + SET_STATE_DURATION)
+    add_usage(user_id, actor_id, Type.setState)
+    SET_STATE_RESULTS.inc(result='grant')
+
+
+def check_set_state_authorization(authorization: Authorization, user_id: uuid.UUID, actor_id: uuid.UUID) -> None:
+    """ raises PermissionError if the authorization does not allow setState """
     # check if users valid status
-    if not check_user_if_valid(user_id):
+    if not authorization.valid:
+        SET_STATE_RESULTS.inc(result='denial')
         raise PermissionError(f'user currently not valid: {user_id=}')
 
     # get scope of user
-    scopes = get_scopes_from_user_id(user_id)
-    if not scopes:
+    if not authorization.any_scope:
+        SET_STATE_RESULTS.inc(result='denial')
         raise PermissionError(f'no scopes found for user_id "{user_id}"')
 
-    if [s for s in scopes if s[1] == actor_id and s[2] == Mode.write]:
-        set_actor_state(actor_id, start=now(), end=now() + datetime.timedelta(seconds=10))
-        add_usage(user_id, actor_id, Type.setState)
-        return
-    else:
+    if not authorization.scope:
+        SET_STATE_RESULTS.inc(result='denial')
         raise PermissionError(f'{actor_id=} scope not found')
 
 
-def check_scope_valid_return_state(user_id: uuid.UUID, actor_id: uuid.UUID) -> Optional[bool]:
-    scopes = [s[1] for s in get_scopes_from_user_id(user_id) if s[1] == actor_id and s[2] == Mode.read]
-    if scopes:
-        states_list = get_state_from_actor_id(actor_id)
-        if eval_ts_list(states_list):
+def check_scope_valid_return_state(user_id: uuid.UUID, actor_id: uuid.UUID,
+                                   authorization: Optional[Authorization] = None) -> Optional[bool]:
+    if authorization is None:
+        authorization = get_authorization(user_id, actor_id, Mode.read)
+    if authorization.scope:
+        if authorization.active:
             # state of actor is true
             add_usage(user_id, actor_id, Type.getState_true)
             return True
@@ -163,35 +340,131 @@ def check_scope_valid_return_state(user_id: uuid.UUID, actor_id: uuid.UUID) -> O
 def get_state(actor_id: uuid.UUID, user_id: uuid.UUID) -> Optional[bool]:
     if user_id is None:
         raise KeyError(f'user id not found: {user_id}')
+    return evaluate_get_state(get_authorization(user_id, actor_id, Mode.read), user_id, actor_id)
+
+
+def evaluate_get_state(authorization: Authorization, user_id: uuid.UUID, actor_id: uuid.UUID) -> Optional[bool]:
+    """ getState outcome of an authorization; records the heartbeat and usage rows """
     # check if users valid status
-    if not check_user_if_valid(user_id):
+    if not authorization.valid:
+        GET_STATE_RESULTS.inc(result='denial')
         raise PermissionError(f'user currently not valid: {user_id=}')
 
-    if check_and_increment():
-        sanitize_state_db()
-
     add_usage(user_id, actor_id, Type.last_getState)
 
     # get scope of user
-    return check_scope_valid_return_state(user_id, actor_id)
+    result = check_scope_valid_return_state(user_id, actor_id, authorization)
+    GET_STATE_RESULTS.inc(result=str(result).lower())
+    return result
+
+
+def batch_authorization_query(user_id: uuid.UUID, actor_ids: List[uuid.UUID], mode: Mode,
+                              ts: datetime.datetime) -> Select:
+    """ rows (user valid at ts, actor_id), one per actor of actor_ids the user has the scope on, or a single row with
+    a NULL actor_id if there is none """
+    scoped = select(Scope.actor_id).where(Scope.user_id == user_id, Scope.mode == mode,
+                                          Scope.actor_id.in_(actor_ids)).subquery()
+    anchor = select(literal(1).label('anchor')).subquery()
+    return (select(active_exists(Valid.user_id, user_id, Valid.start, Valid.end, ts), scoped.c.actor_id)
+            .select_from(anchor).outerjoin(scoped, true()))
+
+
+def get_states(actor_ids: List[uuid.UUID], user_id: uuid.UUID) -> Dict[uuid.UUID, Union[bool, str]]:
+    """ getState for several actors: validity and scopes are resolved in one query, the active states are answered
+    by the in-memory actor state store """
+    ts_now = now()
+    with current_app.app_context():
+        rows = db.session.execute(batch_authorization_query(user_id, actor_ids, Mode.read, ts_now)).all()
+    return evaluate_get_states(rows, user_id, actor_ids, ts_now)
+
+
+def evaluate_get_states(rows: Sequence[Sequence], user_id: uuid.UUID, actor_ids: List[uuid.UUID],
+                        ts: datetime.datetime) -> Dict[uuid.UUID, Union[bool, str]]:
+    """ getStates outcome of the batch authorization rows: True/False per actor, FORBIDDEN for actors without read
+    scope; heartbeat and usage rows of all permitted actors are recorded as one batch """
+    if not rows[0][0]:
+        GET_STATE_RESULTS.inc(result='denial')
+        raise PermissionError(f'user currently not valid: {user_id=}')
+    scoped = {actor_id for _, actor_id in rows if actor_id is not None}
+    active = actor_state_store().active_map(scoped, ts)
+    results = {}
+    usage_rows = []
+    for actor_id in actor_ids:
+        if actor_id not in scoped:
+            results[actor_id] = FORBIDDEN
+            GET_STATE_RESULTS.inc(result='none')
+            continue
+        usage_rows.append(usage_row(user_id, actor_id, Type.last_getState))
+        if active[actor_id]:
+            usage_rows.append(usage_row(user_id, actor_id, Type.getState_true))
+        results[actor_id] = active[actor_id]
+        GET_STATE_RESULTS.inc(result=str(active[actor_id]).lower())
+    add_usages(usage_rows)
+    return results
+
+
+def usage_recorder() -> Optional[BatchRecorder]:
+    return current_app.extensions.get('usage_recorder')
+
+
+def usage_row(user_id: uuid.UUID, actor_id: uuid.UUID, usage_type: Type) -> Dict:
+    ts_now = now()
+    return {'id': uuid.uuid4(), 'user_id': user_id, 'actor_id': actor_id, 'timestamp': ts_now,
+            'created_at': ts_now, 'updated_at': ts_now, 'type': usage_type}
 
 
 def add_usage(user_id: uuid.UUID, actor_id: uuid.UUID, usage_type: Type) -> None:
-    usage_data = {'id': uuid.uuid4(), 'user_id': user_id, 'actor_id': actor_id, 'timestamp': now(),
-                  'created_at': now(), 'updated_at': now(), 'type': usage_type}
+    add_usages([usage_row(user_id, actor_id, usage_type)])
 
-    if usage_type == Type.last_getState:
-        with current_app.app_context():
-            result = db.session.execute(select(Usage).where(Usage.user_id == actor_id,
-                                                            Usage.type == usage_type)).first()
-            if result is None:
-                add_entity_to_db(Usage(**usage_data))
-            else:
-                db.session.execute(update(Usage).where(Usage.user_id == actor_id,
-                                                       Usage.type == usage_type).values({'timestamp': now()}))
-                db.session.commit()
+
+def add_usages(usage_rows: List[Dict]) -> None:
+    """ hands the rows to the write-behind recorder, or writes them in one transaction without it """
+    if not usage_rows:
+        return
+    recorder = usage_recorder()
+    if recorder is not None:
+        recorder.record_many(usage_rows)
     else:
-        add_entity_to_db(Usage(**usage_data))
+        write_usage_batch(usage_rows)
+
+
+def write_usage_batch(usage_rows: List[Dict]) -> None:
+    """ writes usage rows in one transaction; last_getState rows only update the heartbeat timestamp of the actor """
+    heartbeats = {}
+    inserts = []
+    for usage_data in usage_rows:
+        if usage_data['type'] == Type.last_getState:
+            # rows are in chronological order, keep the newest heartbeat per actor
+            heartbeats[usage_data['actor_id']] = usage_data
+        else:
+            inserts.append(usage_data)
+
+    with current_app.app_context():
+        if heartbeats:
+            query = select(Usage.user_id).where(Usage.type == Type.last_getState,
+                                                Usage.user_id.in_(list(heartbeats.keys())))
+            existing = set(db.session.execute(query).scalars())
+            updates = [{'b_actor_id': actor_id, 'b_timestamp': usage_data['timestamp']}
+                       for actor_id, usage_data in heartbeats.items() if actor_id in existing]
+            if updates:
+                usage_table = Usage.__table__
+                db.session.execute(update(usage_table).where(usage_table.c.user_id == bindparam('b_actor_id'),
+                                                             usage_table.c.type == Type.last_getState)
+                                   .values({'timestamp': bindparam('b_timestamp')}), updates)
+            # the heartbeat row of an actor is keyed by user_id = actor_id (see heartbeat_query), also when the
+            # state has been polled with another key, e.g. by a controller serving several actors
+            inserts += [{**usage_data, 'user_id': actor_id} for actor_id, usage_data in heartbeats.items()
+                        if actor_id not in existing]
+        if inserts:
+            db.session.execute(insert(Usage), inserts)
+        db.session.commit()
+
+
+def flush_usage() -> None:
+    """ writes pending usage rows of the write-behind recorder, so that subsequent reads see them """
+    recorder = usage_recorder()
+    if recorder is not None:
+        recorder.flush()
 
 
 def add_valid(user_id: uuid.UUID, start: Optional[datetime.datetime] = None,
@@ -208,12 +481,11 @@ def add_entity_to_db(entity: Union[User, Valid, Scope, Usage, State]) -> None:
 
 
 def check_if_admin_by_api_key(api_key: str) -> bool:
-    user_id = get_user_id_from_api_key(api_key)
-    if user_id is None:
+    principal = get_principal_from_api_key(api_key)
+    if principal is None:
         return False
     else:
-        user_role = get_role_from_user_id(user_id)
-        return user_role == Role.admin
+        return principal[1] == Role.admin
 
 
 def add_bultin_admin_user():
@@ -240,51 +512,465 @@ def add_bultin_maintenance_user():
 def add_user(name: str, role: Role, email: Optional[str] = None, password: Optional[str] = None) -> Optional[
     Dict[str, str]]:
     if password is not None:
-        password = hash_salt_pw_str(password)
+        password = run_bcrypt(hash_salt_pw_str, password)
     if not isinstance(role, Role):
         raise TypeError(f'unknown role: {role}')
     api_key_raw = generate_api_key()
     user_data = {'id': uuid.uuid4(), 'name': name, 'email': email, 'password': password, 'role': role,
                  'api_key': simple_hash_str(api_key_raw)}
     add_entity_to_db(User(**user_data))
+    principal_cache().invalidate(user_data['api_key'])
     return {'id': user_data['id'].hex, 'api_key': api_key_raw,
             'password': '-has been set-' if password is not None else None}
 
 
+def hash_passwords(passwords: List[str]) -> List[str]:
+    """ hashes on all workers of the bcrypt pool, one wave at a time so that logins keep their queue slots """
+    pool = bcrypt_pool()
+    timeout = current_app.config.get('BCRYPT_TIMEOUT', 5)
+    hashed_passwords = []
+    for offset in range(0, len(passwords), pool.max_workers):
+        futures = [pool.submit(hash_salt_pw_str, password) for password in passwords[offset:offset + pool.max_workers]]
+        hashed_passwords += [future.result(timeout=timeout) for future in futures]
+    return hashed_passwords
+
+
+def parse_user_reference(item: dict, prefix: str) -> Union[uuid.UUID, str]:
+    """ '<prefix>-id' (uuid) or '<prefix>-name' of a provisioning item """
+    if item.get(f'{prefix}-id') is not None:
+        return uuid.UUID(str(item[f'{prefix}-id']))
+    if isinstance(item.get(f'{prefix}-name'), str):
+        return item[f'{prefix}-name']
+    raise ValueError(f'{prefix}-id or {prefix}-name missing')
+
+
+def provision(users: List[dict], scopes: List[dict], valid: List[dict]) -> Tuple[bool, Dict[str, List[dict]]]:
+    """ validates all items and inserts the users, scopes and valid windows in one transaction; scopes and valid
+    windows may reference users of the same request by name. Nothing is written if any item is invalid.
+    Returns (success, per-item results) """
+    ts_now = now()
+    references = []
+    for item in scopes + valid:
+        for prefix in ('user', 'actor'):
+            try:
+                references.append(parse_user_reference(item, prefix))
+            except (ValueError, AttributeError):
+                pass
+    names = {item['name'] for item in users if isinstance(item, dict) and isinstance(item.get('name'), str)}
+    emails = {item['email'] for item in users if isinstance(item, dict) and isinstance(item.get('email'), str)}
+    query = select(User.id, User.name, User.role, User.email).where(or_(
+        User.id.in_([r for r in references if isinstance(r, uuid.UUID)]),
+        User.name.in_(names | {r for r in references if isinstance(r, str)}),
+        User.email.in_(emails)))
+    with current_app.app_context():
+        existing = db.session.execute(query).all()
+    roles_by_id = {user_id: role for user_id, _, role, _ in existing}
+    ids_by_name = {name: user_id for user_id, name, _, _ in existing}
+    taken_emails = {email for _, _, _, email in existing if email is not None}
+
+    results = {'users': [], 'scopes': [], 'valid': []}
+    user_rows, passwords, api_keys, scope_rows, valid_rows = [], [], [], [], []
+
+    def resolve(item: dict, prefix: str) -> uuid.UUID:
+        reference = parse_user_reference(item, prefix)
+        user_id = ids_by_name.get(reference) if isinstance(reference, str) else reference
+        if user_id not in roles_by_id:
+            raise ValueError(f'unknown {prefix}: {reference}')
+        return user_id
+
+    for item in users:
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('item must be an object')
+            name, email, password = item.get('name'), item.get('email'), item.get('password')
+            if not isinstance(name, str) or not name:
+                raise ValueError('name missing')
+            if name in ids_by_name:
+                raise ValueError(f'name already taken: {name}')
+            try:
+                role = Role[str(item.get('role'))]
+            except KeyError:
+                raise ValueError(f'unknown role: {item.get("role")}')
+            if email is not None and (not isinstance(email, str) or email in taken_emails):
+                raise ValueError(f'email invalid or already taken: {email}')
+            if password is not None and not isinstance(password, str):
+                raise ValueError('password must be a string')
+        except ValueError as e:
+            results['users'].append({'status': 'error', 'msg': str(e)})
+            continue
+        api_key_raw = generate_api_key()
+        user_rows.append({'id': uuid.uuid4(), 'name': name, 'email': email, 'role': role,
+                          'api_key': simple_hash_str(api_key_raw), 'created_at': ts_now, 'updated_at': ts_now})
+        passwords.append(password)
+        api_keys.append(api_key_raw)
+        ids_by_name[name] = user_rows[-1]['id']
+        roles_by_id[user_rows[-1]['id']] = role
+        if email is not None:
+            taken_emails.add(email)
+        results['users'].append({'status': 'ok', 'id': user_rows[-1]['id'].hex, 'name': name, 'api_key': api_key_raw,
+                                 'password': '-has been set-' if password is not None else None})
+
+    for item in scopes:
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('item must be an object')
+            user_id = resolve(item, 'user')
+            actor_id = resolve(item, 'actor')
+            if roles_by_id[actor_id] != Role.actor:
+                raise ValueError(f'not an actor: {actor_id.hex}')
+            try:
+                mode = Mode[str(item.get('mode'))]
+            except KeyError:
+                raise ValueError(f'unknown mode: {item.get("mode")}')
+        except ValueError as e:
+            results['scopes'].append({'status': 'error', 'msg': str(e)})
+            continue
+        scope_rows.append({'id': uuid.uuid4(), 'user_id': user_id, 'actor_id': actor_id, 'mode': mode,
+                           'created_at': ts_now, 'updated_at': ts_now})
+        results['scopes'].append({'status': 'ok', 'id': scope_rows[-1]['id'].hex})
+
+    for item in valid:
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('item must be an object')
+            user_id = resolve(item, 'user')
+            start = datetime.datetime.fromisoformat(item['start']) if item.get('start') is not None else None
+            end = datetime.datetime.fromisoformat(item['end']) if item.get('end') is not None else None
+            if start is not None and end is not None and end <= start:
+                raise ValueError('end must be after start')
+        except (ValueError, TypeError) as e:
+            results['valid'].append({'status': 'error', 'msg': str(e)})
+            continue
+        valid_rows.append({'id': uuid.uuid4(), 'user_id': user_id, 'start': start, 'end': end,
+                           'created_at': ts_now, 'updated_at': ts_now})
+        results['valid'].append({'status': 'ok', 'id': valid_rows[-1]['id'].hex})
+
+    if any(result['status'] != 'ok' for item_results in results.values() for result in item_results):
+        return False, results
+
+    hashed_passwords = iter(hash_passwords([password for password in passwords if password is not None]))
+    for user_row, password in zip(user_rows, passwords):
+        user_row['password'] = next(hashed_passwords) if password is not None else None
+    with current_app.app_context():
+        try:
+            for model, rows in ((User, user_rows), (Scope, scope_rows), (Valid, valid_rows)):
+                if rows:
+                    db.session.execute(insert(model), rows)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            raise ValueError('conflicting rows have been written concurrently, nothing has been written')
+    return True, results
+
+
 def regenerate_api_key(user_id: uuid.UUID) -> Optional[Dict[str, str]]:
     api_key_raw = generate_api_key()
     with current_app.app_context():
         db.session.query(User).filter(User.id == user_id).update(
             {'api_key': simple_hash_str(api_key_raw), 'updated_at': now()})
+        publish_change(CHANGE_PRINCIPAL, user_id.hex)
         db.session.commit()
+    principal_cache().invalidate_where(lambda principal: principal[0] == user_id)
     return {'api_key': api_key_raw}
 
 
 def health_check_actor(actor_id: uuid.UUID, timeout: int) -> bool:
-    if get_role_from_user_id(actor_id) != Role.actor:
+    check_health_check_args(get_role_from_user_id(actor_id), timeout)
+    flush_usage()
+    with current_app.app_context():
+        timestamps = list(db.session.execute(heartbeat_query(actor_id)).scalars())
+    return evaluate_heartbeats(timestamps, timeout)
+
+
+def check_health_check_args(role: Role, timeout: int) -> None:
+    if role != Role.actor:
         raise TypeError("not an actor")
     if timeout <= 0:
         raise ValueError("timeout must be larger than 0")
+
+
+def heartbeat_query(actor_id: uuid.UUID) -> Select:
+    """ the most recent heartbeat of the actor, NULL if there is none """
+    return select(func.max(Usage.timestamp)).where(Usage.type == Type.last_getState, Usage.user_id == actor_id)
+
+
+def fleet_heartbeat_query(actor_ids: Optional[List[uuid.UUID]] = None) -> Select:
+    """ (actor_id, most recent heartbeat or NULL) for every actor, or for the actors of actor_ids """
+    query = (select(User.id, func.max(Usage.timestamp))
+             .outerjoin(Usage, and_(Usage.type == Type.last_getState, Usage.user_id == User.id))
+             .where(User.role == Role.actor)
+             .group_by(User.id))
+    if actor_ids is not None:
+        query = query.where(User.id.in_(actor_ids))
+    return query
+
+
+def is_healthy(last_heartbeat: Optional[datetime.datetime], timeout: int, ts_now: datetime.datetime) -> bool:
+    if last_heartbeat is None:
+        return False
+    return ts_now - last_heartbeat.replace(tzinfo=datetime.timezone.utc) <= datetime.timedelta(seconds=timeout)
+
+
+def evaluate_heartbeats(timestamps: List[Optional[datetime.datetime]], timeout: int) -> bool:
+    """ healthy if the most recent heartbeat is at most timeout seconds old """
+    timestamps = [ts for ts in timestamps if ts is not None]
+    healthy = is_healthy(max(timestamps) if timestamps else None, timeout, now())
+    HEALTH_CHECK_RESULTS.inc(result='healthy' if healthy else 'unhealthy')
+    return healthy
+
+
+def fleet_health(timeout: int, timeouts: Optional[Dict[uuid.UUID, int]] = None,
+                 actor_ids: Optional[List[uuid.UUID]] = None) -> Dict[uuid.UUID, bool]:
+    """ health of every actor (or of the actors of actor_ids) from one aggregate query; timeouts overrides the
+    timeout per actor. Ids of other users than actors are left out """
+    timeouts = timeouts if timeouts is not None else {}
+    if min([timeout, *timeouts.values()]) <= 0:
+        raise ValueError("timeout must be larger than 0")
+    flush_usage()
+    ts_now = now()
     with current_app.app_context():
-        result = db.session.execute(select(Usage.timestamp).filter_by(user_id=actor_id, type=Type.last_getState))
-        timedelta_result = sorted([now() - ts[0].replace(tzinfo=datetime.timezone.utc) for ts in result])
-        if len(timedelta_result) == 0:
-            return False
-        else:
-            most_recent = timedelta_result[0]
-            return most_recent <= datetime.timedelta(seconds=timeout)
+        rows = db.session.execute(fleet_heartbeat_query(actor_ids)).all()
+    health = {actor_id: is_healthy(last_heartbeat, timeouts.get(actor_id, timeout), ts_now)
+              for actor_id, last_heartbeat in rows}
+    for healthy in health.values():
+        HEALTH_CHECK_RESULTS.inc(result='healthy' if healthy else 'unhealthy')
+    return health
+
+
+def sanitize_state_db(horizon: Optional[datetime.timedelta] = None, archive: Optional[bool] = None,
+                      chunk_size: int = 1000) -> Dict[str, Union[int, bool, float]]:
+    """ moves State rows that ended more than horizon ago into the archive table (or deletes them if archive is
+    False); open-ended rows are kept. Defaults are taken from STATE_RETENTION_HORIZON and STATE_RETENTION_ARCHIVE """
+    if horizon is None:
+        horizon = datetime.timedelta(seconds=current_app.config.get('STATE_RETENTION_HORIZON', 7 * 24 * 3600))
+    if archive is None:
+        archive = current_app.config.get('STATE_RETENTION_ARCHIVE', True)
+    ts_start = time.perf_counter()
+    ts_now = now()
+    cutoff = ts_now - horizon
+    pruned = 0
+    with current_app.app_context():
+        while True:
+            query = select(State.id).where(State.end.is_not(None), State.end < cutoff).limit(chunk_size)
+            state_ids = list(db.session.execute(query).scalars())
+            if not state_ids:
+                break
+            if archive:
+                db.session.execute(insert(StateArchive).from_select(
+                    ['id', 'user_id', 'begin', 'end', 'updated_at', 'created_at', 'archived_at'],
+                    select(State.id, State.user_id, State.begin, State.end, State.updated_at, State.created_at,
+                           literal(ts_now, db.DateTime)).where(State.id.in_(state_ids))))
+            db.session.execute(delete(State).where(State.id.in_(state_ids))
+                               .execution_options(synchronize_session=False))
+            db.session.commit()
+            pruned += len(state_ids)
+            if len(state_ids) < chunk_size:
+                break
+    actor_state_store().prune(cutoff)
+    duration = time.perf_counter() - ts_start
+    log(f'{ts_now.strftime("%Y-%m-%d %H:%M:%S")} sanitized state table: {pruned} rows '
+        f'{"archived" if archive else "deleted"} in {duration:.3f}s')
+    return {'rows': pruned, 'archived': archive, 'seconds': duration}
+
+
+# last_getState rows are heartbeats that are updated in place, they are neither rolled up nor archived
+ROLLUP_TYPES = (Type.setState, Type.getState_true)
+PERIOD_LENGTH = {Period.hour: datetime.timedelta(hours=1), Period.day: datetime.timedelta(days=1)}
+
+
+def naive_utc(ts: datetime.datetime) -> datetime.datetime:
+    """ timestamps are stored as naive utc """
+    if ts.tzinfo is None:
+        return ts
+    return ts.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def period_start(ts: datetime.datetime, period: Period) -> datetime.datetime:
+    ts = ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0) if period == Period.day else ts
+
+
+def rollup_watermark(period: Period) -> Optional[datetime.datetime]:
+    """ end of the last bucket that has been rolled up, None if there is none """
+    with current_app.app_context():
+        last_bucket = db.session.execute(select(func.max(UsageRollup.bucket))
+                                         .where(UsageRollup.period == period)).scalar()
+    return last_bucket + PERIOD_LENGTH[period] if last_bucket is not None else None
+
+
+def rollup_bucket_select(period: Period, bucket: datetime.datetime) -> Select:
+    """ counters of one bucket: hourly ones from the raw rows, daily ones from the hourly counters """
+    bucket_end = bucket + PERIOD_LENGTH[period]
+    if period == Period.hour:
+        return (select(literal(period, UsageRollup.period.type), literal(bucket, db.DateTime), Usage.user_id,
+                       Usage.actor_id, Usage.type, func.count())
+                .where(Usage.type.in_(ROLLUP_TYPES), Usage.timestamp >= bucket, Usage.timestamp < bucket_end)
+                .group_by(Usage.user_id, Usage.actor_id, Usage.type))
+    return (select(literal(period, UsageRollup.period.type), literal(bucket, db.DateTime), UsageRollup.user_id,
+                   UsageRollup.actor_id, UsageRollup.type, func.sum(UsageRollup.count))
+            .where(UsageRollup.period == Period.hour, UsageRollup.bucket >= bucket, UsageRollup.bucket < bucket_end)
+            .group_by(UsageRollup.user_id, UsageRollup.actor_id, UsageRollup.type))
+
+
+def rollup_window() -> datetime.timedelta:
+    return datetime.timedelta(seconds=current_app.config.get('USAGE_ROLLUP_WINDOW', 24 * 3600))
+
+
+def rollup_usage(lag: Optional[datetime.timedelta] = None,
+                 window: Optional[datetime.timedelta] = None) -> Dict[str, int]:
+    """ aggregates the raw usage rows of every hour that ended more than lag ago into per-user, per-actor, per-type
+    counters, and completed days of hourly counters into daily ones; empty stretches are skipped. The buckets of the
+    window (USAGE_ROLLUP_WINDOW) before the last rolled up bucket are counted again and their counters replaced, so
+    that rows written late for an hour that has already been rolled up (e.g. a write-behind batch flushed again after
+    a failed commit) are included; archive_usage does not touch the raw rows of the window. Returns the number of
+    newly rolled up buckets per period """
+    if lag is None:
+        lag = datetime.timedelta(seconds=current_app.config.get('USAGE_ROLLUP_LAG', 300))
+    if window is None:
+        window = rollup_window()
+    horizon = period_start(naive_utc(now()) - lag, Period.hour)
+    result = {}
+    for period, source, source_ts, source_filter in (
+            (Period.hour, Usage, Usage.timestamp, Usage.type.in_(ROLLUP_TYPES)),
+            (Period.day, UsageRollup, UsageRollup.bucket, UsageRollup.period == Period.hour)):
+        period_horizon = period_start(horizon, period)
+        watermark = rollup_watermark(period)
+        start = period_start(watermark - window, period) if watermark is not None else None
+        buckets = 0
+        with current_app.app_context():
+            while True:
+                query = select(func.min(source_ts)).where(source_filter, source_ts < period_horizon)
+                if start is not None:
+                    query = query.where(source_ts >= start)
+                first = db.session.execute(query).scalar()
+                if first is None:
+                    break
+                bucket = period_start(first, period)
+                statement = sqlite_insert(UsageRollup).from_select(
+                    ['period', 'bucket', 'user_id', 'actor_id', 'type', 'count'], rollup_bucket_select(period, bucket))
+                db.session.execute(statement.on_conflict_do_update(
+                    index_elements=['period', 'bucket', 'user_id', 'actor_id', 'type'],
+                    set_={'count': statement.excluded['count']}))
+                db.session.commit()
+                start = bucket + PERIOD_LENGTH[period]
+                if watermark is None or bucket >= watermark:
+                    buckets += 1
+        result[period.name] = buckets
+    return result
 
 
-def sanitize_state_db() -> None:
-    return
-    log(f'{now().strftime("%Y-%m-%d %H:%M:%S")} sanitized state table')
-    # ToDo: add sanitization logic
-    # for k, v in state_db().items():
-    #     if 'last_on' in v:
-    #         if v['last_on'] is None:
-    #             continue
-    #         elif v['last_on'] - datetime.timedelta(seconds=2) > now():
-    #             state_db()[k]['last_on'] = None
+def month_start(ts: datetime.datetime) -> datetime.datetime:
+    return ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(ts: datetime.datetime) -> datetime.datetime:
+    return month_start(month_start(ts) + datetime.timedelta(days=32))
+
+
+def archive_usage(horizon: Optional[datetime.timedelta] = None, archive: Optional[bool] = None,
+                  chunk_size: int = 1000) -> Dict[str, Union[int, bool]]:
+    """ moves raw usage rows older than horizon into the archive table of their month, usage_archive_YYYYMM (or
+    deletes them if archive is False); only rows of hours that have been rolled up and are before the window that
+    rollup_usage counts again are touched. Defaults are taken from USAGE_RETENTION_HORIZON and
+    USAGE_RETENTION_ARCHIVE """
+    if horizon is None:
+        horizon = datetime.timedelta(seconds=current_app.config.get('USAGE_RETENTION_HORIZON', 30 * 24 * 3600))
+    if archive is None:
+        archive = current_app.config.get('USAGE_RETENTION_ARCHIVE', True)
+    ts_now = now()
+    watermark = rollup_watermark(Period.hour)
+    if watermark is None:
+        return {'rows': 0, 'archived': archive}
+    cutoff = min(naive_utc(ts_now - horizon), period_start(watermark - rollup_window(), Period.hour))
+    moved = 0
+    with current_app.app_context():
+        while True:
+            first = db.session.execute(select(func.min(Usage.timestamp))
+                                       .where(Usage.type.in_(ROLLUP_TYPES), Usage.timestamp < cutoff)).scalar()
+            if first is None:
+                break
+            # one month (one archive table) at a time
+            month_cutoff = min(cutoff, next_month(first))
+            if archive:
+                archive_table = usage_archive_table(first.date())
+                archive_table.create(db.session.connection(), checkfirst=True)
+            while True:
+                query = (select(Usage.id).where(Usage.type.in_(ROLLUP_TYPES), Usage.timestamp < month_cutoff)
+                         .limit(chunk_size))
+                usage_ids = list(db.session.execute(query).scalars())
+                if not usage_ids:
+                    break
+                if archive:
+                    db.session.execute(insert(archive_table).from_select(
+                        ['id', 'user_id', 'actor_id', 'type', 'timestamp', 'updated_at', 'created_at', 'archived_at'],
+                        select(Usage.id, Usage.user_id, Usage.actor_id, Usage.type, Usage.timestamp, Usage.updated_at,
+                               Usage.created_at, literal(ts_now, db.DateTime)).where(Usage.id.in_(usage_ids))))
+                db.session.execute(delete(Usage).where(Usage.id.in_(usage_ids))
+                                   .execution_options(synchronize_session=False))
+                db.session.commit()
+                moved += len(usage_ids)
+                if len(usage_ids) < chunk_size:
+                    break
+    return {'rows': moved, 'archived': archive}
+
+
+def drop_usage_archives(retention: Optional[datetime.timedelta] = None) -> List[str]:
+    """ drops the archive tables of the months that ended more than retention ago, a whole month at a time instead
+    of deleting rows; retention defaults to USAGE_ARCHIVE_RETENTION, 0 keeps all archives. Returns the dropped table
+    names """
+    if retention is None:
+        retention = datetime.timedelta(seconds=current_app.config.get('USAGE_ARCHIVE_RETENTION', 365 * 24 * 3600))
+    if retention <= datetime.timedelta(0):
+        return []
+    cutoff = naive_utc(now() - retention)
+    dropped = []
+    with current_app.app_context():
+        for table in usage_archive_tables(db.engine):
+            month = usage_archive_month(table.name)
+            if next_month(datetime.datetime.combine(month, datetime.time())) > cutoff:
+                break
+            table.drop(db.engine)
+            dropped.append(table.name)
+    return dropped
+
+
+def usage_retention() -> Dict[str, Union[int, bool, float]]:
+    """ periodic job: rolls up usage, archives the raw rows beyond the retention horizon and drops expired archive
+    tables """
+    ts_start = time.perf_counter()
+    rollup = rollup_usage()
+    archived = archive_usage()
+    dropped = drop_usage_archives()
+    duration = time.perf_counter() - ts_start
+    log(f'{now().strftime("%Y-%m-%d %H:%M:%S")} usage retention: rolled up {rollup["hour"]} hours and '
+        f'{rollup["day"]} days, {archived["rows"]} rows {"archived" if archived["archived"] else "deleted"}, '
+        f'{len(dropped)} archive tables dropped in {duration:.3f}s')
+    return {'hours': rollup['hour'], 'days': rollup['day'], 'rows': archived['rows'],
+            'archived': archived['archived'], 'dropped': len(dropped), 'seconds': duration}
+
+
+def usage_report(period: Period, start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None,
+                 user_id: Optional[uuid.UUID] = None, actor_id: Optional[uuid.UUID] = None,
+                 limit: Optional[int] = None) -> List[Dict]:
+    """ usage counters of the buckets in [start, end) from the rollup table, ordered by bucket; hours that have not
+    been rolled up yet (see USAGE_ROLLUP_LAG) are not included """
+    query = select(UsageRollup.bucket, UsageRollup.user_id, UsageRollup.actor_id, UsageRollup.type,
+                   UsageRollup.count).where(UsageRollup.period == period)
+    if start is not None:
+        query = query.where(UsageRollup.bucket >= naive_utc(start))
+    if end is not None:
+        query = query.where(UsageRollup.bucket < naive_utc(end))
+    if user_id is not None:
+        query = query.where(UsageRollup.user_id == user_id)
+    if actor_id is not None:
+        query = query.where(UsageRollup.actor_id == actor_id)
+    query = query.order_by(UsageRollup.bucket, UsageRollup.user_id, UsageRollup.actor_id, UsageRollup.type)
+    if limit is not None:
+        query = query.limit(limit)
+    with current_app.app_context():
+        return [{'bucket': bucket.replace(tzinfo=datetime.timezone.utc).isoformat(), 'user-id': row_user_id.hex,
+                 'actor-id': row_actor_id.hex, 'type': usage_type.name, 'count': count}
+                for bucket, row_user_id, row_actor_id, usage_type, count in db.session.execute(query)]
 
 
 def log(msg: str):
@@ -294,7 +980,155 @@ def log(msg: str):
 def set_actor_state(actor_id: uuid.UUID, start: Optional[datetime.datetime],
                     end: Optional[datetime.datetime]) -> None:
     assert (end - start) < datetime.timedelta(minutes=1)
-    new_state = State(**{'user_id': actor_id, 'begin': start, 'end': end})
     with current_app.app_context():
-        db.session.add(new_state)
+        for statement in actor_state_statements(uuid.uuid4(), actor_id, start, end):
+            db.session.execute(statement)
+        db.session.commit()
+    register_actor_state(actor_id, start, end)
+
+
+def actor_state_statements(state_id: uuid.UUID, actor_id: uuid.UUID, start: Optional[datetime.datetime],
+                           end: Optional[datetime.datetime]) -> List[Executable]:
+    """ statements writing a new State row, to be executed in one transaction """
+    statements = [insert(State).values(id=state_id, user_id=actor_id, begin=start, end=end)]
+    if shared_state_enabled():
+        statements.append(change_event_insert(CHANGE_STATE, state_id.hex))
+    return statements
+
+
+def register_actor_state(actor_id: uuid.UUID, start: Optional[datetime.datetime],
+                         end: Optional[datetime.datetime]) -> None:
+    """ to be called after the State row has been committed """
+    # the State table stays the durable log, reads are answered from memory
+    actor_state_store().add(actor_id, start, end, prune_before=start - datetime.timedelta(minutes=1))
+    actor_notifier().notify(actor_id)
+
+
+def webhook_dispatcher() -> Optional[WebhookDispatcher]:
+    return current_app.extensions.get('webhook_dispatcher')
+
+
+def push_actor_state(actor_id: uuid.UUID, start: datetime.datetime, end: datetime.datetime) -> None:
+    """ queues the push of a state set on this worker; whether the actor registered a callback is looked up by the
+    dispatcher, not on the request thread """
+    dispatcher = webhook_dispatcher()
+    if dispatcher is not None:
+        dispatcher.push(actor_id, {'actor-id': actor_id.hex, 'state': True, 'begin': start.isoformat(),
+                                   'end': end.isoformat()}, expires=end.timestamp())
+
+
+def resolve_callback(actor_id: uuid.UUID) -> Optional[Tuple[str, str]]:
+    """ (url, secret) of the callback the actor registered """
+    row = db.session.execute(select(Callback.url, Callback.secret).where(Callback.actor_id == actor_id)).first()
+    return tuple(row) if row is not None else None
+
+
+def write_dead_letters(jobs: List[WebhookJob]) -> None:
+    db.session.execute(insert(CallbackDeadLetter), [{'id': uuid.uuid4(), 'actor_id': job.key, 'url': job.url,
+                                                     'payload': json.dumps(job.payload), 'attempts': job.attempts,
+                                                     'error': job.error} for job in jobs])
+    db.session.commit()
+
+
+def register_callback(actor_id: uuid.UUID, url: str) -> str:
+    """ registers (or replaces) the callback url of the actor; returns the new secret the pushes are signed with """
+    secret = generate_api_key()
+    with current_app.app_context():
+        callback = db.session.execute(select(Callback).where(Callback.actor_id == actor_id)).scalar_one_or_none()
+        if callback is None:
+            db.session.add(Callback(actor_id=actor_id, url=url, secret=secret))
+        else:
+            callback.url, callback.secret, callback.updated_at = url, secret, naive_utc(now())
+        db.session.commit()
+    return secret
+
+
+def remove_callback(actor_id: uuid.UUID) -> bool:
+    with current_app.app_context():
+        removed = db.session.execute(delete(Callback).where(Callback.actor_id == actor_id)).rowcount
+        db.session.commit()
+    return removed > 0
+
+
+def shared_state_enabled() -> bool:
+    return current_app.config.get('SHARED_STATE', False)
+
+
+def worker_id() -> str:
+    return current_app.extensions['worker_id']
+
+
+def publish_change(kind: str, key: str) -> None:
+    """ adds a change event for the other worker processes to the current transaction (multi-process mode only) """
+    if shared_state_enabled():
+        db.session.execute(change_event_insert(kind, key))
+
+
+def change_event_insert(kind: str, key: str) -> Insert:
+    return insert(ChangeEvent).values(origin=worker_id(), kind=kind, key=key, created_at=time.time())
+
+
+def last_change_seq() -> int:
+    with current_app.app_context():
+        return db.session.execute(select(func.max(ChangeEvent.seq))).scalar_one() or 0
+
+
+def sync_shared_state() -> int:
+    """ applies the change events published by other workers since the last call to the in-memory state of this
+    worker (actor state store, principal cache, long-poll notifications); returns the number of applied events """
+    if not shared_state_enabled():
+        return 0
+    with current_app.extensions['shared_state_lock']:
+        with current_app.app_context():
+            query = select(ChangeEvent.seq, ChangeEvent.origin, ChangeEvent.kind, ChangeEvent.key) \
+                .where(ChangeEvent.seq > current_app.extensions['shared_state_seq']).order_by(ChangeEvent.seq)
+            events = db.session.execute(query).all()
+            if not events:
+                return 0
+            # sqlite has a single writer, so events become visible in seq order
+            current_app.extensions['shared_state_seq'] = events[-1].seq
+            foreign_events = [event for event in events if event.origin != worker_id()]
+            state_ids = [uuid.UUID(event.key) for event in foreign_events if event.kind == CHANGE_STATE]
+            if state_ids:
+                store = actor_state_store()
+                for actor_id, begin, end in db.session.execute(
+                        select(State.user_id, State.begin, State.end).where(State.id.in_(state_ids))):
+                    store.add(actor_id, begin, end,
+                              prune_before=begin - datetime.timedelta(minutes=1) if begin is not None else None)
+                    actor_notifier().notify(actor_id)
+        for event in foreign_events:
+            if event.kind == CHANGE_PRINCIPAL:
+                user_id = uuid.UUID(event.key)
+                principal_cache().invalidate_where(lambda principal: principal[0] == user_id)
+    return len(foreign_events)
+
+
+def publish_worker_metrics() -> None:
+    with current_app.app_context():
+        db.session.merge(WorkerMetrics(worker=worker_id(), snapshot=json.dumps(REGISTRY.snapshot()),
+                                       updated_at=time.time()))
+        db.session.commit()
+
+
+def other_worker_metrics() -> List[Dict[str, list]]:
+    """ metrics snapshots of the other live workers """
+    max_age = current_app.config.get('SHARED_STATE_WORKER_TIMEOUT', 60)
+    query = select(WorkerMetrics.snapshot).where(WorkerMetrics.worker != worker_id(),
+                                                 WorkerMetrics.updated_at >= time.time() - max_age)
+    with current_app.app_context():
+        return [json.loads(snapshot) for snapshot in db.session.execute(query).scalars()]
+
+
+def shared_state_housekeeping() -> None:
+    """ publishes the metrics of this worker and deletes old change events and snapshots of stopped workers """
+    publish_worker_metrics()
+    ts = time.time()
+    with current_app.app_context():
+        # the newest event is kept: without AUTOINCREMENT (tables created before it) sqlite reuses the seq values
+        # of deleted rows at the end of the table
+        db.session.execute(delete(ChangeEvent).where(
+            ChangeEvent.created_at < ts - current_app.config.get('SHARED_STATE_EVENT_RETENTION', 3600),
+            ChangeEvent.seq < select(func.max(ChangeEvent.seq)).scalar_subquery()))
+        db.session.execute(delete(WorkerMetrics).where(
+            WorkerMetrics.updated_at < ts - 10 * current_app.config.get('SHARED_STATE_WORKER_TIMEOUT', 60)))
         db.session.commit()
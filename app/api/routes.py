@@ -2,21 +2,31 @@ import datetime
 import json
 import traceback
 import uuid
-from typing import Optional
+from typing import Optional, Iterator
 
-from flask import request
+from flask import request, current_app, stream_with_context
 from werkzeug.exceptions import UnsupportedMediaType
 
-from app.api.func import get_state, set_state, log, add_user, add_scope, add_valid, check_if_admin_by_api_key, \
-    get_user_id_from_api_key, get_role_from_user_id, health_check_actor, regenerate_api_key
+from app.api.func import get_state, set_state, log, add_usage, add_user, add_scope, add_valid, check_if_admin_by_api_key, \
+    get_user_id_from_api_key, get_principal_from_api_key, health_check_actor, regenerate_api_key, principal_cache, \
+    actor_notifier, shared_state_enabled, other_worker_metrics, provision, get_states, fleet_health, usage_report, \
+    register_callback, remove_callback, wait_slots
+from app.export import export, EXPORT_TABLES, FORMATS
+from app.extensions import db
 from app.models.scope import Mode
+from app.models.usage import Type
+from app.models.usage_rollup import Period
+from app.util.metrics import REGISTRY
 from app.models.user import Role
 
 from app.api import bp
+from app.util.sql_stats import query_budget
+from app.util.webhook import target_error
 from flask import Response
 
 
 @bp.route('/', methods=['GET'])
+@query_budget(0)
 def index_get():
     return Response(
         response=json.dumps({'msg': 'This is the api endpoint.'}),
@@ -26,6 +36,7 @@ def index_get():
 
 
 @bp.route('/setState', methods=['POST'])
+@query_budget(3)
 def set_door_state():
     try:
         if request.json != {}:
@@ -94,6 +105,7 @@ def set_door_state():
 
 
 @bp.route('/getState', methods=['GET'])
+@query_budget(3)
 def get_door_state():
     if request.args.get('api-key') is None:
         log(f'key not found')
@@ -114,7 +126,18 @@ def get_door_state():
             return response_permission_error()
         else:
             try:
-                result = get_state(uuid.UUID(request.args.get('actor-id')), user_id)
+                wait = wait_from_str_or_none(request.args.get('wait'))
+                actor_id = uuid.UUID(request.args.get('actor-id'))
+                # read the version before evaluating the state, so a set_state in between is not missed
+                version = actor_notifier().version(actor_id)
+                result = get_state(actor_id, user_id)
+                # without a free slot the request is answered right away and the actor polls again
+                if result is False and wait > 0 and wait_slots().acquire():
+                    try:
+                        if actor_notifier().wait(actor_id, version, wait):
+                            result = get_state(actor_id, user_id)
+                    finally:
+                        wait_slots().release()
                 if result is None:
                     return response_permission_error()
                 else:
@@ -126,7 +149,161 @@ def get_door_state():
                 return response_permission_error()
 
 
+@bp.route('/getStates', methods=['GET'])
+@query_budget(3)
+def get_door_states():
+    """ getState for several actors (repeated actor-id parameter) of one caller, e.g. a controller driving several
+    door strikes; returns {'states': {actor_id: true/false/'forbidden'}}. With wait, the request returns as soon as
+    any of the actors changes """
+    if request.args.get('api-key') is None:
+        log(f'key not found')
+        return json_response(403, 'no key provided')
+    elif not request.args.getlist('actor-id'):
+        return json_response(403, 'no actor id provided')
+    elif len(request.args.getlist('actor-id')) > current_app.config.get('GET_STATES_MAX_ACTORS', 64):
+        return json_response(413, 'too many actor ids')
+
+    user_id = get_user_id_from_api_key(request.args.get('api-key'))
+    if user_id is None:
+        return response_permission_error()
+    try:
+        wait = wait_from_str_or_none(request.args.get('wait'))
+        actor_ids = list(dict.fromkeys(uuid.UUID(actor_id) for actor_id in request.args.getlist('actor-id')))
+        # read the versions before evaluating the states, so a set_state in between is not missed
+        versions = actor_notifier().versions(actor_ids)
+        results = get_states(actor_ids, user_id)
+        # shares the long-poll slots with getState
+        if True not in results.values() and wait > 0 and wait_slots().acquire():
+            try:
+                if actor_notifier().wait_any(versions, wait):
+                    results = get_states(actor_ids, user_id)
+            finally:
+                wait_slots().release()
+    except ValueError:
+        return response_input_error()
+    except PermissionError:
+        return response_permission_error()
+    return json_response(200, None, {'states': {actor_id.hex: result for actor_id, result in results.items()}})
+
+
+@bp.route('/registerCallback', methods=['POST'])
+@query_budget(3)
+def api_register_callback():
+    """ an actor (or an admin) registers the url its state is pushed to on setState, a POST with a json body:
+    {"actor-id": ..., "state": true, "begin": ..., "end": ...}, signed with the returned secret in the
+    X-DoorOpener-Signature header (sha256=<hex hmac of the body>); registering again replaces url and secret """
+    params = request_params()
+    if params.get('api-key') is None:
+        return json_response(403, 'key missing')
+    try:
+        actor_id = uuid.UUID(params.get('actor-id', ''))
+    except ValueError:
+        return response_input_error()
+    if not may_manage_callback(params['api-key'], actor_id):
+        return response_permission_error()
+    url = params.get('url', '')
+    # no pushes to loopback, private or link-local hosts unless they are allowed explicitly
+    if len(url) > 2048 or target_error(url, current_app.config.get('WEBHOOK_ALLOWED_HOSTS', ())) is not None:
+        return response_input_error()
+    return json_response(200, 'success', {'secret': register_callback(actor_id, url)})
+
+
+@bp.route('/removeCallback', methods=['POST'])
+@query_budget(2)
+def api_remove_callback():
+    params = request_params()
+    if params.get('api-key') is None:
+        return json_response(403, 'key missing')
+    try:
+        actor_id = uuid.UUID(params.get('actor-id', ''))
+    except ValueError:
+        return response_input_error()
+    if not may_manage_callback(params['api-key'], actor_id):
+        return response_permission_error()
+    if not remove_callback(actor_id):
+        return json_response(404, 'no callback registered')
+    return response_success()
+
+
+def request_params() -> dict:
+    """ json body or form fields """
+    body = request.get_json(silent=True)
+    return body if isinstance(body, dict) else request.form
+
+
+def may_manage_callback(api_key: str, actor_id: uuid.UUID) -> bool:
+    principal = get_principal_from_api_key(api_key)
+    if principal is None:
+        return False
+    user_id, role = principal
+    return (user_id == actor_id and role == Role.actor) or role == Role.admin
+
+
+@bp.route('/stream', methods=['GET'])
+def stream_door_state():
+    """ server-sent events: pushes the actor state whenever set_state activates the actor and sends periodic
+    keep-alives, which also update the last_getState heartbeat of the actor. A stream holds a server thread for as
+    long as it is open, so it takes one of the long-poll slots and is refused with 503 when none is free; app.asgi
+    serves the stream on the event loop instead """
+    if request.args.get('api-key') is None:
+        log(f'key not found')
+        return json_response(403, 'no key provided')
+    elif request.args.get('actor-id') is None:
+        return json_response(403, 'no actor id provided')
+
+    user_id = get_user_id_from_api_key(request.args.get('api-key'))
+    if user_id is None:
+        return response_permission_error()
+    try:
+        actor_id = uuid.UUID(request.args.get('actor-id'))
+        version = actor_notifier().version(actor_id)
+        result = get_state(actor_id, user_id)
+    except ValueError:
+        return response_input_error()
+    except PermissionError:
+        return response_permission_error()
+    if result is None:
+        return response_permission_error()
+    keepalive = current_app.config.get('STREAM_KEEPALIVE', 15)
+    slots = wait_slots()
+    if not slots.acquire():
+        return json_response(503, 'too many waiting requests')
+
+    def generate(state: bool, version: int) -> Iterator[str]:
+        yield sse_event({'state': state}, 'state')
+        while True:
+            # do not hold a database transaction open while waiting
+            db.session.close()
+            if actor_notifier().wait(actor_id, version, keepalive):
+                version = actor_notifier().version(actor_id)
+                try:
+                    state = get_state(actor_id, user_id)
+                except PermissionError:
+                    state = None
+                if state is None:
+                    yield sse_event({'msg': 'permission error'}, 'error')
+                    return
+                yield sse_event({'state': state}, 'state')
+            else:
+                add_usage(user_id, actor_id, Type.last_getState)
+                yield ': keep-alive\n\n'
+
+    response = Response(stream_with_context(generate(result, version)), status=200, mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # closed by the server once the client has gone
+    response.call_on_close(slots.release)
+    return response
+
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    message = f'data: {json.dumps(data)}\n\n'
+    if event is not None:
+        message = f'event: {event}\n' + message
+    return message
+
+
 @bp.route('/actorHealth', methods=['GET'])
+@query_budget(6)
 def check_actor_health():
     if request.args.get('api-key') is None:
         log(f'key not found')
@@ -148,11 +325,11 @@ def check_actor_health():
             mimetype='application/json'
         )
     else:
-        user_id = get_user_id_from_api_key(request.args.get('api-key'))
-        if user_id is None:
+        principal = get_principal_from_api_key(request.args.get('api-key'))
+        if principal is None:
             return response_permission_error()
         else:
-            role = get_role_from_user_id(user_id)
+            _, role = principal
             if role != Role.maintenance:
                 return Response(
                     response=json.dumps({'msg': 'api key is not from maintenance user'}),
@@ -173,6 +350,61 @@ def check_actor_health():
                     return response_permission_error()
 
 
+@bp.route('/fleetHealth', methods=['GET'])
+@query_budget(6)
+def check_fleet_health():
+    """ health of all actors, or of the actors given by repeated actor-id parameters, from one aggregate query;
+    repeated actor-timeout=<actor-id>:<seconds> parameters override the timeout of single actors """
+    if request.args.get('api-key') is None:
+        return json_response(403, 'key missing')
+    elif request.args.get('timeout') is None:
+        return json_response(403, 'no timeout provided')
+    principal = get_principal_from_api_key(request.args.get('api-key'))
+    if principal is None:
+        return response_permission_error()
+    elif principal[1] != Role.maintenance:
+        return json_response(403, 'api key is not from maintenance user')
+    try:
+        actor_ids = [uuid.UUID(actor_id) for actor_id in request.args.getlist('actor-id')] or None
+        timeouts = {}
+        for override in request.args.getlist('actor-timeout'):
+            actor_id, _, timeout = override.partition(':')
+            timeouts[uuid.UUID(actor_id)] = int(timeout)
+        health = fleet_health(int(request.args.get('timeout')), timeouts, actor_ids)
+    except ValueError:
+        return response_input_error()
+    unhealthy = sum(1 for healthy in health.values() if not healthy)
+    return json_response(200, None, {'health': {actor_id.hex: healthy for actor_id, healthy in health.items()},
+                                     'healthy': len(health) - unhealthy, 'unhealthy': unhealthy})
+
+
+@bp.route('/principalCacheStats', methods=['GET'])
+@query_budget(1)
+def principal_cache_stats():
+    if request.args.get('api-key') is None:
+        return json_response(403, 'key missing')
+    principal = get_principal_from_api_key(request.args.get('api-key'))
+    if principal is None:
+        return response_permission_error()
+    elif principal[1] != Role.maintenance:
+        return json_response(403, 'api key is not from maintenance user')
+    return json_response(200, None, principal_cache().stats())
+
+
+@bp.route('/metrics', methods=['GET'])
+@query_budget(2)
+def metrics():
+    if request.args.get('api-key') is None:
+        return json_response(403, 'key missing')
+    principal = get_principal_from_api_key(request.args.get('api-key'))
+    if principal is None:
+        return response_permission_error()
+    elif principal[1] != Role.maintenance:
+        return json_response(403, 'api key is not from maintenance user')
+    snapshots = other_worker_metrics() if shared_state_enabled() else []
+    return Response(response=REGISTRY.expose(snapshots), status=200, mimetype='text/plain; version=0.0.4')
+
+
 def json_response(status: int, msg: Optional[str], response: Optional[dict] = None) -> Response:
     if response is None:
         response = {}
@@ -187,6 +419,7 @@ def json_response(status: int, msg: Optional[str], response: Optional[dict] = No
 
 
 @bp.route('/addUser', methods=['GET'])
+@query_budget(2)
 def api_add_user():
     if request.args.get('api-key') is None:
         return json_response(403, 'key missing')
@@ -201,13 +434,17 @@ def api_add_user():
             log(f"unknown role: {request.args.get('role')}")
             return json_response(404, 'role unknown')
         if check_if_admin_by_api_key(request.args.get('api-key')):
-            result = add_user(request.args.get('name'), role=role, password=request.args.get('password'))
+            try:
+                result = add_user(request.args.get('name'), role=role, password=request.args.get('password'))
+            except TimeoutError:
+                return json_response(503, 'server busy, please try again')
             return json_response(200, None, result)
         else:
             return json_response(403, 'permission_error')
 
 
 @bp.route('/regenerateApiKey', methods=['GET'])
+@query_budget(2)
 def api_regenerate_api_key():
     if request.args.get('api-key') is None:
         return json_response(403, 'key missing')
@@ -231,6 +468,16 @@ def response_success():
     return json_response(200, 'success')
 
 
+def wait_from_str_or_none(wait_string: Optional[str]) -> float:
+    """ parses the long-polling wait parameter (in seconds), capped at LONG_POLL_MAX_WAIT """
+    if wait_string is None:
+        return 0
+    wait = float(wait_string)
+    if not 0 <= wait < float('inf'):
+        raise ValueError(f'invalid wait: {wait_string}')
+    return min(wait, current_app.config.get('LONG_POLL_MAX_WAIT', 30))
+
+
 def ts_from_iso_or_none(iso_string: Optional[str]) -> Optional[datetime.datetime]:
     if iso_string is not None:
         return datetime.datetime.fromisoformat(iso_string)
@@ -239,6 +486,7 @@ def ts_from_iso_or_none(iso_string: Optional[str]) -> Optional[datetime.datetime
 
 
 @bp.route('/addValid', methods=['GET'])
+@query_budget(2)
 def api_add_valid():
     if request.args.get('api-key') is None:
         return json_response(403, 'key missing')
@@ -255,6 +503,7 @@ def api_add_valid():
 
 
 @bp.route('/addScope', methods=['GET'])
+@query_budget(2)
 def api_add_scope():
     api_key = request.args.get('api-key')
     user_id = request.args.get('user-id')
@@ -282,3 +531,84 @@ def api_add_scope():
         except ValueError as e:
             return json_response(400, 'badly formed uuid string')
         return json_response(200, 'success')
+
+
+@bp.route('/provision', methods=['POST'])
+@query_budget(5)
+def api_provision():
+    """ creates users, scopes and valid windows in one transaction; scopes and valid windows reference users by
+    'user-id'/'actor-id' or by 'user-name'/'actor-name', including users created by the same request. Either all
+    items are written (200) or none (400, with the error of every failing item) """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return json_response(400, 'json object expected')
+    if body.get('api-key') is None:
+        return json_response(403, 'key missing')
+    if not check_if_admin_by_api_key(body['api-key']):
+        return response_permission_error()
+    items = {kind: body.get(kind, []) for kind in ('users', 'scopes', 'valid')}
+    if not all(isinstance(value, list) for value in items.values()):
+        return json_response(400, 'users, scopes and valid must be lists')
+    if sum(len(value) for value in items.values()) > current_app.config.get('PROVISION_MAX_ITEMS', 10_000):
+        return json_response(413, 'too many items')
+    try:
+        success, results = provision(items['users'], items['scopes'], items['valid'])
+    except TimeoutError:
+        return json_response(503, 'server busy, please try again')
+    except ValueError as e:
+        return json_response(409, str(e))
+    if not success:
+        return json_response(400, 'invalid items, nothing has been written', results)
+    return json_response(200, 'success', results)
+
+
+@bp.route('/usageReport', methods=['GET'])
+@query_budget(2)
+def api_usage_report():
+    """ hourly or daily usage counters per user, actor and type, read from the rollup table; optional start/end (iso),
+    user-id and actor-id filters """
+    if request.args.get('api-key') is None:
+        return json_response(403, 'key missing')
+    if not check_if_admin_by_api_key(request.args.get('api-key')):
+        return response_permission_error()
+    try:
+        period = Period[request.args.get('period', Period.day.name)]
+    except KeyError:
+        return json_response(404, 'period unknown')
+    try:
+        start = ts_from_iso_or_none(request.args.get('start'))
+        end = ts_from_iso_or_none(request.args.get('end'))
+        user_id = uuid.UUID(request.args['user-id']) if request.args.get('user-id') is not None else None
+        actor_id = uuid.UUID(request.args['actor-id']) if request.args.get('actor-id') is not None else None
+    except ValueError:
+        return response_input_error()
+    max_rows = current_app.config.get('USAGE_REPORT_MAX_ROWS', 10_000)
+    rows = usage_report(period, start, end, user_id, actor_id, limit=max_rows + 1)
+    return json_response(200, None, {'period': period.name, 'rows': rows[:max_rows], 'truncated': len(rows) > max_rows})
+
+
+@bp.route('/export', methods=['GET'])
+def api_export():
+    """ streams a table (usage, usage_archive, state, state_archive) as ndjson or csv, ordered by time; optional
+    start (inclusive) and end (exclusive) as iso timestamps """
+    if request.args.get('api-key') is None:
+        return json_response(403, 'key missing')
+    if not check_if_admin_by_api_key(request.args.get('api-key')):
+        return response_permission_error()
+    table = request.args.get('table', 'usage')
+    output_format = request.args.get('format', 'ndjson')
+    if table not in EXPORT_TABLES:
+        return json_response(404, 'table unknown')
+    if output_format not in FORMATS:
+        return json_response(404, 'format unknown')
+    try:
+        start = ts_from_iso_or_none(request.args.get('start'))
+        end = ts_from_iso_or_none(request.args.get('end'))
+    except ValueError:
+        return response_input_error()
+    # the permission check above ran in its own transaction, release it before streaming
+    db.session.close()
+    return Response(stream_with_context(export(table, output_format, start, end,
+                                               current_app.config.get('EXPORT_PAGE_SIZE', 5000))),
+                    status=200, mimetype=FORMATS[output_format],
+                    headers={'Content-Disposition': f'attachment; filename={table}.{output_format}'})
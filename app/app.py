@@ -1,22 +1,42 @@
-import logging
 import os
+import signal
+import sys
+import threading
+import uuid
 
 import waitress
-from flask import Flask, request
-
-from app.api.func import add_entity_to_db, add_bultin_admin_user, add_bultin_maintenance_user
+from flask import Flask
+
+from app.api.func import add_entity_to_db, add_bultin_admin_user, add_bultin_maintenance_user, init_principal_cache, \
+    init_bcrypt_pool, write_usage_batch, sanitize_state_db, rebuild_actor_state_store, sync_shared_state, \
+    last_change_seq, shared_state_housekeeping, usage_retention, resolve_callback, write_dead_letters
+from app.models.callback import Callback
+from app.models.callback_dead_letter import CallbackDeadLetter
+from app.models.change_event import ChangeEvent
 from app.models.user import User, Role
 from app.models.scope import Scope
 from app.models.state import State
+from app.models.state_archive import StateArchive
 from app.models.valid import Valid
 from app.models.usage import Usage
+from app.models.usage_rollup import UsageRollup
+from app.models.web_session import WebSession
+from app.models.worker_metrics import WorkerMetrics
 
 from app.extensions import db
-from app.util.util import generate_api_key
+from app.util.batch_recorder import BatchRecorder
+from app.util.metrics import setup_metrics
+from app.util.notify import WaitSlots
+from app.util.periodic import PeriodicJob
+from app.util.prefork import serve_prefork
+from app.util.request_log import setup_request_logging
+from app.util.session_store import SessionStore, DbSessionStore
+from app.util.webhook import WebhookDispatcher
+from app.util.sql_stats import setup_sql_instrumentation
+from app.util.sqlite_profile import apply_sqlite_profile, DEFAULT_SQLITE_PRAGMAS
+from app.util.util import generate_api_key, init_verification_cache
 from config import Config
 
-logging.basicConfig(filename='app.log', encoding='utf-8', level=logging.INFO)
-
 
 def create_app(config_class=Config):
     assert config_class.SECRET_KEY is not None, "SECRET_KEY env variable not set"
@@ -28,14 +48,19 @@ def create_app(config_class=Config):
 
     app.config.from_object(config_class)
 
-    @app.before_request
-    def log_the_request():
-        logging.info(
-            '\t'.join([str(e) for e in [request.args, request.access_route, request.cookies.get('SessionCookie'),
-                                        request.headers.get('User-Agent')]]))
+    app.extensions['background_jobs'] = [setup_request_logging(app)]
+    setup_metrics(app)
 
     # Initialize Flask extensions here
     db.init_app(app)
+    if app.config.get('SHARED_STATE', False):
+        setup_shared_state(app)
+    init_principal_cache(app.config.get('PRINCIPAL_CACHE_SIZE', 1024), app.config.get('PRINCIPAL_CACHE_TTL', 30))
+    init_verification_cache(app.config.get('VERIFICATION_CACHE_SIZE', 1024),
+                            app.config.get('VERIFICATION_CACHE_TTL', 300))
+    app.extensions['wait_slots'] = WaitSlots(app.config.get('LONG_POLL_MAX_WAITERS', 12))
+    app.extensions['background_jobs'].append(init_bcrypt_pool(app.config.get('BCRYPT_WORKERS', 2),
+                                                               app.config.get('BCRYPT_MAX_PENDING', 16)))
 
     # Register blueprints here
     from app.main import bp as main_bp
@@ -45,16 +70,108 @@ def create_app(config_class=Config):
     app.register_blueprint(api_bp, url_prefix='/api')
 
     with app.app_context():
+        # before the first connection is opened
+        apply_sqlite_profile(db.engine, app.config.get('SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS))
+        setup_sql_instrumentation(app, db.engine)
         db.create_all()
+        # create_all does not add new indexes to already existing tables
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
         add_bultin_admin_user()
         add_bultin_maintenance_user()
+        # events published after this point are applied on top of the rebuilt store
+        app.extensions['shared_state_seq'] = last_change_seq()
+        rebuild_actor_state_store()
+
+    from app.main.routes import init_session_store
+    if app.config.get('SHARED_STATE', False):
+        session_store = DbSessionStore(app, ttl=app.config.get('SESSION_TTL', 300),
+                                       maxsize=app.config.get('SESSION_MAX_SIZE', 100_000))
+        init_session_store(session_store)
+        shared_state_jobs = [PeriodicJob(app, sync_shared_state, app.config.get('SHARED_STATE_POLL_INTERVAL', 0.5)),
+                             PeriodicJob(app, session_store.trim, app.config.get('SESSION_TTL', 300))]
+        if app.config.get('MAINTENANCE_JOBS', True):
+            shared_state_jobs.append(PeriodicJob(app, shared_state_housekeeping, 15))
+        for job in shared_state_jobs:
+            job.start()
+        app.extensions['background_jobs'].extend(shared_state_jobs)
+    else:
+        init_session_store(SessionStore(ttl=app.config.get('SESSION_TTL', 300),
+                                        maxsize=app.config.get('SESSION_MAX_SIZE', 100_000)))
+
+    if app.config.get('USAGE_WRITE_BEHIND', True):
+        usage_recorder = BatchRecorder(app, write_usage_batch, flush_size=app.config.get('USAGE_FLUSH_SIZE', 500),
+                                       flush_interval=app.config.get('USAGE_FLUSH_INTERVAL', 1))
+        usage_recorder.start()
+        app.extensions['usage_recorder'] = usage_recorder
+        app.extensions['background_jobs'].append(usage_recorder)
+    # the retention jobs of several workers would archive and delete the same rows at the same time
+    maintenance_jobs = app.config.get('MAINTENANCE_JOBS', True)
+    if maintenance_jobs and app.config.get('STATE_RETENTION_INTERVAL', 3600) > 0:
+        state_retention = PeriodicJob(app, sanitize_state_db, app.config.get('STATE_RETENTION_INTERVAL', 3600))
+        state_retention.start()
+        app.extensions['state_retention'] = state_retention
+        app.extensions['background_jobs'].append(state_retention)
+    if maintenance_jobs and app.config.get('USAGE_RETENTION_INTERVAL', 3600) > 0:
+        usage_retention_job = PeriodicJob(app, usage_retention, app.config.get('USAGE_RETENTION_INTERVAL', 3600))
+        usage_retention_job.start()
+        app.extensions['usage_retention'] = usage_retention_job
+        app.extensions['background_jobs'].append(usage_retention_job)
+    if app.config.get('WEBHOOKS', True):
+        webhook_dispatcher = WebhookDispatcher(app, resolve_callback, write_dead_letters,
+                                               workers=app.config.get('WEBHOOK_WORKERS', 4),
+                                               max_per_target=app.config.get('WEBHOOK_MAX_PER_TARGET', 2),
+                                               max_attempts=app.config.get('WEBHOOK_MAX_ATTEMPTS', 5),
+                                               retry_base=app.config.get('WEBHOOK_RETRY_BASE', 1),
+                                               timeout=app.config.get('WEBHOOK_TIMEOUT', 5),
+                                               max_pending=app.config.get('WEBHOOK_MAX_PENDING', 10_000),
+                                               allowed_hosts=app.config.get('WEBHOOK_ALLOWED_HOSTS', ()))
+        webhook_dispatcher.start()
+        app.extensions['webhook_dispatcher'] = webhook_dispatcher
+        app.extensions['background_jobs'].append(webhook_dispatcher)
     return app
 
 
+def setup_shared_state(app: Flask) -> None:
+    """ multi-process mode: the changes published by the other workers (state changes, api key invalidations) are
+    applied by a periodic job every SHARED_STATE_POLL_INTERVAL seconds """
+    app.extensions['worker_id'] = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+    app.extensions['shared_state_lock'] = threading.Lock()
+
+
+def shutdown_app(app: Flask) -> None:
+    """ stops the background jobs of the app, pending usage rows are written """
+    for job in reversed(app.extensions.get('background_jobs', [])):
+        job.stop()
+
+
+def worker_config(index: int) -> type:
+    """ the config of prefork worker index, only worker 0 runs the maintenance jobs """
+    return type('WorkerConfig', (Config,), {'MAINTENANCE_JOBS': Config.MAINTENANCE_JOBS and index == 0})
+
+
 def main():
-    print("waitress")
-    waitress.serve(create_app(config_class=Config), host="127.0.0.1",
-                   port=int(os.getenv("SERVICE_PORT")) if os.getenv("SERVICE_PORT") is not None else 5050)
+    host = "127.0.0.1"
+    port = int(os.getenv("SERVICE_PORT")) if os.getenv("SERVICE_PORT") is not None else 5050
+    if Config.WORKERS > 1:
+        print(f"waitress, {Config.WORKERS} workers")
+        # set up the database once, before the workers start
+        app = create_app(config_class=Config)
+        shutdown_app(app)
+        with app.app_context():
+            db.engine.dispose()
+        serve_prefork(lambda index: create_app(config_class=worker_config(index)), host, port, Config.WORKERS,
+                      shutdown=shutdown_app, threads=Config.WAITRESS_THREADS)
+    else:
+        print("waitress")
+        # SIGTERM would skip the atexit handlers, exit through SystemExit so that pending usage rows are written
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        app = create_app(config_class=Config)
+        try:
+            waitress.create_server(app, host=host, port=port, threads=Config.WAITRESS_THREADS).run()
+        finally:
+            shutdown_app(app)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,390 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+from urllib.parse import parse_qsl
+
+import uvicorn
+from asgiref.wsgi import WsgiToAsgi
+from flask import Flask
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.sql import Select
+
+from app.api.func import principal_cache, principal_query, remember_principal, authorization_query, \
+    authorization_from_row, evaluate_get_state, check_set_state_authorization, actor_state_statements, \
+    register_actor_state, add_usage, actor_notifier, role_query, check_health_check_args, heartbeat_query, \
+    evaluate_heartbeats, usage_recorder, log, push_actor_state, SET_STATE_DURATION
+from app.api.routes import wait_from_str_or_none, sse_event
+from app.app import create_app, shutdown_app
+from app.models.scope import Mode
+from app.models.usage import Type
+from app.models.user import Role
+from app.util.metrics import SET_STATE_RESULTS, HTTP_REQUESTS, HTTP_LATENCY, HTTP_IN_FLIGHT
+from app.util.notify import ActorNotifier
+from app.util.sqlite_profile import apply_sqlite_profile, DEFAULT_SQLITE_PRAGMAS
+from app.util.util import now, simple_hash_str
+from config import Config
+
+JsonResult = Tuple[int, dict]
+
+PERMISSION_ERROR: JsonResult = (403, {'msg': 'permission error'})
+INPUT_ERROR: JsonResult = (403, {'msg': 'bad input error'})
+NO_KEY: JsonResult = (403, {'msg': 'no key provided'})
+NO_ACTOR_ID: JsonResult = (403, {'msg': 'no actor id provided'})
+
+
+def async_database_uri(uri: str) -> str:
+    """ sqlite:///path -> sqlite+aiosqlite:///path """
+    if uri.startswith('sqlite://'):
+        return 'sqlite+aiosqlite://' + uri[len('sqlite://'):]
+    raise ValueError(f'no async driver configured for {uri}')
+
+
+class ActorWaiters:
+    """ asyncio counterpart of ActorNotifier.wait: coroutines wait on futures that are resolved on the event loop
+    when the notifier reports a change of their actor (from any thread) """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, notifier: ActorNotifier):
+        self.loop = loop
+        self._notifier = notifier
+        self._futures: Dict[uuid.UUID, Set[asyncio.Future]] = {}
+        notifier.add_listener(self._on_notify)
+
+    def _on_notify(self, actor_id: uuid.UUID) -> None:
+        self.loop.call_soon_threadsafe(self._wake, actor_id)
+
+    def _wake(self, actor_id: uuid.UUID) -> None:
+        for future in self._futures.pop(actor_id, ()):
+            if not future.done():
+                future.set_result(True)
+
+    async def wait(self, actor_id: uuid.UUID, since_version: int, timeout: float) -> bool:
+        """ returns True if the version of actor_id differs from since_version within timeout seconds """
+        future = self.loop.create_future()
+        self._futures.setdefault(actor_id, set()).add(future)
+        try:
+            # a notify between reading the version and registering the future is seen here
+            if self._notifier.version(actor_id) == since_version:
+                try:
+                    await asyncio.wait_for(future, timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self._notifier.version(actor_id) != since_version
+        finally:
+            futures = self._futures.get(actor_id)
+            if futures is not None:
+                futures.discard(future)
+                if not futures:
+                    del self._futures[actor_id]
+
+    def waiting(self) -> int:
+        return sum(len(futures) for futures in self._futures.values())
+
+    def close(self) -> None:
+        self._notifier.remove_listener(self._on_notify)
+
+
+class AsyncActorApi:
+    """ ASGI app answering getState, setState, actorHealth and stream on the event loop with an aiosqlite engine, all
+    other requests are passed to the flask app (run on a thread pool). Authorization, state and usage logic is shared
+    with app/api/func.py; a long-polling getState or an open stream waits without holding a thread. Usage rows are
+    written behind by the recorder thread of the flask app. The async endpoints are counted in the http metrics, but
+    do not write the access log; in multi-process mode changes of other workers are applied by the periodic sync
+    only """
+
+    def __init__(self, flask_app: Flask):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.engine: AsyncEngine = create_async_engine(async_database_uri(flask_app.config['SQLALCHEMY_DATABASE_URI']),
+                                                       **flask_app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+        apply_sqlite_profile(self.engine.sync_engine, flask_app.config.get('SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS))
+        self._waiters: Optional[ActorWaiters] = None
+        # path -> (method, metrics endpoint name, handler)
+        self.routes: Dict[str, Tuple[str, str, Callable[[dict, bytes, dict], Awaitable[JsonResult]]]] = {
+            '/api/getState': ('GET', 'api.get_door_state', self.get_door_state),
+            '/api/setState': ('POST', 'api.set_door_state', self.set_door_state),
+            '/api/actorHealth': ('GET', 'api.check_actor_health', self.check_actor_health)}
+
+    async def __call__(self, scope: dict, receive, send) -> None:
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] == 'http' and scope['path'] == '/api/stream' and scope['method'] == 'GET':
+            await self.stream(scope, receive, send)
+            return
+        route = self.routes.get(scope['path']) if scope['type'] == 'http' else None
+        if route is None or route[0] != scope['method']:
+            await self.wsgi(scope, receive, send)
+            return
+        _, endpoint, handler = route
+        params = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        body = await read_body(receive) if scope['method'] == 'POST' else b''
+        ts_start = time.perf_counter()
+        HTTP_IN_FLIGHT.inc(endpoint=endpoint)
+        try:
+            with self.flask_app.app_context():
+                status, response = await handler(params, body, headers)
+        except Exception:
+            HTTP_REQUESTS.inc(endpoint=endpoint, method=scope['method'], status=500)
+            raise
+        else:
+            HTTP_REQUESTS.inc(endpoint=endpoint, method=scope['method'], status=status)
+        finally:
+            HTTP_LATENCY.observe(time.perf_counter() - ts_start, endpoint=endpoint, method=scope['method'])
+            HTTP_IN_FLIGHT.dec(endpoint=endpoint)
+        await send_json(send, status, response)
+
+    async def stream(self, scope: dict, receive, send) -> None:
+        endpoint = 'api.stream_door_state'
+        params = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        status = 500
+        HTTP_IN_FLIGHT.inc(endpoint=endpoint)
+        try:
+            with self.flask_app.app_context():
+                status = await self.stream_door_state(params, receive, send)
+        finally:
+            HTTP_REQUESTS.inc(endpoint=endpoint, method='GET', status=status)
+            HTTP_IN_FLIGHT.dec(endpoint=endpoint)
+
+    async def lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def close(self) -> None:
+        """ disposes the async engine and stops the flask app, pending usage rows are written """
+        if self._waiters is not None:
+            self._waiters.close()
+            self._waiters = None
+        await self.engine.dispose()
+        await asyncio.get_running_loop().run_in_executor(None, shutdown_app, self.flask_app)
+
+    def waiters(self) -> ActorWaiters:
+        loop = asyncio.get_running_loop()
+        if self._waiters is None or self._waiters.loop is not loop:
+            if self._waiters is not None:
+                self._waiters.close()
+            self._waiters = ActorWaiters(loop, actor_notifier())
+        return self._waiters
+
+    async def fetch_all(self, query: Select) -> list:
+        async with self.engine.connect() as connection:
+            return (await connection.execute(query)).all()
+
+    async def get_principal(self, api_key: str) -> Optional[Tuple[uuid.UUID, Role]]:
+        key_hash = simple_hash_str(api_key)
+        principal = principal_cache().get(key_hash)
+        if principal is not None:
+            return principal
+        generation = principal_cache().generation
+        return remember_principal(key_hash, [tuple(row) for row in await self.fetch_all(principal_query(key_hash))],
+                                  generation)
+
+    async def get_state(self, actor_id: uuid.UUID, user_id: uuid.UUID) -> Optional[bool]:
+        ts_now = now()
+        row = (await self.fetch_all(authorization_query(user_id, actor_id, Mode.read, ts_now)))[0]
+        return evaluate_get_state(authorization_from_row(row, actor_id, ts_now), user_id, actor_id)
+
+    async def set_state(self, actor_id: uuid.UUID, user_id: uuid.UUID) -> None:
+        ts_now = now()
+        row = (await self.fetch_all(authorization_query(user_id, actor_id, Mode.write, ts_now)))[0]
+        check_set_state_authorization(authorization_from_row(row, actor_id, ts_now), user_id, actor_id)
+        start = now()
+        end = start + SET_STATE_DURATION
+        async with self.engine.begin() as connection:
+            for statement in actor_state_statements(uuid.uuid4(), actor_id, start, end):
+                await connection.execute(statement)
+        register_actor_state(actor_id, start, end)
+        push_actor_state(actor_id, start, end)
+        add_usage(user_id, actor_id, Type.setState)
+        SET_STATE_RESULTS.inc(result='grant')
+
+    async def get_door_state(self, params: dict, body: bytes, headers: dict) -> JsonResult:
+        if params.get('api-key') is None:
+            log(f'key not found')
+            return NO_KEY
+        elif params.get('actor-id') is None:
+            return NO_ACTOR_ID
+        principal = await self.get_principal(params['api-key'])
+        if principal is None:
+            return PERMISSION_ERROR
+        user_id = principal[0]
+        try:
+            wait = wait_from_str_or_none(params.get('wait'))
+            actor_id = uuid.UUID(params['actor-id'])
+            # read the version before evaluating the state, so a set_state in between is not missed
+            version = actor_notifier().version(actor_id)
+            result = await self.get_state(actor_id, user_id)
+            if result is False and wait > 0 and await self.waiters().wait(actor_id, version, wait):
+                result = await self.get_state(actor_id, user_id)
+        except ValueError:
+            return INPUT_ERROR
+        except PermissionError:
+            return PERMISSION_ERROR
+        if result is None:
+            return PERMISSION_ERROR
+        return 200, {'state': result}
+
+    async def set_door_state(self, params: dict, body: bytes, headers: dict) -> JsonResult:
+        data = {}
+        if headers.get('content-type', '').startswith('application/json'):
+            try:
+                data = json.loads(body or b'{}')
+            except ValueError:
+                return INPUT_ERROR
+        if not data:
+            data = dict(parse_qsl(body.decode('utf-8')))
+        if data.get('api-key') is None:
+            log(f'key not found')
+            return NO_KEY
+        elif data.get('actor-id') is None:
+            return NO_ACTOR_ID
+        principal = await self.get_principal(data['api-key'])
+        if principal is None:
+            return PERMISSION_ERROR
+        try:
+            await self.set_state(uuid.UUID(data['actor-id']), principal[0])
+        except ValueError:
+            return INPUT_ERROR
+        except PermissionError:
+            return PERMISSION_ERROR
+        return 200, {'msg': 'success'}
+
+    async def stream_door_state(self, params: dict, receive, send) -> int:
+        """ server-sent events like the flask endpoint, until the client disconnects; returns the status """
+        error = None
+        if params.get('api-key') is None:
+            log(f'key not found')
+            error = NO_KEY
+        elif params.get('actor-id') is None:
+            error = NO_ACTOR_ID
+        else:
+            principal = await self.get_principal(params['api-key'])
+            if principal is None:
+                error = PERMISSION_ERROR
+            else:
+                user_id = principal[0]
+                try:
+                    actor_id = uuid.UUID(params['actor-id'])
+                    version = actor_notifier().version(actor_id)
+                    state = await self.get_state(actor_id, user_id)
+                    if state is None:
+                        error = PERMISSION_ERROR
+                except ValueError:
+                    error = INPUT_ERROR
+                except PermissionError:
+                    error = PERMISSION_ERROR
+        if error is not None:
+            await send_json(send, *error)
+            return error[0]
+
+        keepalive = self.flask_app.config.get('STREAM_KEEPALIVE', 15)
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await send_event(send, sse_event({'state': state}, 'state'))
+            while True:
+                change = asyncio.ensure_future(self.waiters().wait(actor_id, version, keepalive))
+                await asyncio.wait({change, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+                if disconnect.done():
+                    change.cancel()
+                    # lets the waiter unregister
+                    await asyncio.wait({change})
+                    return 200
+                if change.result():
+                    version = actor_notifier().version(actor_id)
+                    try:
+                        state = await self.get_state(actor_id, user_id)
+                    except PermissionError:
+                        state = None
+                    if state is None:
+                        await send_event(send, sse_event({'msg': 'permission error'}, 'error'))
+                        break
+                    await send_event(send, sse_event({'state': state}, 'state'))
+                else:
+                    add_usage(user_id, actor_id, Type.last_getState)
+                    await send_event(send, ': keep-alive\n\n')
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnect.cancel()
+        return 200
+
+    async def check_actor_health(self, params: dict, body: bytes, headers: dict) -> JsonResult:
+        if params.get('api-key') is None:
+            log(f'key not found')
+            return NO_KEY
+        elif params.get('actor-id') is None:
+            return NO_ACTOR_ID
+        elif params.get('timeout') is None:
+            return 403, {'msg': 'no timeout provided'}
+        principal = await self.get_principal(params['api-key'])
+        if principal is None:
+            return PERMISSION_ERROR
+        if principal[1] != Role.maintenance:
+            return 403, {'msg': 'api key is not from maintenance user'}
+        try:
+            actor_id = uuid.UUID(params['actor-id'])
+            timeout = int(params['timeout'])
+            check_health_check_args((await self.fetch_all(role_query(actor_id)))[0][0], timeout)
+            recorder = usage_recorder()
+            if recorder is not None:
+                await asyncio.get_running_loop().run_in_executor(None, recorder.flush)
+            timestamps = [row[0] for row in await self.fetch_all(heartbeat_query(actor_id))]
+            return 200, {'health': evaluate_heartbeats(timestamps, timeout)}
+        except ValueError:
+            return INPUT_ERROR
+        except PermissionError:
+            return PERMISSION_ERROR
+
+
+async def read_body(receive) -> bytes:
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def wait_for_disconnect(receive) -> None:
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def send_event(send, message: str) -> None:
+    await send({'type': 'http.response.body', 'body': message.encode('utf-8'), 'more_body': True})
+
+
+async def send_json(send, status: int, response: dict) -> None:
+    payload = json.dumps(response).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(payload)).encode('latin-1'))]})
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+def create_asgi_app(config_class=Config) -> AsyncActorApi:
+    # the event loop must not write usage rows itself, so the write-behind recorder is always used
+    return AsyncActorApi(create_app(config_class=type('AsgiConfig', (config_class,), {'USAGE_WRITE_BEHIND': True})))
+
+
+def main():
+    print("uvicorn")
+    uvicorn.run(create_asgi_app(config_class=Config), host="127.0.0.1",
+                port=int(os.getenv("SERVICE_PORT")) if os.getenv("SERVICE_PORT") is not None else 5050,
+                lifespan='on', access_log=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import argparse
+import csv
+import datetime
+import enum
+import io
+import json
+import sys
+import uuid
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional
+
+from sqlalchemy import Table, select, tuple_
+from sqlalchemy.sql import Select
+
+from app.api.func import naive_utc
+from app.extensions import db
+from app.models.state import State
+from app.models.state_archive import StateArchive
+from app.models.usage import Usage
+from app.models.usage_archive import usage_archive_tables
+
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+class ExportTable(NamedTuple):
+    # the tables holding the rows, in time order (the usage archive has one table per month)
+    tables: Callable[[], List[Table]]
+    # rows are paginated and filtered by (time column, id)
+    time_column: str
+    columns: List[str]
+
+
+EXPORT_TABLES: Dict[str, ExportTable] = {
+    'usage': ExportTable(lambda: [Usage.__table__], 'timestamp',
+                         ['id', 'user_id', 'actor_id', 'type', 'timestamp', 'created_at', 'updated_at']),
+    'usage_archive': ExportTable(lambda: usage_archive_tables(db.engine), 'timestamp',
+                                 ['id', 'user_id', 'actor_id', 'type', 'timestamp', 'created_at', 'updated_at',
+                                  'archived_at']),
+    'state': ExportTable(lambda: [State.__table__], 'begin',
+                         ['id', 'user_id', 'begin', 'end', 'created_at', 'updated_at']),
+    'state_archive': ExportTable(lambda: [StateArchive.__table__], 'begin',
+                                 ['id', 'user_id', 'begin', 'end', 'created_at', 'updated_at', 'archived_at']),
+}
+
+
+def export_rows(table: str, start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None,
+                page_size: int = 5000) -> Iterator[tuple]:
+    """ yields the rows of table with start <= time column < end in (time column, id) order; every page is a keyset
+    query of page_size rows that is fetched in yield_per chunks, so memory does not grow with the table and no
+    transaction is held open between pages. Rows without a time (open-ended states) come first and only without
+    start; tables split by month are read one after the other """
+    export_table = EXPORT_TABLES[table]
+    id_index = export_table.columns.index('id')
+    time_index = export_table.columns.index(export_table.time_column)
+
+    def pages(query: Select, key_columns: list, key_indexes: List[int]) -> Iterator[tuple]:
+        last_key = None
+        while True:
+            page_query = query if last_key is None else query.where(tuple_(*key_columns) > tuple_(*last_key))
+            result = db.session.execute(page_query.order_by(*key_columns).limit(page_size)
+                                        .execution_options(yield_per=min(page_size, 1000)))
+            row = None
+            rows = 0
+            for row in result:
+                rows += 1
+                yield row
+            db.session.close()
+            if rows < page_size:
+                return
+            last_key = [row[index] for index in key_indexes]
+
+    sql_tables = export_table.tables()
+    if start is None:
+        for sql_table in sql_tables:
+            time_column = sql_table.c[export_table.time_column]
+            if time_column.nullable:
+                yield from pages(select(*[sql_table.c[column] for column in export_table.columns])
+                                 .where(time_column.is_(None)), [sql_table.c.id], [id_index])
+    for sql_table in sql_tables:
+        time_column = sql_table.c[export_table.time_column]
+        query = select(*[sql_table.c[column] for column in export_table.columns]).where(time_column.is_not(None))
+        if start is not None:
+            query = query.where(time_column >= naive_utc(start))
+        if end is not None:
+            query = query.where(time_column < naive_utc(end))
+        yield from pages(query, [time_column, sql_table.c.id], [time_index, id_index])
+
+
+def export_value(value):
+    if isinstance(value, uuid.UUID):
+        return value.hex
+    if isinstance(value, datetime.datetime):
+        return value.replace(tzinfo=datetime.timezone.utc).isoformat()
+    if isinstance(value, enum.Enum):
+        return value.name
+    return value
+
+
+def format_ndjson(columns: List[str], rows: Iterator[tuple]) -> Iterator[str]:
+    for row in rows:
+        yield json.dumps({column: export_value(value) for column, value in zip(columns, row)}) + '\n'
+
+
+def format_csv(columns: List[str], rows: Iterator[tuple], lines_per_chunk: int = 1000) -> Iterator[str]:
+    """ header line first; lines are joined into chunks to keep the number of writes down """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(columns)
+    for i, row in enumerate(rows, start=1):
+        writer.writerow(['' if value is None else export_value(value) for value in row])
+        if i % lines_per_chunk == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export(table: str, output_format: str, start: Optional[datetime.datetime] = None,
+           end: Optional[datetime.datetime] = None, page_size: int = 5000) -> Iterator[str]:
+    """ streams the rows of table as ndjson or csv text chunks """
+    if table not in EXPORT_TABLES:
+        raise ValueError(f'unknown table: {table}')
+    if output_format not in FORMATS:
+        raise ValueError(f'unknown format: {output_format}')
+    rows = export_rows(table, start, end, page_size)
+    formatter = format_ndjson if output_format == 'ndjson' else format_csv
+    return formatter(EXPORT_TABLES[table].columns, rows)
+
+
+def main(argv=None) -> None:
+    """ writes the export to a file (or stdout) straight from the database of the server configuration """
+    parser = argparse.ArgumentParser(description='streams usage or state history as ndjson or csv')
+    parser.add_argument('table', choices=list(EXPORT_TABLES))
+    parser.add_argument('--format', choices=list(FORMATS), default='ndjson')
+    parser.add_argument('--start', type=datetime.datetime.fromisoformat, help='iso timestamp, inclusive')
+    parser.add_argument('--end', type=datetime.datetime.fromisoformat, help='iso timestamp, exclusive')
+    parser.add_argument('--output', help='file to write, default: stdout')
+    parser.add_argument('--page-size', type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    from app.app import create_app, shutdown_app
+    from config import Config
+    config = type('ExportConfig', (Config,), {'USAGE_WRITE_BEHIND': False, 'STATE_RETENTION_INTERVAL': 0,
+                                              'USAGE_RETENTION_INTERVAL': 0})
+    app = create_app(config_class=config)
+    output = open(args.output, 'w', newline='') if args.output is not None else sys.stdout
+    try:
+        with app.app_context():
+            for chunk in export(args.table, args.format, args.start, args.end, args.page_size):
+                output.write(chunk)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        shutdown_app(app)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,35 @@
 import logging
 import uuid
-import datetime
-from typing import Dict
+from typing import Optional, Union
 
 from flask import make_response, request, render_template, redirect, url_for
 
 from app.api.func import get_user_id_from_api_key, check_user_if_valid, set_state, check_password
 from app.api.routes import set_door_state
 from app.main import bp
+from app.util.session_store import SessionStore, DbSessionStore
+from app.util.sql_stats import query_budget
 
 
-SESSIONS = None
+SESSIONS: Optional[Union[SessionStore, DbSessionStore]] = None
 TIMEOUT = 300
 
 
-def sessions() -> Dict[uuid.UUID, datetime.datetime]:
+def sessions() -> Union[SessionStore, DbSessionStore]:
     global SESSIONS
     if SESSIONS is None:
-        SESSIONS = {}
+        SESSIONS = SessionStore(ttl=TIMEOUT)
     return SESSIONS
 
 
-def clean_sessions():
-    return_dict = {}
-    for session_id, timestamp in sessions().items():
-        if (datetime.datetime.now(tz=datetime.timezone.utc) - timestamp) < datetime.timedelta(seconds=TIMEOUT):
-            return_dict[session_id] = timestamp
-    sessions().clear()
-    sessions().update(return_dict)
+def init_session_store(store: Union[SessionStore, DbSessionStore]) -> None:
+    """ replaces the session store, the sessions of the former store are dropped """
+    global SESSIONS
+    SESSIONS = store
 
 
 def register_session(session_id: uuid.UUID) -> None:
-    clean_sessions()
-    if session_id not in sessions().keys():
-        sessions()[session_id] = datetime.datetime.now(tz=datetime.timezone.utc)
+    sessions().add(session_id)
 
 
 def gen_cookie() -> str:
@@ -62,6 +58,7 @@ def login_get():
 
 
 @bp.route('/login', methods=['POST'])
+@query_budget(2)
 def login_post():
     api_key = request.form.get('api-key')
     if api_key is None:
@@ -73,11 +70,15 @@ def login_post():
     if actor_id is None:
         return "no actor id"
     password = request.form.get('password')
-    if not check_password(user_id, password):
+    try:
+        password_ok = check_password(user_id, password)
+    except TimeoutError:
+        return render_template('login.html', msg='server busy, please try again',
+                               **{'api_key': api_key, 'actor_id': actor_id}), 503
+    if not password_ok:
         return render_template('login.html', msg='wrong password', **{'api_key': api_key, 'actor_id': actor_id})
     else:
         cookie = gen_cookie()
-        clean_sessions()
         register_session(uuid.UUID(cookie))
         response = make_response(render_template('open.html', api_url=url_for('api.set_door_state'), **{'api_key': api_key, 'actor_id': actor_id}))
         response.set_cookie('SessionCookie', cookie)
@@ -89,6 +90,7 @@ def error(msg: str):
 
 
 @bp.route('/open', methods=['POST'])
+@query_budget(3)
 def open_post():
     api_key = request.form.get('api-key')
     actor_id = request.form.get('actor-id')
@@ -99,8 +101,8 @@ def open_post():
             cookie = uuid.UUID(cookie)
         except ValueError:
             return render_template('login.html', msg='please login first', **{'api_key': api_key, 'actor_id': actor_id})
-        clean_sessions()
-        if cookie not in sessions():
+        # sliding expiry: every action renews the session
+        if not sessions().touch(cookie):
             return render_template('login.html', msg='please login first', **{'api_key': api_key, 'actor_id': actor_id})
         else:
             user_id = get_user_id_from_api_key(api_key)
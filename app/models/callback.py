@@ -0,0 +1,15 @@
+import uuid
+from sqlalchemy import func
+from app.extensions import db
+
+
+class Callback(db.Model):
+    """ url an actor registered to get its state pushed to, instead of polling """
+
+    id = db.Column(db.Uuid, primary_key=True, default=uuid.uuid4)
+    actor_id = db.Column(db.Uuid, db.ForeignKey('user.id'), nullable=False, unique=True)
+    url = db.Column(db.String(2048), nullable=False)
+    # pushes are signed with it (X-DoorOpener-Signature), the actor gets it when it registers
+    secret = db.Column(db.String(64), nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, server_default=func.now())
+    created_at = db.Column(db.DateTime, nullable=False, server_default=func.now())
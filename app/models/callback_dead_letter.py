@@ -0,0 +1,17 @@
+import uuid
+from sqlalchemy import func
+from app.extensions import db
+
+
+class CallbackDeadLetter(db.Model):
+    """ pushes that could not be delivered """
+    __tablename__ = 'callback_dead_letter'
+    __table_args__ = (db.Index('ix_callback_dead_letter_actor_id_created_at', 'actor_id', 'created_at'),)
+
+    id = db.Column(db.Uuid, primary_key=True, default=uuid.uuid4)
+    actor_id = db.Column(db.Uuid, db.ForeignKey('user.id'), nullable=False)
+    url = db.Column(db.String(2048), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False)
+    error = db.Column(db.String(256), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=func.now())
@@ -0,0 +1,15 @@
+from app.extensions import db
+
+
+class ChangeEvent(db.Model):
+    """ change feed between worker processes (multi-process mode): state changes and cache invalidations """
+    __tablename__ = 'change_event'
+    # workers remember the last applied seq, a seq must never be handed out twice
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    origin = db.Column(db.String(64), nullable=False)
+    kind = db.Column(db.String(32), nullable=False)
+    key = db.Column(db.String(64), nullable=False)
+    # unix time, compared across processes
+    created_at = db.Column(db.Float, nullable=False, index=True)
@@ -4,6 +4,9 @@ from app.extensions import db
 
 
 class State(db.Model):
+    __table_args__ = (db.Index('ix_state_user_id_end', 'user_id', 'end'),
+                      db.Index('ix_state_begin_id', 'begin', 'id'))
+
     id = db.Column(db.Uuid, primary_key=True, default=uuid.uuid4)
     user_id = db.Column(db.Uuid, db.ForeignKey('user.id'), nullable=False)
     begin = db.Column(db.DateTime, nullable=True)
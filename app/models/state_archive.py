@@ -0,0 +1,16 @@
+import uuid
+from sqlalchemy import func
+from app.extensions import db
+
+
+class StateArchive(db.Model):
+    __tablename__ = 'state_archive'
+    __table_args__ = (db.Index('ix_state_archive_begin_id', 'begin', 'id'),)
+
+    id = db.Column(db.Uuid, primary_key=True, default=uuid.uuid4)
+    user_id = db.Column(db.Uuid, db.ForeignKey('user.id'), nullable=False)
+    begin = db.Column(db.DateTime, nullable=True)
+    end = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False, server_default=func.now())
+    created_at = db.Column(db.DateTime, nullable=False, server_default=func.now())
+    archived_at = db.Column(db.DateTime, nullable=False, server_default=func.now())
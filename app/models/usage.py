@@ -14,6 +14,10 @@ class Type(enum.Enum):
 
 
 class Usage(db.Model):
+    __table_args__ = (db.Index('ix_usage_type_user_id_timestamp', 'type', 'user_id', 'timestamp'),
+                      db.Index('ix_usage_type_timestamp', 'type', 'timestamp'),
+                      db.Index('ix_usage_timestamp_id', 'timestamp', 'id'))
+
     id = db.Column(db.Uuid, primary_key=True, default=uuid.uuid4)
     user_id = db.Column(db.Uuid, db.ForeignKey('user.id'), nullable=False)
     actor_id = db.Column(db.Uuid, db.ForeignKey('user.id'), nullable=False)
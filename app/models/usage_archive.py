@@ -0,0 +1,49 @@
+import datetime
+import re
+from typing import List, Optional, Union
+
+from sqlalchemy import Column, DateTime, Enum, Index, MetaData, Table, Uuid, func, inspect
+from sqlalchemy.engine import Connection, Engine
+
+from app.models.usage import Type
+
+# one table per calendar month of the usage timestamp, created by archive_usage on first use and dropped as a whole
+# by the retention; they are not part of db.metadata, so create_all does not touch them
+ARCHIVE_METADATA = MetaData()
+ARCHIVE_TABLE_PATTERN = re.compile(r'usage_archive_(\d{4})(\d{2})')
+
+
+def usage_archive_name(month: datetime.date) -> str:
+    return f'usage_archive_{month.year:04d}{month.month:02d}'
+
+
+def usage_archive_month(name: str) -> Optional[datetime.date]:
+    """ first day of the month of an archive table name, None for other tables """
+    match = ARCHIVE_TABLE_PATTERN.fullmatch(name)
+    if match is None:
+        return None
+    return datetime.date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def usage_archive_table(month: datetime.date) -> Table:
+    """ the archive table of the month of month (the day is ignored) """
+    name = usage_archive_name(month)
+    table = ARCHIVE_METADATA.tables.get(name)
+    if table is None:
+        table = Table(name, ARCHIVE_METADATA,
+                      Column('id', Uuid, primary_key=True),
+                      Column('user_id', Uuid, nullable=False),
+                      Column('actor_id', Uuid, nullable=False),
+                      Column('type', Enum(Type), nullable=False),
+                      Column('timestamp', DateTime, nullable=False),
+                      Column('updated_at', DateTime, nullable=False, server_default=func.now()),
+                      Column('created_at', DateTime, nullable=False, server_default=func.now()),
+                      Column('archived_at', DateTime, nullable=False, server_default=func.now()),
+                      Index(f'ix_{name}_timestamp_id', 'timestamp', 'id'))
+    return table
+
+
+def usage_archive_tables(bind: Union[Engine, Connection]) -> List[Table]:
+    """ the existing archive tables, oldest month first """
+    months = [usage_archive_month(name) for name in inspect(bind).get_table_names()]
+    return [usage_archive_table(month) for month in sorted(month for month in months if month is not None)]
@@ -0,0 +1,22 @@
+import enum
+
+from sqlalchemy import Enum
+
+from app.extensions import db
+from app.models.usage import Type
+
+
+class Period(enum.Enum):
+    hour = 0
+    day = 1
+
+
+class UsageRollup(db.Model):
+    __tablename__ = 'usage_rollup'
+
+    period = db.Column(Enum(Period), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    user_id = db.Column(db.Uuid, db.ForeignKey('user.id'), primary_key=True)
+    actor_id = db.Column(db.Uuid, db.ForeignKey('user.id'), primary_key=True)
+    type = db.Column(Enum(Type), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
@@ -4,6 +4,8 @@ from app.extensions import db
 
 
 class Valid(db.Model):
+    __table_args__ = (db.Index('ix_valid_user_id_end', 'user_id', 'end'),)
+
     id = db.Column(db.Uuid, primary_key=True, default=uuid.uuid4)
     user_id = db.Column(db.Uuid, db.ForeignKey('user.id'), nullable=False)
     start = db.Column(db.DateTime, nullable=True)
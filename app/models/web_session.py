@@ -0,0 +1,12 @@
+import uuid
+
+from app.extensions import db
+
+
+class WebSession(db.Model):
+    """ web UI sessions shared between worker processes (multi-process mode) """
+    __tablename__ = 'web_session'
+
+    id = db.Column(db.Uuid, primary_key=True, default=uuid.uuid4)
+    # unix time, compared across processes
+    expires_at = db.Column(db.Float, nullable=False, index=True)
@@ -0,0 +1,11 @@
+from app.extensions import db
+
+
+class WorkerMetrics(db.Model):
+    """ latest metrics snapshot (json) of each worker process, merged by /api/metrics in multi-process mode """
+    __tablename__ = 'worker_metrics'
+
+    worker = db.Column(db.String(64), primary_key=True)
+    snapshot = db.Column(db.Text, nullable=False)
+    # unix time, compared across processes
+    updated_at = db.Column(db.Float, nullable=False)
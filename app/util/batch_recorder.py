@@ -0,0 +1,94 @@
+import atexit
+import threading
+import traceback
+from typing import Any, Callable, List
+
+from flask import Flask
+
+
+class BatchRecorder:
+    """ write-behind queue: records are collected on the request threads and handed to writer in batches by a
+    background thread, once flush_size records are pending or flush_interval seconds have passed; without start()
+    records are only written by explicit flush() calls or when max_pending is reached """
+
+    def __init__(self, app: Flask, writer: Callable[[List[Any]], None], flush_size: int = 500,
+                 flush_interval: float = 1.0, max_pending: int = 100_000):
+        if flush_size <= 0:
+            raise ValueError("flush_size must be larger than 0")
+        if flush_interval <= 0:
+            raise ValueError("flush_interval must be larger than 0")
+        self.app = app
+        self.writer = writer
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.flushed = 0
+        self.failed_flushes = 0
+        self._pending: List[Any] = []
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._stopping = False
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='BatchRecorder', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def record(self, item: Any) -> None:
+        self.record_many([item])
+
+    def record_many(self, items: List[Any]) -> None:
+        with self._condition:
+            self._pending.extend(items)
+            pending = len(self._pending)
+            if pending >= self.flush_size:
+                self._condition.notify()
+        if pending >= self.max_pending:
+            # backpressure: write on the calling thread
+            self.flush()
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    def flush(self) -> int:
+        """ writes all pending records; returns the number of records written """
+        with self._flush_lock:
+            with self._condition:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                with self.app.app_context():
+                    self.writer(batch)
+            except Exception:
+                traceback.print_exc()
+                self.failed_flushes += 1
+                with self._condition:
+                    # keep the records for the next flush, without growing beyond max_pending
+                    self._pending = (batch + self._pending)[-self.max_pending:]
+                return 0
+            self.flushed += len(batch)
+            return len(batch)
+
+    def stop(self) -> None:
+        """ stops the background thread and drains the queue """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+        atexit.unregister(self.stop)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopping or len(self._pending) >= self.flush_size,
+                                         timeout=self.flush_interval)
+                if self._stopping:
+                    return
+            self.flush()
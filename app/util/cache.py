@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class LRUTTLCache:
+    """ thread-safe, size-bounded LRU cache whose entries expire after a fixed ttl (in seconds). generation counts
+    the invalidations: a value loaded while an invalidation ran may be stale, set(..., generation) drops it """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        if maxsize <= 0:
+            raise ValueError("maxsize must be larger than 0")
+        if ttl <= 0:
+            raise ValueError("ttl must be larger than 0")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None) -> bool:
+        """ with generation (read before the value was loaded), the value is only stored if nothing has been
+        invalidated since; returns whether it has been stored """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self.generation += 1
+            self._data.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Any], bool]) -> None:
+        with self._lock:
+            self.generation += 1
+            for key in [k for k, (_, v) in self._data.items() if predicate(v)]:
+                del self._data[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,42 @@
+import concurrent.futures
+import threading
+from typing import Any, Callable, Optional
+
+
+class BoundedExecutor:
+    """ thread pool with a bounded number of running plus queued tasks; submissions beyond that are rejected
+    immediately with TimeoutError instead of piling up (backpressure) """
+
+    def __init__(self, max_workers: int, max_pending: int, name: str = 'bounded'):
+        if max_workers <= 0:
+            raise ValueError("max_workers must be larger than 0")
+        if max_pending < 0:
+            raise ValueError("max_pending must not be negative")
+        self.max_workers = max_workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self.rejected = 0
+
+    def submit(self, fn: Callable, *args) -> concurrent.futures.Future:
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise TimeoutError('executor saturated')
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def run(self, fn: Callable, *args, timeout: Optional[float] = None) -> Any:
+        """ runs fn(*args) on the pool and waits for the result """
+        future = self.submit(fn, *args)
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError(f'no result within {timeout}s')
+
+    def stop(self) -> None:
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,253 @@
+import math
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from flask import Flask, request, g
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric:
+    """ base class: every thread records into its own shard without locking, shards are summed on collection """
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[dict] = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = {}
+            self._local.shard = shard
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def _label_values(self, labels: Dict[str, object]) -> LabelValues:
+        if set(labels.keys()) != set(self.labelnames):
+            raise ValueError(f'{self.name}: expected labels {self.labelnames}, got {tuple(labels.keys())}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _snapshots(self) -> List[List[Tuple[LabelValues, object]]]:
+        with self._shards_lock:
+            shards = list(self._shards)
+        # list() of the items view does not release the GIL, so it is consistent per shard
+        return [list(shard.items()) for shard in shards]
+
+    def _format_labels(self, label_values: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, label_values))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        escaped = [(k, v.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')) for k, v in pairs]
+        return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+    def totals(self) -> dict:
+        raise NotImplementedError
+
+    def merge(self, totals: dict, snapshot: list) -> None:
+        """ adds a snapshot of another process to totals """
+        raise NotImplementedError
+
+    def snapshot(self) -> list:
+        """ json serializable totals, to be merged by another process """
+        return [[list(key), value] for key, value in self.totals().items()]
+
+    def samples(self, totals: dict) -> List[str]:
+        raise NotImplementedError
+
+    def expose(self, snapshots: Sequence[list] = ()) -> str:
+        totals = self.totals()
+        for snapshot in snapshots:
+            self.merge(totals, snapshot)
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}'] + self.samples(totals)
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        shard = self._shard()
+        key = self._label_values(labels)
+        shard[key] = shard.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        key = self._label_values(labels)
+        return sum(dict(snapshot).get(key, 0.0) for snapshot in self._snapshots())
+
+    def totals(self) -> Dict[LabelValues, float]:
+        totals = {}
+        for snapshot in self._snapshots():
+            for key, value in snapshot:
+                totals[key] = totals.get(key, 0.0) + value
+        return totals
+
+    def merge(self, totals: Dict[LabelValues, float], snapshot: list) -> None:
+        for key, value in snapshot:
+            totals[tuple(key)] = totals.get(tuple(key), 0.0) + value
+
+    def samples(self, totals: Dict[LabelValues, float]) -> List[str]:
+        return [f'{self.name}{self._format_labels(key)} {format_value(value)}' for key, value in sorted(totals.items())]
+
+
+class Gauge(Counter):
+    """ up/down counter, e.g. in-flight requests; inc and dec may happen on different threads """
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        shard = self._shard()
+        key = self._label_values(labels)
+        entry = shard.get(key)
+        if entry is None:
+            # bucket counts (non-cumulative, last one is +Inf), sum, count
+            entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            shard[key] = entry
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def totals(self) -> Dict[LabelValues, list]:
+        totals = {}
+        for snapshot in self._snapshots():
+            for key, (bucket_counts, total, count) in snapshot:
+                if key not in totals:
+                    totals[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                aggregate = totals[key]
+                aggregate[0] = [a + b for a, b in zip(aggregate[0], bucket_counts)]
+                aggregate[1] += total
+                aggregate[2] += count
+        return totals
+
+    def merge(self, totals: Dict[LabelValues, list], snapshot: list) -> None:
+        for key, (bucket_counts, total, count) in snapshot:
+            aggregate = totals.setdefault(tuple(key), [[0] * (len(self.buckets) + 1), 0.0, 0])
+            aggregate[0] = [a + b for a, b in zip(aggregate[0], bucket_counts)]
+            aggregate[1] += total
+            aggregate[2] += count
+
+    def samples(self, totals: Dict[LabelValues, list]) -> List[str]:
+        lines = []
+        for key, (bucket_counts, total, count) in sorted(totals.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(list(self.buckets) + [math.inf], bucket_counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == math.inf else format_value(bound)
+                lines.append(f'{self.name}_bucket{self._format_labels(key, ("le", le))} {cumulative}')
+            lines.append(f'{self.name}_sum{self._format_labels(key)} {format_value(total)}')
+            lines.append(f'{self.name}_count{self._format_labels(key)} {count}')
+        return lines
+
+
+def format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'metric already registered: {metric.name}')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        # noinspection PyTypeChecker
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        # noinspection PyTypeChecker
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        # noinspection PyTypeChecker
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self) -> Dict[str, list]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def expose(self, snapshots: Sequence[Dict[str, list]] = ()) -> str:
+        """ prometheus text exposition format 0.0.4; snapshots of other processes are added to the own values """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.expose([s[metric.name] for s in snapshots if metric.name in s])
+                         for metric in metrics) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUESTS = REGISTRY.counter('http_requests_total', 'HTTP requests by endpoint, method and status.',
+                                 ['endpoint', 'method', 'status'])
+HTTP_LATENCY = REGISTRY.histogram('http_request_duration_seconds', 'HTTP request latency by endpoint.',
+                                  ['endpoint', 'method'])
+HTTP_IN_FLIGHT = REGISTRY.gauge('http_requests_in_flight', 'HTTP requests currently being served.', ['endpoint'])
+SET_STATE_RESULTS = REGISTRY.counter('door_set_state_total', 'setState calls by result (grant, denial).', ['result'])
+GET_STATE_RESULTS = REGISTRY.counter('door_get_state_total', 'getState calls by result (true, false, none, denial).',
+                                     ['result'])
+HEALTH_CHECK_RESULTS = REGISTRY.counter('door_actor_health_check_total', 'Actor health checks by result.',
+                                        ['result'])
+WEBHOOK_RESULTS = REGISTRY.counter('door_webhook_push_total', 'Callback pushes by result (delivered, retry, '
+                                   'dead_letter, dropped).', ['result'])
+
+
+def setup_metrics(app: Flask) -> None:
+    """ registers the request hooks recording per-endpoint counts, latencies and in-flight requests """
+
+    @app.before_request
+    def start_metrics():
+        g.metrics_start = time.perf_counter()
+        g.metrics_endpoint = str(request.endpoint)
+        HTTP_IN_FLIGHT.inc(endpoint=g.metrics_endpoint)
+
+    @app.after_request
+    def record_metrics(response):
+        if 'metrics_start' in g:
+            HTTP_REQUESTS.inc(endpoint=g.metrics_endpoint, method=request.method, status=response.status_code)
+            HTTP_LATENCY.observe(time.perf_counter() - g.metrics_start, endpoint=g.metrics_endpoint,
+                                 method=request.method)
+            g.metrics_recorded = True
+        return response
+
+    @app.teardown_request
+    def finish_metrics(exc):
+        if 'metrics_start' in g:
+            if exc is not None and not g.get('metrics_recorded', False):
+                HTTP_REQUESTS.inc(endpoint=g.metrics_endpoint, method=request.method, status=500)
+                HTTP_LATENCY.observe(time.perf_counter() - g.metrics_start, endpoint=g.metrics_endpoint,
+                                     method=request.method)
+            HTTP_IN_FLIGHT.dec(endpoint=g.metrics_endpoint)
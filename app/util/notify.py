@@ -0,0 +1,78 @@
+import threading
+import uuid
+from typing import Callable, Dict, Iterable, List
+
+
+class ActorNotifier:
+    """ in-process change notification per actor, used to wake up long-polling requests """
+
+    def __init__(self):
+        self._versions: Dict[uuid.UUID, int] = {}
+        self._condition = threading.Condition()
+        self._listeners: List[Callable[[uuid.UUID], None]] = []
+
+    def version(self, actor_id: uuid.UUID) -> int:
+        with self._condition:
+            return self._versions.get(actor_id, 0)
+
+    def versions(self, actor_ids: Iterable[uuid.UUID]) -> Dict[uuid.UUID, int]:
+        with self._condition:
+            return {actor_id: self._versions.get(actor_id, 0) for actor_id in actor_ids}
+
+    def notify(self, actor_id: uuid.UUID) -> None:
+        with self._condition:
+            self._versions[actor_id] = self._versions.get(actor_id, 0) + 1
+            self._condition.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(actor_id)
+
+    def add_listener(self, listener: Callable[[uuid.UUID], None]) -> None:
+        """ listener(actor_id) is called on the notifying thread after every notify, e.g. to wake up asyncio
+        waiters; it must not block """
+        with self._condition:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[uuid.UUID], None]) -> None:
+        with self._condition:
+            self._listeners.remove(listener)
+
+    def wait(self, actor_id: uuid.UUID, since_version: int, timeout: float) -> bool:
+        """ blocks until the version of actor_id differs from since_version or the timeout expires;
+        returns True if a change has been observed """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._versions.get(actor_id, 0) != since_version,
+                                            timeout=timeout)
+
+    def wait_any(self, since_versions: Dict[uuid.UUID, int], timeout: float) -> bool:
+        """ like wait, for several actors: returns True as soon as any of them has changed """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: any(self._versions.get(actor_id, 0) != version
+                            for actor_id, version in since_versions.items()), timeout=timeout)
+
+
+class WaitSlots:
+    """ bounds the number of requests that hold a server thread while they wait for a change (long-polls), so that
+    waiting actors cannot take all threads of a threaded server """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        """ False if all slots are taken, the request has to answer right away then """
+        with self._lock:
+            if self._waiting >= self.limit:
+                return False
+            self._waiting += 1
+            return True
+
+    def release(self) -> None:
+        with self._lock:
+            self._waiting -= 1
+
+    def waiting(self) -> int:
+        with self._lock:
+            return self._waiting
@@ -0,0 +1,45 @@
+import threading
+import traceback
+from typing import Any, Callable, Optional
+
+from flask import Flask
+
+
+class PeriodicJob:
+    """ runs fn inside an app context every interval seconds on a background thread """
+
+    def __init__(self, app: Flask, fn: Callable[[], Any], interval: float, name: Optional[str] = None):
+        if interval <= 0:
+            raise ValueError("interval must be larger than 0")
+        self.app = app
+        self.fn = fn
+        self.interval = interval
+        self.name = name if name is not None else fn.__name__
+        self.runs = 0
+        self.last_result = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def run_once(self) -> Any:
+        with self.app.app_context():
+            self.last_result = self.fn()
+        self.runs += 1
+        return self.last_result
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,90 @@
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from typing import Callable, Dict, Optional, Tuple
+
+import waitress
+from flask import Flask
+
+# a worker that exits faster than this after its start is restarted with a delay, to avoid a fork loop
+MIN_WORKER_LIFETIME = 1.0
+
+
+def run_worker(sock: socket.socket, app_factory: Callable[[int], Flask], index: int,
+               shutdown: Optional[Callable[[Flask], None]], **waitress_kwargs) -> None:
+    """ runs one waitress server on the inherited listening socket; SIGTERM stops it after the app has been shut
+    down (pending usage rows are written) """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    app = app_factory(index)
+    try:
+        waitress.create_server(app, sockets=[sock], **waitress_kwargs).run()
+    finally:
+        if shutdown is not None:
+            shutdown(app)
+
+
+def serve_prefork(app_factory: Callable[[int], Flask], host: str, port: int, workers: int,
+                  shutdown: Optional[Callable[[Flask], None]] = None, **waitress_kwargs) -> None:
+    """ binds host:port once and forks workers that accept on the shared socket, each running its own app; dead
+    workers are restarted with the same index, SIGTERM/SIGINT stop all workers. The app is created after the fork
+    by app_factory(index of the worker, 0 to workers - 1), so every worker has its own database connections and
+    background threads """
+    if workers <= 0:
+        raise ValueError("workers must be larger than 0")
+    sock = socket.create_server((host, port))
+    sock.setblocking(False)
+    # pid -> (index, start time)
+    children: Dict[int, Tuple[int, float]] = {}
+    stopping = False
+
+    def spawn(index: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                run_worker(sock, app_factory, index, shutdown, **waitress_kwargs)
+            except SystemExit:
+                pass
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        children[pid] = (index, time.monotonic())
+        print(f'worker {pid} started')
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for index in range(workers):
+        spawn(index)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        child = children.pop(pid, None)
+        if child is None or stopping:
+            continue
+        index, started = child
+        print(f'worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting')
+        if time.monotonic() - started < MIN_WORKER_LIFETIME:
+            time.sleep(MIN_WORKER_LIFETIME)
+        if not stopping:
+            spawn(index)
+    sock.close()
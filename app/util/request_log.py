@@ -0,0 +1,111 @@
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import time
+from typing import Dict, Optional
+
+from flask import Flask, request, g
+
+from app.util.util import simple_hash_str
+
+REDACTED_ARGS = ('api-key', 'password')
+
+_ROOT_HANDLER: Optional[logging.Handler] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """ one json object per line, fields passed via extra={'fields': {...}} are merged in """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'), 'level': record.levelname,
+                 'logger': record.name, 'msg': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ never blocks the request thread: records are dropped (and counted) if the queue is full """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class ClosingQueueListener(logging.handlers.QueueListener):
+    """ stop() drains the queue, closes the target handlers and may be called more than once """
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        super().stop()
+        for handler in self.handlers:
+            handler.close()
+
+
+def redact_args(args: Dict[str, str]) -> Dict[str, str]:
+    return {k: ('<redacted>' if k in REDACTED_ARGS else v) for k, v in args.items()}
+
+
+def setup_request_logging(app: Flask) -> ClosingQueueListener:
+    """ routes the root logger through a queue to a size-rotated json log file written by a listener thread and
+    registers the access log hooks; returns the started listener """
+    global _ROOT_HANDLER
+    file_handler = logging.handlers.RotatingFileHandler(app.config.get('REQUEST_LOG_FILE', 'app.log'),
+                                                        maxBytes=app.config.get('REQUEST_LOG_MAX_BYTES', 10 << 20),
+                                                        backupCount=app.config.get('REQUEST_LOG_BACKUP_COUNT', 5),
+                                                        encoding='utf-8', delay=True)
+    file_handler.setFormatter(JsonFormatter())
+    log_queue = queue.Queue(maxsize=app.config.get('REQUEST_LOG_QUEUE_SIZE', 10_000))
+    queue_handler = DroppingQueueHandler(log_queue)
+    listener = ClosingQueueListener(log_queue, file_handler)
+    listener.start()
+
+    root_logger = logging.getLogger()
+    if _ROOT_HANDLER is not None:
+        root_logger.removeHandler(_ROOT_HANDLER)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(logging.INFO)
+    _ROOT_HANDLER = queue_handler
+    app.extensions['request_log_handler'] = queue_handler
+
+    access_logger = logging.getLogger('doorOpener.access')
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_response_status(response):
+        g.response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def log_the_request(exc):
+        # after_request does not run for views that raised, these are logged as 500
+        status = 500 if exc is not None else g.get('response_status')
+        rate = app.config.get('REQUEST_LOG_SAMPLING', {}).get(request.endpoint, 1.0)
+        if exc is not None or rate >= 1.0 or random.random() < rate:
+            session_cookie = request.cookies.get('SessionCookie')
+            sql_stats = g.get('sql_stats')
+            access_logger.info('request', extra={'fields': {
+                'method': request.method, 'path': request.path, 'endpoint': request.endpoint,
+                'args': redact_args(request.args.to_dict()), 'status': status,
+                'duration_ms': round((time.perf_counter() - g.get('request_start', time.perf_counter())) * 1000, 3),
+                'access_route': list(request.access_route),
+                'session': simple_hash_str(session_cookie)[:16] if session_cookie is not None else None,
+                'user_agent': request.headers.get('User-Agent'), 'sample_rate': rate,
+                'sql_statements': sql_stats.statements if sql_stats is not None else None,
+                'sql_ms': round(sql_stats.duration * 1000, 3) if sql_stats is not None else None,
+                'error': repr(exc)[:256] if exc is not None else None}})
+
+    return listener
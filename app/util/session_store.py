@@ -0,0 +1,160 @@
+import heapq
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Hashable, List, Tuple
+
+from flask import Flask
+from sqlalchemy import select, update, delete, func
+
+from app.extensions import db
+from app.models.web_session import WebSession
+
+
+class SessionStore:
+    """ thread-safe, size-bounded session store with sliding expiry (ttl in seconds); expired sessions are dropped
+    lazily from a heap ordered by expiry, so register/lookup cost O(log n) instead of a scan over all sessions """
+
+    def __init__(self, ttl: float = 300.0, maxsize: int = 100_000, clock: Callable[[], float] = time.monotonic):
+        if ttl <= 0:
+            raise ValueError("ttl must be larger than 0")
+        if maxsize <= 0:
+            raise ValueError("maxsize must be larger than 0")
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.expired = 0
+        self.evictions = 0
+        self._clock = clock
+        self._expiry: Dict[Hashable, float] = {}
+        # (expires_at, session_id); entries whose expires_at no longer matches _expiry are stale
+        self._heap: List[Tuple[float, Hashable]] = []
+        self._lock = threading.Lock()
+
+    def _expire(self, ts: float) -> None:
+        while self._heap and self._heap[0][0] <= ts:
+            expires_at, session_id = heapq.heappop(self._heap)
+            if self._expiry.get(session_id) == expires_at:
+                del self._expiry[session_id]
+                self.expired += 1
+
+    def _push(self, session_id: Hashable, expires_at: float) -> None:
+        self._expiry[session_id] = expires_at
+        heapq.heappush(self._heap, (expires_at, session_id))
+        if len(self._heap) > 2 * len(self._expiry) + 64:
+            # too many stale entries from renewals: rebuild the heap from the live sessions
+            self._heap = [(e, s) for s, e in self._expiry.items()]
+            heapq.heapify(self._heap)
+
+    def add(self, session_id: Hashable) -> None:
+        """ registers (or renews) a session; the session closest to expiry is evicted if maxsize is exceeded """
+        with self._lock:
+            ts = self._clock()
+            self._expire(ts)
+            self._push(session_id, ts + self.ttl)
+            while len(self._expiry) > self.maxsize:
+                expires_at, evicted_id = heapq.heappop(self._heap)
+                if self._expiry.get(evicted_id) == expires_at:
+                    del self._expiry[evicted_id]
+                    self.evictions += 1
+
+    def touch(self, session_id: Hashable) -> bool:
+        """ returns True and extends the session by ttl if it exists and has not expired """
+        with self._lock:
+            ts = self._clock()
+            self._expire(ts)
+            if session_id not in self._expiry:
+                return False
+            self._push(session_id, ts + self.ttl)
+            return True
+
+    def discard(self, session_id: Hashable) -> None:
+        with self._lock:
+            # the heap entry becomes stale and is skipped later
+            self._expiry.pop(session_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._expiry.clear()
+            self._heap.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'size': len(self._expiry), 'maxsize': self.maxsize, 'heap': len(self._heap),
+                    'expired': self.expired, 'evictions': self.evictions}
+
+    def __contains__(self, session_id: Hashable) -> bool:
+        with self._lock:
+            expires_at = self._expiry.get(session_id)
+            return expires_at is not None and expires_at > self._clock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._expire(self._clock())
+            return len(self._expiry)
+
+
+class DbSessionStore:
+    """ SessionStore counterpart for the multi-process mode: sessions live in the web_session table so that every
+    worker sees them; expired rows are ignored and removed by trim(), which also enforces maxsize """
+
+    def __init__(self, app: Flask, ttl: float = 300.0, maxsize: int = 100_000):
+        if ttl <= 0:
+            raise ValueError("ttl must be larger than 0")
+        if maxsize <= 0:
+            raise ValueError("maxsize must be larger than 0")
+        self.app = app
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.expired = 0
+        self.evictions = 0
+
+    def add(self, session_id: uuid.UUID) -> None:
+        with self.app.app_context():
+            db.session.merge(WebSession(id=session_id, expires_at=time.time() + self.ttl))
+            db.session.commit()
+
+    def touch(self, session_id: uuid.UUID) -> bool:
+        ts = time.time()
+        with self.app.app_context():
+            result = db.session.execute(update(WebSession)
+                                        .where(WebSession.id == session_id, WebSession.expires_at > ts)
+                                        .values(expires_at=ts + self.ttl))
+            db.session.commit()
+        return result.rowcount == 1
+
+    def discard(self, session_id: uuid.UUID) -> None:
+        with self.app.app_context():
+            db.session.execute(delete(WebSession).where(WebSession.id == session_id))
+            db.session.commit()
+
+    def trim(self) -> int:
+        """ deletes expired sessions and the sessions closest to expiry beyond maxsize; returns the deleted rows """
+        with self.app.app_context():
+            expired = db.session.execute(delete(WebSession).where(WebSession.expires_at <= time.time())).rowcount
+            surplus = db.session.execute(select(func.count()).select_from(WebSession)).scalar_one() - self.maxsize
+            evicted = 0
+            if surplus > 0:
+                oldest = select(WebSession.id).order_by(WebSession.expires_at).limit(surplus)
+                evicted = db.session.execute(delete(WebSession).where(WebSession.id.in_(oldest))).rowcount
+            db.session.commit()
+        self.expired += expired
+        self.evictions += evicted
+        return expired + evicted
+
+    def clear(self) -> None:
+        with self.app.app_context():
+            db.session.execute(delete(WebSession))
+            db.session.commit()
+
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self), 'maxsize': self.maxsize, 'expired': self.expired, 'evictions': self.evictions}
+
+    def __contains__(self, session_id: uuid.UUID) -> bool:
+        query = select(WebSession.id).where(WebSession.id == session_id, WebSession.expires_at > time.time())
+        with self.app.app_context():
+            return db.session.execute(query).first() is not None
+
+    def __len__(self) -> int:
+        with self.app.app_context():
+            return db.session.execute(select(func.count()).select_from(WebSession)
+                                      .where(WebSession.expires_at > time.time())).scalar_one()
@@ -0,0 +1,84 @@
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+from flask import Flask, g, request, current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SQL_STATS_HEADER = 'X-SQL-Stats'
+
+_local = threading.local()
+
+
+class SqlStats:
+    """ statements and database time of the current request (collected on the request thread only) """
+
+    def __init__(self):
+        self.statements = 0
+        self.duration = 0.0
+
+    def header_value(self) -> str:
+        return f'statements={self.statements}; time_ms={self.duration * 1000:.3f}'
+
+
+def current_sql_stats() -> Optional[SqlStats]:
+    return getattr(_local, 'stats', None)
+
+
+def query_budget(statements: int) -> Callable:
+    """ declares the maximum number of SQL statements a view may execute per request """
+
+    def decorator(view: Callable) -> Callable:
+        view.query_budget = statements
+        return view
+
+    return decorator
+
+
+def get_query_budget(endpoint: Optional[str]) -> Optional[int]:
+    view = current_app.view_functions.get(endpoint) if endpoint is not None else None
+    return getattr(view, 'query_budget', None)
+
+
+def instrument_engine(engine: Engine) -> None:
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_sql_stats() is not None:
+            conn.info.setdefault('sql_stats_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = current_sql_stats()
+        if stats is not None and conn.info.get('sql_stats_start'):
+            stats.statements += 1
+            stats.duration += time.perf_counter() - conn.info['sql_stats_start'].pop()
+
+
+def setup_sql_instrumentation(app: Flask, engine: Engine) -> None:
+    """ counts statements and database time per request; the numbers are stored in g.sql_stats for the access log
+    and sent in the X-SQL-Stats response header if SQL_DEBUG_HEADER is set. Requests exceeding the query budget
+    declared on their view are logged as warning """
+    instrument_engine(engine)
+
+    @app.before_request
+    def start_sql_stats():
+        _local.stats = SqlStats()
+
+    @app.after_request
+    def finish_sql_stats(response):
+        stats = current_sql_stats()
+        if stats is not None:
+            g.sql_stats = stats
+            if app.config.get('SQL_DEBUG_HEADER', False):
+                response.headers[SQL_STATS_HEADER] = stats.header_value()
+            budget = get_query_budget(request.endpoint)
+            if budget is not None and stats.statements > budget:
+                logging.getLogger('doorOpener.sql').warning(
+                    f'{request.endpoint} executed {stats.statements} statements, budget is {budget}')
+        return response
+
+    @app.teardown_request
+    def clear_sql_stats(exc):
+        _local.stats = None
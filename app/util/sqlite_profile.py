@@ -0,0 +1,49 @@
+import re
+from typing import Dict, Union
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PragmaValue = Union[int, str]
+
+# WAL lets readers (getState polls) proceed while a writer commits; synchronous=NORMAL is durable in WAL mode
+# except for the last transactions on power loss
+DEFAULT_SQLITE_PRAGMAS: Dict[str, PragmaValue] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -20_000,
+    'mmap_size': 256 << 20,
+    'temp_store': 'MEMORY',
+}
+
+SUPPORTED_PRAGMAS = ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size', 'mmap_size', 'temp_store',
+                     'wal_autocheckpoint', 'foreign_keys')
+
+
+def pragma_statements(pragmas: Dict[str, PragmaValue]) -> list:
+    """ validates the profile (pragma values cannot be bound as parameters) and returns the PRAGMA statements """
+    statements = []
+    for name, value in pragmas.items():
+        if name not in SUPPORTED_PRAGMAS:
+            raise ValueError(f'unsupported sqlite pragma: {name}')
+        if not isinstance(value, int) and not re.fullmatch(r'-?\w+', str(value)):
+            raise ValueError(f'invalid value for sqlite pragma {name}: {value}')
+        statements.append(f'PRAGMA {name}={value}')
+    return statements
+
+
+def apply_sqlite_profile(engine: Engine, pragmas: Dict[str, PragmaValue]) -> None:
+    """ sets the pragmas on every new connection of engine; has no effect on other databases than sqlite """
+    if engine.dialect.name != 'sqlite':
+        return
+    statements = pragma_statements(pragmas)
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
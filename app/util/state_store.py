@@ -0,0 +1,73 @@
+import datetime
+import threading
+import uuid
+from typing import Dict, Iterable, List, Optional, Tuple
+
+TS_MIN = datetime.datetime(1, 1, 1, 0, 0, 0, 0, tzinfo=datetime.timezone.utc)
+TS_MAX = datetime.datetime(9999, 12, 31, 0, 0, 0, 0, tzinfo=datetime.timezone.utc)
+
+Interval = Tuple[datetime.datetime, datetime.datetime]
+
+
+def as_utc(ts: Optional[datetime.datetime], default: datetime.datetime) -> datetime.datetime:
+    if ts is None:
+        return default
+    if ts.tzinfo is None:
+        return ts.replace(tzinfo=datetime.timezone.utc)
+    return ts.astimezone(datetime.timezone.utc)
+
+
+class ActorStateStore:
+    """ thread-safe in-memory store of the state intervals of each actor (per process); same semantics as
+    eval_ts_list: None begin/end are open-ended, intervals with end <= begin never match """
+
+    def __init__(self):
+        self._intervals: Dict[uuid.UUID, List[Interval]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, actor_id: uuid.UUID, begin: Optional[datetime.datetime], end: Optional[datetime.datetime],
+            prune_before: Optional[datetime.datetime] = None) -> None:
+        """ adds an interval; intervals of the actor that ended before prune_before are dropped """
+        interval = (as_utc(begin, TS_MIN), as_utc(end, TS_MAX))
+        with self._lock:
+            intervals = self._intervals.get(actor_id, [])
+            if prune_before is not None:
+                prune_before = as_utc(prune_before, TS_MIN)
+                intervals = [i for i in intervals if i[1] >= prune_before]
+            if interval[1] > interval[0]:
+                intervals.append(interval)
+            self._intervals[actor_id] = intervals
+
+    def is_active(self, actor_id: uuid.UUID, ts: datetime.datetime) -> bool:
+        ts = as_utc(ts, TS_MIN)
+        with self._lock:
+            return any(begin <= ts <= end for begin, end in self._intervals.get(actor_id, []))
+
+    def active_map(self, actor_ids: Iterable[uuid.UUID], ts: datetime.datetime) -> Dict[uuid.UUID, bool]:
+        """ is_active for several actors under one lock acquisition """
+        ts = as_utc(ts, TS_MIN)
+        with self._lock:
+            return {actor_id: any(begin <= ts <= end for begin, end in self._intervals.get(actor_id, []))
+                    for actor_id in actor_ids}
+
+    def prune(self, before: datetime.datetime) -> int:
+        """ drops all intervals that ended before the given timestamp; returns the number of dropped intervals """
+        before = as_utc(before, TS_MIN)
+        pruned = 0
+        with self._lock:
+            for actor_id in list(self._intervals.keys()):
+                intervals = [i for i in self._intervals[actor_id] if i[1] >= before]
+                pruned += len(self._intervals[actor_id]) - len(intervals)
+                if intervals:
+                    self._intervals[actor_id] = intervals
+                else:
+                    del self._intervals[actor_id]
+        return pruned
+
+    def clear(self) -> None:
+        with self._lock:
+            self._intervals.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(intervals) for intervals in self._intervals.values())
@@ -1,10 +1,31 @@
 import datetime
+import hmac
 import secrets
-from functools import cache
 from hashlib import sha256
+from typing import Optional
 
 from bcrypt import hashpw, gensalt, checkpw
 
+from app.util.cache import LRUTTLCache
+
+# results of check_pw_str, keyed by an HMAC of password and hash under a per-process random key, so that no
+# plaintext password is kept in memory
+VERIFICATION_CACHE: Optional[LRUTTLCache] = None
+_VERIFICATION_CACHE_KEY = secrets.token_bytes(32)
+
+
+def verification_cache() -> LRUTTLCache:
+    global VERIFICATION_CACHE
+    if VERIFICATION_CACHE is None:
+        VERIFICATION_CACHE = LRUTTLCache(maxsize=1024, ttl=300)
+    return VERIFICATION_CACHE
+
+
+def init_verification_cache(maxsize: int, ttl: float) -> None:
+    """ (re-)creates the password verification cache, dropping all cached results """
+    global VERIFICATION_CACHE
+    VERIFICATION_CACHE = LRUTTLCache(maxsize=maxsize, ttl=ttl)
+
 
 def simple_hash(pw: bytes) -> bytes:
     return sha256(pw).digest()
@@ -18,7 +39,6 @@ def hash_salt_pw(pw: bytes) -> bytes:
     return hashpw(pw, gensalt())
 
 
-@cache
 def hash_salt_pw_str(pw: str) -> str:
     return hashpw(pw.encode('utf-8'), gensalt()).decode('utf-8')
 
@@ -27,9 +47,23 @@ def check_pw(pw: bytes, hashed_pw: bytes) -> bool:
     return checkpw(pw, hashed_pw)
 
 
-@cache
+def verification_cache_key(pw: str, hashed_pw: str) -> str:
+    return hmac.new(_VERIFICATION_CACHE_KEY, hashed_pw.encode('utf-8') + b'\0' + pw.encode('utf-8'),
+                    sha256).hexdigest()
+
+
+def cached_check_pw_str(pw: str, hashed_pw: str) -> Optional[bool]:
+    """ the cached result of check_pw_str, None if bcrypt has to run """
+    return verification_cache().get(verification_cache_key(pw, hashed_pw))
+
+
 def check_pw_str(pw: str, hashed_pw: str) -> bool:
-    return checkpw(pw.encode('utf-8'), hashed_pw.encode('utf-8'))
+    key = verification_cache_key(pw, hashed_pw)
+    result = verification_cache().get(key)
+    if result is None:
+        result = checkpw(pw.encode('utf-8'), hashed_pw.encode('utf-8'))
+        verification_cache().set(key, result)
+    return result
 
 
 def generate_api_key():
@@ -0,0 +1,315 @@
+import atexit
+import collections
+import hashlib
+import heapq
+import hmac
+import ipaddress
+import itertools
+import json
+import random
+import socket
+import threading
+import time
+import traceback
+from typing import Any, Callable, Collection, Deque, Dict, FrozenSet, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from flask import Flask
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from app.util.metrics import WEBHOOK_RESULTS
+
+SIGNATURE_HEADER = 'X-DoorOpener-Signature'
+# besides 5xx
+RETRY_STATUS = {408, 429}
+
+
+def sign(secret: str, body: bytes) -> str:
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def target_error(url: str, allowed_hosts: Collection[str] = ()) -> Optional[str]:
+    """ None if pushes may go to url: http(s) and a host that is in allowed_hosts or resolves to public addresses
+    only, so that callbacks cannot reach loopback, private, link-local or otherwise internal hosts; the reason
+    otherwise """
+    url_parts = urlsplit(url)
+    if url_parts.scheme not in ('http', 'https') or not url_parts.hostname:
+        return 'not an http(s) url'
+    if url_parts.hostname in allowed_hosts:
+        return None
+    try:
+        port = url_parts.port or (443 if url_parts.scheme == 'https' else 80)
+        addresses = {info[4][0] for info in socket.getaddrinfo(url_parts.hostname, port, proto=socket.IPPROTO_TCP)}
+    except (OSError, ValueError) as e:
+        return f'unresolvable host: {e}'[:256]
+    for address in addresses:
+        if not is_public_address(address):
+            return f'non-public address: {address}'
+    return None
+
+
+def is_public_address(address: str) -> bool:
+    # scoped ipv6 addresses carry the interface after a %
+    ip_address = ipaddress.ip_address(address.split('%')[0])
+    if isinstance(ip_address, ipaddress.IPv6Address) and ip_address.ipv4_mapped is not None:
+        ip_address = ip_address.ipv4_mapped
+    return ip_address.is_global
+
+
+class ForbiddenTarget(Exception):
+    """ a push connected to a non-public address """
+
+
+class PublicAddressConnection:
+    """ mixin for urllib3 connections: checks the address a new connection has actually been made to, so that a host
+    whose dns answer changes after target_error (dns rebinding) cannot reach an internal address """
+    allowed_hosts: FrozenSet[str] = frozenset()
+
+    def _new_conn(self) -> socket.socket:
+        sock = super()._new_conn()
+        address = sock.getpeername()[0]
+        if self.host not in self.allowed_hosts and not is_public_address(address):
+            sock.close()
+            raise ForbiddenTarget(f'non-public address: {address}')
+        return sock
+
+
+class PublicAddressAdapter(HTTPAdapter):
+    """ HTTPAdapter whose connections only go to public addresses or to hosts in allowed_hosts """
+
+    def __init__(self, allowed_hosts: Collection[str] = (), **kwargs):
+        # init_poolmanager is called by HTTPAdapter.__init__
+        self.allowed_hosts = frozenset(allowed_hosts)
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        attributes = {'allowed_hosts': self.allowed_hosts}
+        http_connection = type('PublicHTTPConnection', (PublicAddressConnection, HTTPConnection), attributes)
+        https_connection = type('PublicHTTPSConnection', (PublicAddressConnection, HTTPSConnection), attributes)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': type('PublicHTTPConnectionPool', (HTTPConnectionPool,), {'ConnectionCls': http_connection}),
+            'https': type('PublicHTTPSConnectionPool', (HTTPSConnectionPool,), {'ConnectionCls': https_connection})}
+
+
+class WebhookJob:
+    __slots__ = ('key', 'payload', 'expires', 'url', 'secret', 'attempts', 'error')
+
+    def __init__(self, key: Any, payload: dict, expires: Optional[float]):
+        self.key = key
+        self.payload = payload
+        # unix time after which the push is useless and not retried anymore
+        self.expires = expires
+        self.url: Optional[str] = None
+        self.secret: Optional[str] = None
+        self.attempts = 0
+        self.error: Optional[str] = None
+
+    @property
+    def target(self) -> str:
+        return urlsplit(self.url).netloc
+
+
+class WebhookDispatcher:
+    """ pushes payloads to the callback registered for a key, resolve(key) -> (url, secret) or None, from a pool of
+    background threads sharing one keep-alive connection pool. At most max_per_target pushes run against one host at
+    a time; failed pushes are retried with exponential backoff (5xx, 408, 429 and connection errors) up to
+    max_attempts times unless they have expired, the ones given up are handed to dead_letter. resolve and dead_letter
+    run inside an app context. Every push checks its target again (see target_error, hosts in allowed_hosts are
+    exempt), as its address may have changed since the registration, and the address every new connection has been
+    made to; redirects are not followed and no proxy is used """
+
+    def __init__(self, app: Flask, resolve: Callable[[Any], Optional[Tuple[str, str]]],
+                 dead_letter: Callable[[List[WebhookJob]], None], workers: int = 4, max_per_target: int = 2,
+                 max_attempts: int = 5, retry_base: float = 1.0, timeout: float = 5.0, max_pending: int = 10_000,
+                 allowed_hosts: Collection[str] = ()):
+        if workers <= 0:
+            raise ValueError("workers must be larger than 0")
+        if max_per_target <= 0:
+            raise ValueError("max_per_target must be larger than 0")
+        if max_attempts <= 0:
+            raise ValueError("max_attempts must be larger than 0")
+        self.app = app
+        self.resolve = resolve
+        self.dead_letter = dead_letter
+        self.workers = workers
+        self.max_per_target = max_per_target
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.allowed_hosts = set(allowed_hosts)
+        self.session = requests.Session()
+        # a proxy would be the peer of every connection
+        self.session.trust_env = False
+        adapter = PublicAddressAdapter(self.allowed_hosts, pool_connections=64, pool_maxsize=workers, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.delivered = 0
+        self.retried = 0
+        self.dead_lettered = 0
+        self.dropped = 0
+        self._ready: Deque[WebhookJob] = collections.deque()
+        self._delayed: List[Tuple[float, int, WebhookJob]] = []
+        self._sequence = itertools.count()
+        self._in_flight: Dict[str, int] = {}
+        self._dead: List[WebhookJob] = []
+        self._condition = threading.Condition()
+        self._dead_letter_lock = threading.Lock()
+        self._stopping = False
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        self._threads = [threading.Thread(target=self._run, name=f'WebhookDispatcher-{i}', daemon=True)
+                         for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+        atexit.register(self.stop)
+
+    def push(self, key: Any, payload: dict, expires: Optional[float] = None) -> bool:
+        """ queues a push, False if it has been dropped because the queue is full """
+        with self._condition:
+            if self._stopping or len(self._ready) + len(self._delayed) >= self.max_pending:
+                self.dropped += 1
+                WEBHOOK_RESULTS.inc(result='dropped')
+                return False
+            self._ready.append(WebhookJob(key, payload, expires))
+            self._condition.notify()
+        return True
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._ready) + len(self._delayed) + sum(self._in_flight.values())
+
+    def stop(self) -> None:
+        """ stops the threads after their current push; queued pushes are dropped, dead letters are written """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        with self._condition:
+            self.dropped += len(self._ready) + len(self._delayed)
+            self._ready.clear()
+            self._delayed.clear()
+        self._write_dead_letters()
+        self.session.close()
+        atexit.unregister(self.stop)
+
+    def _take(self) -> Optional[WebhookJob]:
+        """ waits for a job that is due and whose target has a free slot (unresolved jobs have no target yet) and
+        claims the slot; None when stopping """
+        with self._condition:
+            while not self._stopping:
+                ts_now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= ts_now:
+                    self._ready.append(heapq.heappop(self._delayed)[2])
+                for i, job in enumerate(self._ready):
+                    if job.url is None:
+                        del self._ready[i]
+                        return job
+                    if self._in_flight.get(job.target, 0) < self.max_per_target:
+                        del self._ready[i]
+                        self._in_flight[job.target] = self._in_flight.get(job.target, 0) + 1
+                        return job
+                self._condition.wait(self._delayed[0][0] - ts_now if self._delayed else None)
+        return None
+
+    def _release(self, job: WebhookJob, retry_at: Optional[float] = None) -> None:
+        with self._condition:
+            self._in_flight[job.target] -= 1
+            if self._in_flight[job.target] == 0:
+                del self._in_flight[job.target]
+            if retry_at is not None:
+                heapq.heappush(self._delayed, (retry_at, next(self._sequence), job))
+            # a slot is free or a retry is scheduled
+            self._condition.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            job = self._take()
+            if job is None:
+                return
+            try:
+                if job.url is None:
+                    self._resolve(job)
+                else:
+                    retry_at = None
+                    try:
+                        retry_at = self._deliver(job)
+                    finally:
+                        self._release(job, retry_at)
+            except Exception:
+                traceback.print_exc()
+            if self._dead:
+                self._write_dead_letters()
+
+    def _resolve(self, job: WebhookJob) -> None:
+        with self.app.app_context():
+            target = self.resolve(job.key)
+        if target is None:
+            # nothing registered for the key
+            return
+        job.url, job.secret = target
+        with self._condition:
+            self._ready.appendleft(job)
+            self._condition.notify()
+
+    def _deliver(self, job: WebhookJob) -> Optional[float]:
+        """ one attempt; returns the time.monotonic() of the retry, None when done """
+        job.attempts += 1
+        error = target_error(job.url, self.allowed_hosts)
+        if error is not None:
+            job.error = f'forbidden target, {error}'[:256]
+            with self._condition:
+                self._dead.append(job)
+            return None
+        body = json.dumps(job.payload).encode()
+        headers = {'Content-Type': 'application/json', SIGNATURE_HEADER: sign(job.secret, body)}
+        try:
+            response = self.session.post(job.url, data=body, headers=headers, timeout=self.timeout,
+                                         allow_redirects=False)
+            if 200 <= response.status_code < 300:
+                self.delivered += 1
+                WEBHOOK_RESULTS.inc(result='delivered')
+                return None
+            job.error = f'http status {response.status_code}'
+            retry = response.status_code >= 500 or response.status_code in RETRY_STATUS
+        except ForbiddenTarget as e:
+            job.error = f'forbidden target, {e}'[:256]
+            with self._condition:
+                self._dead.append(job)
+            return None
+        except requests.RequestException as e:
+            job.error = f'{type(e).__name__}: {e}'[:256]
+            retry = True
+        if retry and job.attempts < self.max_attempts:
+            delay = self.retry_base * 2 ** (job.attempts - 1) * random.uniform(0.5, 1)
+            if job.expires is None or time.time() + delay < job.expires:
+                self.retried += 1
+                WEBHOOK_RESULTS.inc(result='retry')
+                return time.monotonic() + delay
+            job.error = f'expired, {job.error}'[:256]
+        with self._condition:
+            self._dead.append(job)
+        return None
+
+    def _write_dead_letters(self) -> None:
+        with self._dead_letter_lock:
+            with self._condition:
+                jobs, self._dead = self._dead, []
+            if not jobs:
+                return
+            try:
+                with self.app.app_context():
+                    self.dead_letter(jobs)
+            except Exception:
+                traceback.print_exc()
+            self.dead_lettered += len(jobs)
+            WEBHOOK_RESULTS.inc(len(jobs), result='dead_letter')
@@ -0,0 +1,58 @@
+"""Benchmark of the "is actor X active right now" check against a growing State table.
+
+    python -m benchmarks.bench_active_state [max_rows]
+
+Compares the sql EXISTS check (check_actor_if_active) with the former path that loads every State row of the actor
+and walks them in python (get_state_from_actor_id + eval_ts_list). The legacy path is skipped above 100k rows.
+"""
+import statistics
+import sys
+import time
+import uuid
+from typing import Callable
+
+from app.app import create_app, shutdown_app, db
+from app.api.func import add_user, check_actor_if_active, get_state_from_actor_id, eval_ts_list
+from app.models.user import Role
+from benchmarks.context.bench_config import Config
+from benchmarks.fixtures import insert_expired_states
+
+LEGACY_MAX_ROWS = 100_000
+
+
+def median_ms(fn: Callable[[], object], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        ts_start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - ts_start)
+    return statistics.median(timings) * 1000
+
+
+def main(max_rows: int = 1_000_000) -> None:
+    app = create_app(config_class=Config.get_cls())
+    with app.app_context():
+        actor_id = uuid.UUID(add_user('bench_actor', Role.actor)['id'])
+        print(f'{"rows":>10} {"exists [ms]":>12} {"legacy [ms]":>12}')
+        rows = 0
+        size = 1_000
+        while size <= max_rows:
+            insert_expired_states([actor_id], size - rows)
+            rows = size
+            assert not check_actor_if_active(actor_id)
+            exists_ms = median_ms(lambda: check_actor_if_active(actor_id), repeat=200)
+            if rows <= LEGACY_MAX_ROWS:
+                legacy_ms = f'{median_ms(lambda: eval_ts_list(get_state_from_actor_id(actor_id)), repeat=5):12.3f}'
+            else:
+                legacy_ms = f'{"-":>12}'
+            print(f'{rows:>10} {exists_ms:12.3f} {legacy_ms}')
+            size *= 10
+    shutdown_app(app)
+    with app.app_context():
+        db.session.close()
+        db.engine.dispose()
+    Config.TEMP_DIR.cleanup()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
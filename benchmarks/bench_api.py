@@ -0,0 +1,160 @@
+"""Latency, throughput and statement counts of the api hot paths against a synthetic dataset.
+
+    python -m benchmarks.bench_api --users 1000 --actors 100 --states 100000 --output results.json
+
+Every scenario is run through the Flask test client and through a real waitress server on localhost. Results are
+written as JSON so that runs of different releases can be compared.
+"""
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import threading
+from typing import Callable, Dict, Optional
+
+import requests
+import waitress
+
+from app.app import create_app, shutdown_app, db
+from benchmarks.context.bench_config import Config
+from benchmarks.fixtures import set_up_dataset, Dataset
+from benchmarks.runner import run_load, statement_counter
+
+TARGETS = ['client', 'waitress']
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class ClientTarget:
+    """ sends requests through the flask test client, one client per thread """
+
+    def __init__(self, app, threads: int):
+        self.clients = [app.test_client() for _ in range(threads)]
+
+    def get(self, thread_index: int, path: str, params: dict) -> int:
+        return self.clients[thread_index].get(path, query_string=params).status_code
+
+    def post(self, thread_index: int, path: str, data: dict) -> int:
+        return self.clients[thread_index].post(path, data=data).status_code
+
+    def close(self) -> None:
+        pass
+
+
+class WaitressTarget:
+    """ serves the app with waitress on a free localhost port, one keep-alive session per thread """
+
+    def __init__(self, app, threads: int):
+        self.server = waitress.create_server(app, host='127.0.0.1', port=0, threads=max(4, threads))
+        self.url = f'http://127.0.0.1:{self.server.effective_port}'
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        self.sessions = [requests.Session() for _ in range(threads)]
+
+    def get(self, thread_index: int, path: str, params: dict) -> int:
+        return self.sessions[thread_index].get(self.url + path, params=params).status_code
+
+    def post(self, thread_index: int, path: str, data: dict) -> int:
+        return self.sessions[thread_index].post(self.url + path, data=data).status_code
+
+    def close(self) -> None:
+        for session in self.sessions:
+            session.close()
+        self.server.close()
+        self.thread.join(timeout=5)
+
+
+def scenarios(dataset: Dataset, target) -> Dict[str, Callable[[int, int], bool]]:
+    def get_state(thread_index: int, request_index: int) -> bool:
+        actor_id, actor_key = dataset.actors[request_index % len(dataset.actors)]
+        return target.get(thread_index, '/api/getState', {'api-key': actor_key, 'actor-id': actor_id.hex}) == 200
+
+    def set_state(thread_index: int, request_index: int) -> bool:
+        user_id, actor_id = dataset.write_scopes[request_index % len(dataset.write_scopes)]
+        data = {'api-key': dataset.users_by_id[user_id], 'actor-id': actor_id.hex}
+        return target.post(thread_index, '/api/setState', data) == 200
+
+    return {'getState': get_state, 'setState': set_state}
+
+
+def run(users: int, actors: int, scopes_per_user: int, valid_rows: int, state_rows: int, requests_count: int,
+        threads: int, targets=None) -> Dict:
+    targets = targets if targets is not None else TARGETS
+    app = create_app(config_class=Config.get_cls())
+    dataset = set_up_dataset(app, users, actors, scopes_per_user, valid_rows, state_rows)
+    with app.app_context():
+        engine = db.engine
+    results = {}
+    try:
+        for target_name in targets:
+            target = ClientTarget(app, threads) if target_name == 'client' else WaitressTarget(app, threads)
+            try:
+                results[target_name] = {}
+                for scenario_name, request_fn in scenarios(dataset, target).items():
+                    # warm up caches and connections
+                    run_load(request_fn, min(requests_count, 2 * len(dataset.actors)), threads)
+                    with statement_counter(engine) as statements:
+                        result = run_load(request_fn, requests_count, threads)
+                        # write-behind usage rows belong to the measured requests
+                        if 'usage_recorder' in app.extensions:
+                            app.extensions['usage_recorder'].flush()
+                    result['statements_per_request'] = statements[0] / max(1, result['requests'])
+                    results[target_name][scenario_name] = result
+            finally:
+                target.close()
+    finally:
+        shutdown_app(app)
+        with app.app_context():
+            db.session.close()
+            db.engine.dispose()
+        Config.TEMP_DIR.cleanup()
+
+    return {'meta': {'timestamp': datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+                     'revision': git_revision(), 'python': sys.version.split()[0], 'platform': platform.platform(),
+                     'database': 'sqlite'},
+            'parameters': {'users': users, 'actors': actors, 'scopes_per_user': scopes_per_user,
+                           'valid_rows': valid_rows, 'state_rows': state_rows, 'requests': requests_count,
+                           'threads': threads, 'targets': targets},
+            'results': results}
+
+
+def print_results(report: Dict) -> None:
+    print(f'{"target":<10} {"scenario":<10} {"rps":>9} {"p50 [ms]":>9} {"p95 [ms]":>9} {"p99 [ms]":>9} '
+          f'{"stmt/req":>9} {"errors":>7}')
+    for target_name, target_results in report['results'].items():
+        for scenario_name, r in target_results.items():
+            print(f'{target_name:<10} {scenario_name:<10} {r["throughput_rps"]:9.1f} {r["p50_ms"]:9.2f} '
+                  f'{r["p95_ms"]:9.2f} {r["p99_ms"]:9.2f} {r["statements_per_request"]:9.2f} {r["errors"]:7d}')
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--actors', type=int, default=10)
+    parser.add_argument('--scopes-per-user', type=int, default=1)
+    parser.add_argument('--valid', type=int, default=0, help='additional expired Valid rows')
+    parser.add_argument('--states', type=int, default=0, help='additional expired State rows')
+    parser.add_argument('--requests', type=int, default=1000, help='requests per scenario and target')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--target', choices=TARGETS + ['both'], default='both')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    report = run(args.users, args.actors, args.scopes_per_user, args.valid, args.states, args.requests, args.threads,
+                 TARGETS if args.target == 'both' else [args.target])
+    print_results(report)
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""Concurrent long-polling actors: the asyncio path (app.asgi on uvicorn) against the waitress.serve entry point.
+
+    python -m benchmarks.bench_asgi --connections 1000 --wait 5 --duration 15
+
+Each server runs in its own process with default settings (waitress: 4 threads, uvicorn: one event loop). The
+given number of actors long-poll getState (their state stays false, so every poll waits the full time) while a
+probe sends plain getState requests one after another; the probe latency shows whether other requests are still
+served while the connections are held.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+from urllib.parse import urlencode
+
+from app.app import create_app, shutdown_app, db
+from benchmarks.context.bench_config import Config
+from benchmarks.fixtures import set_up_dataset
+from benchmarks.runner import summarize
+
+TARGETS = ['waitress', 'asgi']
+REQUEST_TIMEOUT = 60
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(target: str, database_uri: str, port: int) -> None:
+    """ runs in the server process """
+    config = type('BenchAsgiConfig', (Config,), {'SQLALCHEMY_DATABASE_URI': database_uri,
+                                                 'LONG_POLL_MAX_WAIT': 3600})
+    if target == 'waitress':
+        import waitress
+        waitress.serve(create_app(config_class=config), host='127.0.0.1', port=port)
+    else:
+        import uvicorn
+        from app.asgi import create_asgi_app
+        uvicorn.run(create_asgi_app(config_class=config), host='127.0.0.1', port=port, lifespan='on',
+                    access_log=False, log_level='warning')
+
+
+def start_server(target: str, database_uri: str) -> Tuple[subprocess.Popen, int]:
+    port = free_port()
+    process = subprocess.Popen([sys.executable, '-m', 'benchmarks.bench_asgi', '--serve', target,
+                                '--database-uri', database_uri, '--port', str(port)],
+                               stdout=subprocess.DEVNULL, env={**os.environ, 'PYTHONPATH': os.getcwd()})
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'{target} server did not start')
+
+
+async def http_get(port: int, path: str, params: dict) -> int:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(f'GET {path}?{urlencode(params)} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n'
+                     .encode('latin-1'))
+        await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+async def run_load(port: int, actors: List[Tuple], connections: int, wait: float, duration: float) -> Dict:
+    deadline = time.monotonic() + duration
+    polls = {'completed': 0, 'errors': 0}
+    probe_latencies = []
+    probe_errors = [0]
+
+    async def poller(index: int) -> None:
+        actor_id, actor_key = actors[index % len(actors)]
+        params = {'api-key': actor_key, 'actor-id': actor_id.hex, 'wait': wait}
+        while time.monotonic() < deadline:
+            try:
+                status = await asyncio.wait_for(http_get(port, '/api/getState', params), REQUEST_TIMEOUT)
+                polls['completed' if status == 200 else 'errors'] += 1
+            except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+                polls['errors'] += 1
+                await asyncio.sleep(0.1)
+
+    async def probe() -> None:
+        actor_id, actor_key = actors[0]
+        params = {'api-key': actor_key, 'actor-id': actor_id.hex}
+        # let the pollers connect first
+        await asyncio.sleep(min(1.0, duration / 4))
+        while time.monotonic() < deadline:
+            ts_start = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(http_get(port, '/api/getState', params), REQUEST_TIMEOUT)
+                if status != 200:
+                    probe_errors[0] += 1
+            except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+                probe_errors[0] += 1
+            probe_latencies.append(time.perf_counter() - ts_start)
+
+    ts_start = time.perf_counter()
+    await asyncio.gather(probe(), *[poller(i) for i in range(connections)])
+    probe_result = summarize(probe_latencies, time.perf_counter() - ts_start, probe_errors[0])
+    return {'polls_completed': polls['completed'], 'poll_errors': polls['errors'], 'probe': probe_result}
+
+
+def run(connections: int, wait: float, duration: float, actors: int, targets=None) -> Dict:
+    targets = targets if targets is not None else TARGETS
+    app = create_app(config_class=Config.get_cls())
+    dataset = set_up_dataset(app, users=1, actors=actors)
+    database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    shutdown_app(app)
+    with app.app_context():
+        db.session.close()
+        db.engine.dispose()
+    results = {}
+    try:
+        for target in targets:
+            process, port = start_server(target, database_uri)
+            try:
+                results[target] = asyncio.run(run_load(port, dataset.actors, connections, wait, duration))
+            finally:
+                process.terminate()
+                process.wait(timeout=30)
+    finally:
+        Config.TEMP_DIR.cleanup()
+    return results
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=1000, help='concurrently long-polling actors')
+    parser.add_argument('--wait', type=float, default=5, help='long-poll wait in seconds')
+    parser.add_argument('--duration', type=float, default=15, help='seconds per target')
+    parser.add_argument('--actors', type=int, default=100)
+    parser.add_argument('--target', choices=TARGETS + ['both'], default='both')
+    parser.add_argument('--serve', choices=TARGETS, help=argparse.SUPPRESS)
+    parser.add_argument('--database-uri', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.serve is not None:
+        serve(args.serve, args.database_uri, args.port)
+        return
+
+    results = run(args.connections, args.wait, args.duration, args.actors,
+                  TARGETS if args.target == 'both' else [args.target])
+    print(f'{"target":<10} {"polls":>8} {"poll err":>9} {"probe req":>10} {"p50 [ms]":>10} {"p99 [ms]":>10} '
+          f'{"probe err":>10}')
+    for target, r in results.items():
+        probe = r['probe']
+        print(f'{target:<10} {r["polls_completed"]:8d} {r["poll_errors"]:9d} {probe["requests"]:10d} '
+              f'{probe["p50_ms"]:10.2f} {probe["p99_ms"]:10.2f} {probe["errors"]:10d}')
+
+
+if __name__ == '__main__':
+    main()
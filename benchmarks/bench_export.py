@@ -0,0 +1,91 @@
+"""Exporting usage history: the streaming keyset export against loading the whole table in one query.
+
+    python -m benchmarks.bench_export --rows 1000000
+
+Both variants write ndjson to /dev/null; peak memory is measured with tracemalloc, so it only covers python
+allocations (not the sqlite page cache).
+"""
+import argparse
+import datetime
+import json
+import os
+import time
+import tracemalloc
+import uuid
+from typing import Dict
+
+from sqlalchemy import select
+
+from app.app import create_app, shutdown_app, db
+from app.export import export, export_value, EXPORT_TABLES
+from app.models.usage import Usage, Type
+from app.util.util import now
+from benchmarks.context.bench_config import Config
+from benchmarks.fixtures import set_up_dataset, bulk_insert
+
+
+def insert_usage(dataset, rows: int) -> None:
+    ts_now = now()
+    bulk_insert(Usage, [{'id': uuid.uuid4(), 'user_id': dataset.users[i % len(dataset.users)][0],
+                         'actor_id': dataset.actors[i % len(dataset.actors)][0],
+                         'type': Type.setState if i % 2 else Type.getState_true,
+                         'timestamp': ts_now - datetime.timedelta(seconds=i // 2),
+                         'created_at': ts_now, 'updated_at': ts_now} for i in range(rows)])
+
+
+def export_load_all() -> Dict:
+    columns = EXPORT_TABLES['usage'].columns
+    rows = db.session.execute(select(*[getattr(Usage, column) for column in columns])
+                              .order_by(Usage.timestamp, Usage.id)).all()
+    with open(os.devnull, 'w') as output:
+        for row in rows:
+            output.write(json.dumps({column: export_value(value) for column, value in zip(columns, row)}) + '\n')
+    return {'rows': len(rows)}
+
+
+def export_stream() -> Dict:
+    lines = 0
+    with open(os.devnull, 'w') as output:
+        for chunk in export('usage', 'ndjson'):
+            output.write(chunk)
+            lines += 1
+    return {'rows': lines}
+
+
+def run(rows: int) -> Dict:
+    app = create_app(config_class=Config.get_cls())
+    dataset = set_up_dataset(app, users=100, actors=20)
+    results = {}
+    try:
+        with app.app_context():
+            insert_usage(dataset, rows)
+            for variant, export_fn in [('load-all', export_load_all), ('stream', export_stream)]:
+                db.session.close()
+                tracemalloc.start()
+                ts_start = time.perf_counter()
+                result = export_fn()
+                result['seconds'] = time.perf_counter() - ts_start
+                result['peak_mb'] = tracemalloc.get_traced_memory()[1] / (1 << 20)
+                tracemalloc.stop()
+                results[variant] = result
+    finally:
+        shutdown_app(app)
+        with app.app_context():
+            db.session.close()
+            db.engine.dispose()
+        Config.TEMP_DIR.cleanup()
+    return results
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    args = parser.parse_args(argv)
+
+    print(f'{"variant":<10} {"rows":>9} {"seconds":>9} {"peak [MB]":>10}')
+    for variant, r in run(args.rows).items():
+        print(f'{variant:<10} {r["rows"]:9d} {r["seconds"]:9.2f} {r["peak_mb"]:10.1f}')
+
+
+if __name__ == '__main__':
+    main()
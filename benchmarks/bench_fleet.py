@@ -0,0 +1,364 @@
+"""Fleet simulator: how many doors one server handles before polls and openings slow down.
+
+    python -m benchmarks.bench_fleet --actors 2000 --users 200 --step-duration 20
+
+The fleet is provisioned through /api/provision (the calls of sh/util/initial_setup.py) on a waitress server in its
+own process, set up like the production entry point. Then load steps run with a growing number of active actors:
+every actor polls getState on its own keep-alive connection like sh/actor/daemon.py (every poll-interval seconds with
+jitter, or long polls with --wait) and holds off for the strike pulse after it saw its state, and doors are opened
+at random (Poisson) with opens-per-door-hour by one of their users. Each step records the getState latency and the
+delay from sending setState until the actor observes the state. The first step that breaks a limit is the saturation
+point; the number of actors between the last good and the first failing step is narrowed down by bisection.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+from app.app import create_app, shutdown_app, db
+from app.models.scope import Mode
+from app.models.user import User, Role
+from app.util.util import generate_api_key, simple_hash_str
+from benchmarks.bench_asgi import free_port
+from benchmarks.context.bench_config import Config
+from benchmarks.runner import summarize, percentile
+from sh.util import initial_setup
+
+REQUEST_TIMEOUT = 30
+# a chunk of users, scopes or valid windows per provision request, below PROVISION_MAX_ITEMS
+PROVISION_CHUNK = 5000
+# open (6s) plus hold-off (4s) of the door strike, the actor daemon does not poll meanwhile
+STRIKE_PULSE = 10
+HEADER = (f'{"actors":>7} {"polls/s":>8} {"p50 [ms]":>9} {"p99 [ms]":>9} {"set p99":>9} {"opens":>7} '
+          f'{"delay p50":>9} {"delay p99":>9} {"errors":>7} {"lag p99":>8}  limit')
+
+
+class Connection:
+    """ one keep-alive HTTP/1.1 connection to the server, reopened after errors """
+
+    def __init__(self, port: int):
+        self.port = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def request(self, method: str, path: str, params: dict) -> Tuple[int, bytes]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        if method == 'GET':
+            message = f'GET {path}?{urlencode(params)} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'.encode('latin-1')
+        else:
+            body = urlencode(params).encode('latin-1')
+            message = (f'{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: '
+                       f'application/x-www-form-urlencoded\r\nContent-Length: {len(body)}\r\n\r\n'
+                       ).encode('latin-1') + body
+        try:
+            self.writer.write(message)
+            await self.writer.drain()
+            status_line = await self.reader.readline()
+            length, close = 0, False
+            while (line := await self.reader.readline()) not in (b'\r\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value)
+                elif name.lower() == 'connection':
+                    close = value.strip().lower() == 'close'
+            body = await self.reader.readexactly(length)
+            if close:
+                self.close()
+            return int(status_line.split()[1]), body
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+def fleet(actors: int, users: int) -> Tuple[List[dict], List[dict], List[dict], Dict[int, int]]:
+    """ provision items and the user that opens each door; every actor reads its own state, the doors are dealt
+    round-robin to the users (a user without a door of its own shares one) """
+    user_items = [{'name': f'actor{i}', 'role': Role.actor.name} for i in range(actors)]
+    user_items += [{'name': f'user{u}', 'role': Role.user.name} for u in range(users)]
+    scope_items = [{'user-name': f'actor{i}', 'actor-name': f'actor{i}', 'mode': Mode.read.name}
+                   for i in range(actors)]
+    doors = {u: [i for i in range(u, actors, users)] or [u % actors] for u in range(users)}
+    scope_items += [{'user-name': f'user{u}', 'actor-name': f'actor{i}', 'mode': Mode.write.name}
+                    for u, actor_indexes in doors.items() for i in actor_indexes]
+    valid_items = [{'user-name': item['name']} for item in user_items]
+    openers = {i: i % users for i in range(actors)}
+    return user_items, scope_items, valid_items, openers
+
+
+def provision_fleet(url: str, admin_key: str, actors: int, users: int) -> Tuple[List[Tuple[str, str]],
+                                                                              List[str], Dict[int, int]]:
+    """ (actor id, actor key) per actor, the key per user and the opening user per actor """
+    user_items, scope_items, valid_items, openers = fleet(actors, users)
+    created = []
+    for kind, items in [('users', user_items), ('scopes', scope_items), ('valid', valid_items)]:
+        for chunk_start in range(0, len(items), PROVISION_CHUNK):
+            chunk = {'users': [], 'scopes': [], 'valid': []}
+            chunk[kind] = items[chunk_start:chunk_start + PROVISION_CHUNK]
+            response = initial_setup.provision(url, admin_key, **chunk)
+            if response.get('msg') != 'success':
+                raise RuntimeError(f'provisioning failed: {response.get("msg")}')
+            created += response['users']
+    actor_credentials = [(user['id'], user['api_key']) for user in created[:actors]]
+    user_keys = [user['api_key'] for user in created[actors:]]
+    return actor_credentials, user_keys, openers
+
+
+def serve(database_uri: str, port: int, threads: int, connection_limit: int) -> None:
+    """ runs in the server process """
+    config = type('BenchFleetConfig', (Config,), {'SQLALCHEMY_DATABASE_URI': database_uri})
+    import waitress
+    waitress.serve(create_app(config_class=config), host='127.0.0.1', port=port, threads=threads,
+                   connection_limit=connection_limit)
+
+
+def start_server(database_uri: str, threads: int, connection_limit: int) -> Tuple[subprocess.Popen, int]:
+    port = free_port()
+    process = subprocess.Popen([sys.executable, '-m', 'benchmarks.bench_fleet', '--serve', '--database-uri',
+                                database_uri, '--port', str(port), '--threads', str(threads),
+                                '--connection-limit', str(connection_limit)],
+                               stdout=subprocess.DEVNULL, env={**os.environ, 'PYTHONPATH': os.getcwd()})
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('waitress server did not start')
+
+
+async def run_step(port: int, actors: List[Tuple[str, str]], user_keys: List[str], openers: Dict[int, int],
+                   duration: float, poll_interval: float, wait: float, opens_per_door_hour: float) -> Dict:
+    """ one load step with all given actors polling and their doors being opened """
+    deadline = time.monotonic() + duration
+    poll_latencies, set_latencies, delays, loop_lags = [], [], [], []
+    errors = {'getState': 0, 'setState': 0}
+    # actor index -> time.monotonic() of the first setState it has not observed yet
+    pending: Dict[int, float] = {}
+    pulsing = set()
+
+    async def actor(index: int) -> None:
+        actor_id, actor_key = actors[index]
+        params = {'api-key': actor_key, 'actor-id': actor_id}
+        if wait > 0:
+            params['wait'] = wait
+        connection = Connection(port)
+        # the daemons do not start in lockstep
+        await asyncio.sleep(random.uniform(0, poll_interval))
+        try:
+            while time.monotonic() < deadline:
+                ts_start = time.monotonic()
+                state = None
+                try:
+                    status, body = await asyncio.wait_for(connection.request('GET', '/api/getState', params),
+                                                          REQUEST_TIMEOUT + wait)
+                    if status == 200:
+                        state = json.loads(body)['state'] is True
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError, KeyError):
+                    connection.close()
+                ts_end = time.monotonic()
+                poll_latencies.append(ts_end - ts_start)
+                if state is None:
+                    errors['getState'] += 1
+                    await asyncio.sleep(poll_interval * random.uniform(0.5, 1))
+                elif state:
+                    if index in pending:
+                        delays.append(ts_end - pending.pop(index))
+                    pulsing.add(index)
+                    await asyncio.sleep(min(STRIKE_PULSE, max(0.0, deadline - ts_end)))
+                    pulsing.discard(index)
+                elif ts_end - ts_start < poll_interval:
+                    await asyncio.sleep((poll_interval - (ts_end - ts_start)) * random.uniform(0.5, 1))
+        finally:
+            connection.close()
+
+    async def open_door(index: int) -> None:
+        actor_id, _ = actors[index]
+        params = {'api-key': user_keys[openers[index]], 'actor-id': actor_id}
+        connection = Connection(port)
+        ts_start = time.monotonic()
+        # the door is open already, nothing to observe
+        if index not in pulsing:
+            pending.setdefault(index, ts_start)
+        try:
+            status, _ = await asyncio.wait_for(connection.request('POST', '/api/setState', params), REQUEST_TIMEOUT)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError):
+            status = None
+        finally:
+            connection.close()
+        set_latencies.append(time.monotonic() - ts_start)
+        if status != 200:
+            errors['setState'] += 1
+            if pending.get(index) == ts_start:
+                del pending[index]
+
+    async def opener() -> None:
+        rate = len(actors) * opens_per_door_hour / 3600
+        tasks = set()
+        while rate > 0:
+            await asyncio.sleep(random.expovariate(rate))
+            if time.monotonic() >= deadline:
+                break
+            task = asyncio.create_task(open_door(random.randrange(len(actors))))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+
+    async def loop_lag() -> None:
+        """ how late the event loop runs a timer, shows when the simulator itself is the bottleneck """
+        while time.monotonic() < deadline:
+            ts_start = time.monotonic()
+            await asyncio.sleep(0.1)
+            loop_lags.append(time.monotonic() - ts_start - 0.1)
+
+    ts_start = time.perf_counter()
+    await asyncio.gather(opener(), loop_lag(), *[actor(i) for i in range(len(actors))])
+    elapsed = time.perf_counter() - ts_start
+    # openings that no poll observed before the step ended (the state lasts for SET_STATE_DURATION)
+    missed = sum(1 for ts in pending.values() if ts < deadline - poll_interval - wait - 1)
+    return {'actors': len(actors), 'getState': summarize(poll_latencies, elapsed, errors['getState']),
+            'setState': summarize(set_latencies, elapsed, errors['setState']),
+            'delay': {**summarize(delays, elapsed), 'missed': missed},
+            'loop_lag_p99_ms': percentile(sorted(lag * 1000 for lag in loop_lags), 0.99)}
+
+
+def check_step(result: Dict, max_p99_ms: float, max_delay_ms: float, max_error_rate: float,
+               long_poll: bool) -> Optional[str]:
+    """ the limit a step broke, None if it stayed within all of them """
+    requests_count = result['getState']['requests'] + result['setState']['requests']
+    errors = result['getState']['errors'] + result['setState']['errors'] + result['delay']['missed']
+    if requests_count == 0 or errors / requests_count > max_error_rate:
+        return 'errors'
+    # long polls take up to wait by design
+    if not long_poll and result['getState']['p99_ms'] > max_p99_ms:
+        return 'getState p99'
+    if result['setState']['p99_ms'] > max_p99_ms:
+        return 'setState p99'
+    if result['delay']['requests'] > 0 and result['delay']['p99_ms'] > max_delay_ms:
+        return 'delay p99'
+    return None
+
+
+def step_sizes(start: int, growth: float, maximum: int) -> List[int]:
+    sizes = [min(start, maximum)]
+    while sizes[-1] < maximum:
+        sizes.append(min(maximum, max(sizes[-1] + 1, math.ceil(sizes[-1] * growth))))
+    return sizes
+
+
+def run(actors: int, users: int, start: int, growth: float, refine: int, step_duration: float, poll_interval: float,
+        wait: float, opens_per_door_hour: float, max_p99_ms: float, max_delay_ms: Optional[float],
+        max_error_rate: float, threads: int, connection_limit: int, log=print) -> Dict:
+    max_delay_ms = max_delay_ms if max_delay_ms is not None else poll_interval * 1000 + max_p99_ms
+    app = create_app(config_class=Config.get_cls())
+    admin_key = generate_api_key()
+    with app.app_context():
+        User.query.filter_by(name='_builtin_admin').update({'api_key': simple_hash_str(admin_key)})
+        db.session.commit()
+    database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    shutdown_app(app)
+    with app.app_context():
+        db.session.close()
+        db.engine.dispose()
+    steps = []
+    capacity, saturation, reason = 0, None, None
+    try:
+        process, port = start_server(database_uri, threads, connection_limit)
+        try:
+            ts_start = time.perf_counter()
+            actor_credentials, user_keys, openers = provision_fleet(f'http://127.0.0.1:{port}', admin_key, actors,
+                                                                    users)
+            log(f'provisioned {actors} actors and {users} users in {time.perf_counter() - ts_start:.1f}s')
+            log(HEADER)
+
+            def measure(size: int) -> Optional[str]:
+                result = asyncio.run(run_step(port, actor_credentials[:size], user_keys, openers, step_duration,
+                                              poll_interval, wait, opens_per_door_hour))
+                result['limit'] = check_step(result, max_p99_ms, max_delay_ms, max_error_rate, wait > 0)
+                steps.append(result)
+                log(format_step(result))
+                return result['limit']
+
+            for size in step_sizes(start, growth, actors):
+                limit = measure(size)
+                if limit is not None:
+                    saturation, reason = size, limit
+                    break
+                capacity = size
+            # narrow down between the last good and the first failing step
+            for _ in range(refine if saturation is not None else 0):
+                size = (capacity + saturation) // 2
+                if size in (capacity, saturation):
+                    break
+                limit = measure(size)
+                if limit is None:
+                    capacity = size
+                else:
+                    saturation, reason = size, limit
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+    finally:
+        Config.TEMP_DIR.cleanup()
+    return {'steps': steps, 'capacity': capacity, 'saturation': saturation, 'reason': reason}
+
+
+def format_step(result: Dict) -> str:
+    get_state, set_state, delay = result['getState'], result['setState'], result['delay']
+    return (f'{result["actors"]:7d} {get_state["throughput_rps"]:8.1f} {get_state["p50_ms"]:9.1f} '
+            f'{get_state["p99_ms"]:9.1f} {set_state["p99_ms"]:9.1f} {delay["requests"]:7d} {delay["p50_ms"]:9.1f} '
+            f'{delay["p99_ms"]:9.1f} {get_state["errors"] + set_state["errors"] + delay["missed"]:7d} '
+            f'{result["loop_lag_p99_ms"]:8.1f}  {result["limit"] or "ok"}')
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--actors', type=int, default=2000, help='provisioned actors, the largest step')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--start', type=int, default=50, help='active actors in the first step')
+    parser.add_argument('--growth', type=float, default=2, help='factor between steps')
+    parser.add_argument('--refine', type=int, default=3, help='bisection steps after the first failing step')
+    parser.add_argument('--step-duration', type=float, default=20, help='seconds per step')
+    parser.add_argument('--poll-interval', type=float, default=1, help='seconds between polls of an actor')
+    parser.add_argument('--wait', type=float, default=0, help='long-poll seconds, 0 for interval polling')
+    parser.add_argument('--opens-per-door-hour', type=float, default=30)
+    parser.add_argument('--max-p99-ms', type=float, default=500, help='limit for getState/setState p99')
+    parser.add_argument('--max-delay-ms', type=float, help='limit for the setState -> observed p99, default: '
+                                                           'poll interval + max-p99-ms')
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    parser.add_argument('--threads', type=int, default=4, help='waitress threads (waitress default)')
+    parser.add_argument('--connection-limit', type=int, default=100, help='waitress connection limit (default)')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--database-uri', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.serve:
+        serve(args.database_uri, args.port, args.threads, args.connection_limit)
+        return
+
+    result = run(args.actors, args.users, args.start, args.growth, args.refine, args.step_duration,
+                 args.poll_interval, args.wait, args.opens_per_door_hour, args.max_p99_ms, args.max_delay_ms,
+                 args.max_error_rate, args.threads, args.connection_limit)
+    if result['saturation'] is None:
+        print(f'not saturated with {result["capacity"]} actors, provision more with --actors')
+    else:
+        print(f'capacity: {result["capacity"]} actors, saturated at {result["saturation"]} ({result["reason"]})')
+
+
+if __name__ == '__main__':
+    main()
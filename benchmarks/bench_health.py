@@ -0,0 +1,83 @@
+"""Monitoring a fleet: one actorHealth request per actor against a single fleetHealth request.
+
+    python -m benchmarks.bench_health --actors 500 --usage-rows 200000
+
+Every actor gets a heartbeat, usage-rows adds setState/getState_true history on top. Both variants run through
+waitress on the same database.
+"""
+import argparse
+import datetime
+import time
+import uuid
+from typing import Dict
+
+from app.app import create_app, shutdown_app, db
+from app.api.func import principal_cache
+from app.models.usage import Usage, Type
+from app.models.user import User
+from app.util.util import generate_api_key, simple_hash_str, now
+from benchmarks.bench_api import WaitressTarget
+from benchmarks.context.bench_config import Config
+from benchmarks.fixtures import set_up_dataset, bulk_insert
+
+
+def insert_usage(dataset, usage_rows: int) -> None:
+    ts_now = now()
+    rows = [{'id': uuid.uuid4(), 'user_id': actor_id, 'actor_id': actor_id, 'type': Type.last_getState,
+             'timestamp': ts_now - datetime.timedelta(seconds=i % 10), 'created_at': ts_now, 'updated_at': ts_now}
+            for i, (actor_id, _) in enumerate(dataset.actors)]
+    rows += [{'id': uuid.uuid4(), 'user_id': dataset.users[i % len(dataset.users)][0],
+              'actor_id': dataset.actors[i % len(dataset.actors)][0],
+              'type': Type.setState if i % 2 else Type.getState_true,
+              'timestamp': ts_now - datetime.timedelta(seconds=i), 'created_at': ts_now, 'updated_at': ts_now}
+             for i in range(usage_rows)]
+    bulk_insert(Usage, rows)
+
+
+def run(actors: int, usage_rows: int, timeout: int) -> Dict:
+    app = create_app(config_class=Config.get_cls())
+    dataset = set_up_dataset(app, users=10, actors=actors)
+    maintenance_key = generate_api_key()
+    with app.app_context():
+        insert_usage(dataset, usage_rows)
+        User.query.filter_by(name='_builtin_maintenance').update({'api_key': simple_hash_str(maintenance_key)})
+        db.session.commit()
+    principal_cache().clear()
+    target = WaitressTarget(app, 1)
+    results = {}
+    try:
+        ts_start = time.perf_counter()
+        healthy = sum(target.sessions[0].get(target.url + '/api/actorHealth',
+                                             params={'api-key': maintenance_key, 'actor-id': actor_id.hex,
+                                                     'timeout': timeout}).json()['health']
+                      for actor_id, _ in dataset.actors)
+        results['per-actor'] = {'requests': actors, 'seconds': time.perf_counter() - ts_start, 'healthy': healthy}
+
+        ts_start = time.perf_counter()
+        response = target.sessions[0].get(target.url + '/api/fleetHealth',
+                                          params={'api-key': maintenance_key, 'timeout': timeout}).json()
+        results['fleet'] = {'requests': 1, 'seconds': time.perf_counter() - ts_start, 'healthy': response['healthy']}
+    finally:
+        target.close()
+        shutdown_app(app)
+        with app.app_context():
+            db.session.close()
+            db.engine.dispose()
+        Config.TEMP_DIR.cleanup()
+    return results
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--actors', type=int, default=500)
+    parser.add_argument('--usage-rows', type=int, default=200_000)
+    parser.add_argument('--timeout', type=int, default=30)
+    args = parser.parse_args(argv)
+
+    print(f'{"variant":<10} {"requests":>9} {"seconds":>9} {"healthy":>8}')
+    for variant, r in run(args.actors, args.usage_rows, args.timeout).items():
+        print(f'{variant:<10} {r["requests"]:9d} {r["seconds"]:9.3f} {r["healthy"]:8d}')
+
+
+if __name__ == '__main__':
+    main()
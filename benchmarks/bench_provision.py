@@ -0,0 +1,94 @@
+"""Provisioning a fleet: one addUser/addScope/addValid request per item against a single /api/provision request.
+
+    python -m benchmarks.bench_provision --actors 200 --users 50 --passwords 10
+
+Both variants create the same fleet through waitress on a fresh database with the calls of sh/util/initial_setup.py:
+every actor gets a read scope on itself, every user a write scope on every actor, and everybody an open-ended valid
+window.
+"""
+import argparse
+import time
+from typing import Dict, List, Tuple
+
+from app.app import create_app, shutdown_app, db
+from app.models.scope import Mode
+from app.models.user import User, Role
+from app.util.util import generate_api_key, simple_hash_str
+from benchmarks.bench_api import WaitressTarget
+from benchmarks.context.bench_config import Config
+from sh.util import initial_setup
+
+VARIANTS = ['per-item', 'bulk']
+
+
+def fleet(actors: int, users: int, passwords: int) -> Tuple[List[dict], List[dict], List[dict]]:
+    user_items = [{'name': f'actor{i}', 'role': Role.actor.name} for i in range(actors)]
+    user_items += [{'name': f'user{i}', 'role': Role.user.name, 'password': 'secret' if i < passwords else None}
+                   for i in range(users)]
+    scope_items = [{'user-name': f'actor{i}', 'actor-name': f'actor{i}', 'mode': Mode.read.name}
+                   for i in range(actors)]
+    scope_items += [{'user-name': f'user{u}', 'actor-name': f'actor{a}', 'mode': Mode.write.name}
+                    for u in range(users) for a in range(actors)]
+    valid_items = [{'user-name': item['name']} for item in user_items]
+    return user_items, scope_items, valid_items
+
+
+def provision_per_item(url: str, admin_key: str, user_items, scope_items, valid_items) -> int:
+    ids = {}
+    for item in user_items:
+        ids[item['name']] = initial_setup.create_user(url, admin_key, item['name'], Role[item['role']],
+                                                      item.get('password'))['id']
+    for item in scope_items:
+        initial_setup.create_scope(url, admin_key, ids[item['user-name']], ids[item['actor-name']],
+                                   Mode[item['mode']])
+    for item in valid_items:
+        initial_setup.create_valid(url, admin_key, ids[item['user-name']])
+    return len(user_items) + len(scope_items) + len(valid_items)
+
+
+def provision_bulk(url: str, admin_key: str, user_items, scope_items, valid_items) -> int:
+    user_items = [{k: v for k, v in item.items() if v is not None} for item in user_items]
+    initial_setup.provision(url, admin_key, user_items, scope_items, valid_items)
+    return 1
+
+
+def run_variant(variant: str, actors: int, users: int, passwords: int) -> Dict:
+    app = create_app(config_class=Config.get_cls())
+    admin_key = generate_api_key()
+    with app.app_context():
+        User.query.filter_by(name='_builtin_admin').update({'api_key': simple_hash_str(admin_key)})
+        db.session.commit()
+    target = WaitressTarget(app, 1)
+    try:
+        provision_fn = provision_per_item if variant == 'per-item' else provision_bulk
+        ts_start = time.perf_counter()
+        requests_count = provision_fn(target.url, admin_key, *fleet(actors, users, passwords))
+        elapsed = time.perf_counter() - ts_start
+        with app.app_context():
+            rows = db.session.query(User).count()
+    finally:
+        target.close()
+        shutdown_app(app)
+        with app.app_context():
+            db.session.close()
+            db.engine.dispose()
+        Config.TEMP_DIR.cleanup()
+    return {'requests': requests_count, 'seconds': elapsed, 'users': rows}
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--actors', type=int, default=200)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--passwords', type=int, default=10, help='users that get a (bcrypt hashed) password')
+    parser.add_argument('--variant', choices=VARIANTS + ['both'], default='both')
+    args = parser.parse_args(argv)
+
+    print(f'{"variant":<10} {"requests":>9} {"seconds":>9} {"users":>7}')
+    for variant in (VARIANTS if args.variant == 'both' else [args.variant]):
+        r = run_variant(variant, args.actors, args.users, args.passwords)
+        print(f'{variant:<10} {r["requests"]:9d} {r["seconds"]:9.2f} {r["users"]:7d}')
+
+
+if __name__ == '__main__':
+    main()
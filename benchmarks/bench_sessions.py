@@ -0,0 +1,68 @@
+"""Benchmark of the web UI session bookkeeping at a large number of live sessions.
+
+    python -m benchmarks.bench_sessions [sessions]
+
+Compares the SessionStore (heap with lazy expiry, sliding renewal) with the former dict that was rebuilt by
+clean_sessions on every login and open request. The legacy path rebuilds the dict once per operation, so it is only
+run for a small number of operations.
+"""
+import datetime
+import statistics
+import sys
+import time
+import uuid
+from typing import Callable, Dict
+
+from app.util.session_store import SessionStore
+
+TIMEOUT = 300
+
+
+def legacy_clean_sessions(sessions: Dict[uuid.UUID, datetime.datetime]) -> None:
+    return_dict = {}
+    for session_id, timestamp in sessions.items():
+        if (datetime.datetime.now(tz=datetime.timezone.utc) - timestamp) < datetime.timedelta(seconds=TIMEOUT):
+            return_dict[session_id] = timestamp
+    sessions.clear()
+    sessions.update(return_dict)
+
+
+def legacy_register_session(sessions: Dict[uuid.UUID, datetime.datetime], session_id: uuid.UUID) -> None:
+    legacy_clean_sessions(sessions)
+    if session_id not in sessions.keys():
+        sessions[session_id] = datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+def median_us(fn: Callable[[], object], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        ts_start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - ts_start)
+    return statistics.median(timings) * 1_000_000
+
+
+def main(count: int = 100_000) -> None:
+    session_ids = [uuid.uuid4() for _ in range(count)]
+
+    store = SessionStore(ttl=TIMEOUT, maxsize=count)
+    ts_start = time.perf_counter()
+    for session_id in session_ids:
+        store.add(session_id)
+    fill_s = time.perf_counter() - ts_start
+    register_us = median_us(lambda: store.add(uuid.uuid4()), repeat=10_000)
+    touch_us = median_us(lambda: store.touch(session_ids[-1]), repeat=10_000)
+
+    legacy = {session_id: datetime.datetime.now(tz=datetime.timezone.utc) for session_id in session_ids}
+    legacy_register_ms = median_us(lambda: legacy_register_session(legacy, uuid.uuid4()), repeat=5) / 1000
+    legacy_lookup_ms = median_us(lambda: (legacy_clean_sessions(legacy), session_ids[-1] in legacy), repeat=5) / 1000
+
+    print(f'sessions: {count}, store fill: {fill_s:.3f} s')
+    print(f'{"":>10} {"store [us]":>12} {"legacy [ms]":>12}')
+    print(f'{"register":>10} {register_us:12.2f} {legacy_register_ms:12.3f}')
+    print(f'{"open":>10} {touch_us:12.2f} {legacy_lookup_ms:12.3f}')
+    print(f'store stats: {store.stats()}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
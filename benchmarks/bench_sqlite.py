@@ -0,0 +1,77 @@
+"""Concurrency benchmark of the sqlite connection profile: many getState pollers and setState writers at once.
+
+    python -m benchmarks.bench_sqlite --pollers 32 --writers 8 --requests 2000
+
+Every profile is run against a fresh database served by waitress, with the usage write-behind disabled so that
+every getState writes its heartbeat row (the contention the profile is meant for). "rollback" is sqlite's default
+(rollback journal, synchronous=FULL), "tuned" is the default profile of config.py.
+"""
+import argparse
+import threading
+from typing import Dict
+
+from app.app import create_app, shutdown_app, db
+from app.util.sqlite_profile import DEFAULT_SQLITE_PRAGMAS
+from benchmarks.bench_api import WaitressTarget, scenarios
+from benchmarks.context.bench_config import Config
+from benchmarks.fixtures import set_up_dataset
+from benchmarks.runner import run_load
+
+PROFILES = {'rollback': {'journal_mode': 'DELETE', 'synchronous': 'FULL'},
+            'tuned': DEFAULT_SQLITE_PRAGMAS}
+
+
+def run_profile(pragmas: Dict, users: int, actors: int, pollers: int, writers: int, requests_count: int) -> Dict:
+    config = type('BenchSqliteConfig', (Config.get_cls(),), {'SQLITE_PRAGMAS': pragmas, 'USAGE_WRITE_BEHIND': False})
+    app = create_app(config_class=config)
+    dataset = set_up_dataset(app, users, actors, 1, 0, 0)
+    target = WaitressTarget(app, pollers + writers)
+    results = {}
+    try:
+        request_fns = scenarios(dataset, target)
+
+        def poll(thread_index: int, request_index: int) -> bool:
+            return request_fns['getState'](thread_index, request_index)
+
+        def write(thread_index: int, request_index: int) -> bool:
+            return request_fns['setState'](pollers + thread_index, request_index)
+
+        def load(name, request_fn, threads):
+            results[name] = run_load(request_fn, requests_count, threads)
+
+        load_threads = [threading.Thread(target=load, args=('getState', poll, pollers)),
+                        threading.Thread(target=load, args=('setState', write, writers))]
+        for thread in load_threads:
+            thread.start()
+        for thread in load_threads:
+            thread.join()
+    finally:
+        target.close()
+        shutdown_app(app)
+        with app.app_context():
+            db.session.close()
+            db.engine.dispose()
+        Config.TEMP_DIR.cleanup()
+    return results
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--actors', type=int, default=20)
+    parser.add_argument('--pollers', type=int, default=32)
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000, help='requests per role and profile')
+    parser.add_argument('--profile', choices=list(PROFILES) + ['both'], default='both')
+    args = parser.parse_args(argv)
+
+    print(f'{"profile":<10} {"role":<10} {"rps":>9} {"p50 [ms]":>9} {"p99 [ms]":>9} {"max [ms]":>9} {"errors":>7}')
+    for name in (PROFILES if args.profile == 'both' else [args.profile]):
+        results = run_profile(PROFILES[name], args.users, args.actors, args.pollers, args.writers, args.requests)
+        for role, r in results.items():
+            print(f'{name:<10} {role:<10} {r["throughput_rps"]:9.1f} {r["p50_ms"]:9.2f} {r["p99_ms"]:9.2f} '
+                  f'{r["max_ms"]:9.2f} {r["errors"]:7d}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Usage reporting: daily counters per user, actor and type from the rollup table against a scan of the raw rows.
+
+    python -m benchmarks.bench_usage --rows 1000000 --days 30
+
+Inserts setState/getState_true rows spread over the given number of days, rolls them up once (timed; rows are the
+hourly buckets) and compares a daily report from the rollups with the equivalent GROUP BY over the raw usage table.
+"""
+import argparse
+import datetime
+import time
+import uuid
+from typing import Dict
+
+from sqlalchemy import select, func
+
+from app.app import create_app, shutdown_app, db
+from app.api.func import rollup_usage, usage_report, naive_utc
+from app.models.usage import Usage, Type
+from app.models.usage_rollup import Period
+from app.util.util import now
+from benchmarks.context.bench_config import Config
+from benchmarks.fixtures import set_up_dataset, bulk_insert
+
+
+def insert_usage(dataset, rows: int, days: int) -> None:
+    ts_now = now()
+    step = days * 24 * 3600 / max(rows, 1)
+    bulk_insert(Usage, [{'id': uuid.uuid4(), 'user_id': dataset.users[i % len(dataset.users)][0],
+                         'actor_id': dataset.actors[i % len(dataset.actors)][0],
+                         'type': Type.setState if i % 3 else Type.getState_true,
+                         'timestamp': ts_now - datetime.timedelta(seconds=3600 + i * step),
+                         'created_at': ts_now, 'updated_at': ts_now} for i in range(rows)])
+
+
+def raw_daily_report(start: datetime.datetime) -> list:
+    day = func.date(Usage.timestamp)
+    query = (select(day, Usage.user_id, Usage.actor_id, Usage.type, func.count())
+             .where(Usage.type.in_([Type.setState, Type.getState_true]), Usage.timestamp >= naive_utc(start))
+             .group_by(day, Usage.user_id, Usage.actor_id, Usage.type))
+    return db.session.execute(query).all()
+
+
+def run(rows: int, days: int, users: int, actors: int) -> Dict:
+    app = create_app(config_class=Config.get_cls())
+    dataset = set_up_dataset(app, users=users, actors=actors)
+    results = {}
+    try:
+        with app.app_context():
+            insert_usage(dataset, rows, days)
+            ts_start = time.perf_counter()
+            rolled_up = rollup_usage()
+            results['rollup'] = {'seconds': time.perf_counter() - ts_start, 'rows': rolled_up['hour']}
+            start = now() - datetime.timedelta(days=days + 1)
+            for name, report in [('raw', lambda: raw_daily_report(start)),
+                                 ('rollup report', lambda: usage_report(Period.day, start))]:
+                ts_start = time.perf_counter()
+                report_rows = report()
+                results[name] = {'seconds': time.perf_counter() - ts_start, 'rows': len(report_rows)}
+    finally:
+        shutdown_app(app)
+        with app.app_context():
+            db.session.close()
+            db.engine.dispose()
+        Config.TEMP_DIR.cleanup()
+    return results
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--actors', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    results = run(args.rows, args.days, args.users, args.actors)
+    print(f'{"step":<14} {"seconds":>9} {"rows":>9}')
+    for name, r in results.items():
+        print(f'{name:<14} {r["seconds"]:9.3f} {r["rows"]:9d}')
+
+
+if __name__ == '__main__':
+    main()
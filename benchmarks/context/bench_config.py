@@ -0,0 +1,21 @@
+import os
+import secrets
+import tempfile
+from pathlib import Path
+
+
+class Config:
+    SECRET_KEY: str = os.environ.get('SECRET_KEY') or secrets.token_hex()
+    SQLALCHEMY_TRACK_MODIFICATIONS: bool = False
+    TEMP_DIR: tempfile.TemporaryDirectory = tempfile.TemporaryDirectory()
+    SQLALCHEMY_DATABASE_URI: str = 'sqlite:///' + os.path.join(TEMP_DIR.name, 'bench.sqlite')
+    FILES_DIR: Path = Path(TEMP_DIR.name)
+    REQUEST_LOG_FILE: str = os.path.join(TEMP_DIR.name, 'app.log')
+
+    @classmethod
+    def get_cls(cls):
+        cls.TEMP_DIR: tempfile.TemporaryDirectory = tempfile.TemporaryDirectory()
+        cls.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(cls.TEMP_DIR.name, 'bench.sqlite')
+        cls.REQUEST_LOG_FILE = os.path.join(cls.TEMP_DIR.name, 'app.log')
+        cls.FILES_DIR = Path(cls.TEMP_DIR.name)
+        return cls
@@ -0,0 +1,86 @@
+import datetime
+import uuid
+from typing import Dict, List, NamedTuple, Tuple
+
+import flask
+from sqlalchemy import insert
+
+from app.app import db
+from app.models.scope import Scope, Mode
+from app.models.state import State
+from app.models.user import User, Role
+from app.models.valid import Valid
+from app.util.util import generate_api_key, simple_hash_str, now
+
+CHUNK_SIZE = 50_000
+
+
+class Dataset(NamedTuple):
+    # (user_id, raw api key)
+    actors: List[Tuple[uuid.UUID, str]]
+    users: List[Tuple[uuid.UUID, str]]
+    # (user_id, actor_id) pairs with write scope
+    write_scopes: List[Tuple[uuid.UUID, uuid.UUID]]
+    users_by_id: Dict[uuid.UUID, str]
+
+
+def bulk_insert(model, rows: List[dict]) -> None:
+    for offset in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(insert(model), rows[offset:offset + CHUNK_SIZE])
+        db.session.commit()
+
+
+def insert_expired_states(actor_ids: List[uuid.UUID], count: int) -> None:
+    """ inserts count expired 10-second State windows round-robin over actor_ids, ending one minute ago and
+    earlier """
+    ts_last = now() - datetime.timedelta(minutes=1)
+    for offset in range(0, count, CHUNK_SIZE):
+        rows = []
+        for i in range(offset, min(offset + CHUNK_SIZE, count)):
+            end = ts_last - datetime.timedelta(seconds=15 * (i // len(actor_ids)))
+            rows.append({'id': uuid.uuid4(), 'user_id': actor_ids[i % len(actor_ids)],
+                         'begin': end - datetime.timedelta(seconds=10), 'end': end, 'created_at': end,
+                         'updated_at': end})
+        bulk_insert(State, rows)
+
+
+def set_up_dataset(app: flask.app.Flask, users: int, actors: int, scopes_per_user: int = 1, valid_rows: int = 0,
+                   state_rows: int = 0) -> Dataset:
+    """ seeds users and actors with read scopes on themselves and open-ended validity, each user gets write scopes on
+    scopes_per_user actors; valid_rows and state_rows add expired history on top """
+    ts_now = now()
+    created_updated_dict = {'created_at': ts_now, 'updated_at': ts_now}
+    actor_list = [(uuid.uuid4(), generate_api_key()) for _ in range(actors)]
+    user_list = [(uuid.uuid4(), generate_api_key()) for _ in range(users)]
+
+    user_rows = [{'id': actor_id, 'name': f'bench_actor_{i}', 'role': Role.actor, 'api_key': simple_hash_str(key),
+                  **created_updated_dict} for i, (actor_id, key) in enumerate(actor_list)]
+    user_rows += [{'id': user_id, 'name': f'bench_user_{i}', 'role': Role.user, 'api_key': simple_hash_str(key),
+                   **created_updated_dict} for i, (user_id, key) in enumerate(user_list)]
+
+    scope_rows = [{'id': uuid.uuid4(), 'user_id': actor_id, 'actor_id': actor_id, 'mode': Mode.read,
+                   **created_updated_dict} for actor_id, _ in actor_list]
+    write_scopes = []
+    for i, (user_id, _) in enumerate(user_list):
+        for j in range(min(scopes_per_user, actors)):
+            actor_id = actor_list[(i + j) % actors][0]
+            write_scopes.append((user_id, actor_id))
+            scope_rows.append({'id': uuid.uuid4(), 'user_id': user_id, 'actor_id': actor_id, 'mode': Mode.write,
+                               **created_updated_dict})
+
+    all_ids = [row['id'] for row in user_rows]
+    valid_list = [{'id': uuid.uuid4(), 'user_id': user_id, 'start': None, 'end': None, **created_updated_dict}
+                  for user_id in all_ids]
+    ts_expired = ts_now - datetime.timedelta(days=1)
+    valid_list += [{'id': uuid.uuid4(), 'user_id': all_ids[i % len(all_ids)], 'start': None, 'end': ts_expired,
+                    **created_updated_dict} for i in range(valid_rows)]
+
+    with app.app_context():
+        bulk_insert(User, user_rows)
+        bulk_insert(Scope, scope_rows)
+        bulk_insert(Valid, valid_list)
+        if state_rows:
+            insert_expired_states([actor_id for actor_id, _ in actor_list], state_rows)
+
+    return Dataset(actors=actor_list, users=user_list, write_scopes=write_scopes,
+                   users_by_id={user_id: key for user_id, key in actor_list + user_list})
@@ -0,0 +1,66 @@
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+@contextmanager
+def statement_counter(engine: Engine) -> Iterator[List[int]]:
+    """ counts the statements executed on engine by all threads, the count is held in the yielded one-element list """
+    count = [0]
+    lock = threading.Lock()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        with lock:
+            count[0] += 1
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield count
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def run_load(request_fn: Callable[[int, int], bool], requests: int, threads: int) -> Dict[str, float]:
+    """ calls request_fn(thread_index, request_index) requests times spread over threads worker threads;
+    request_fn returns whether the request succeeded """
+    latencies: List[List[float]] = [[] for _ in range(threads)]
+    errors = [0] * threads
+
+    def worker(thread_index: int) -> None:
+        for request_index in range(thread_index, requests, threads):
+            ts_start = time.perf_counter()
+            ok = request_fn(thread_index, request_index)
+            latencies[thread_index].append(time.perf_counter() - ts_start)
+            if not ok:
+                errors[thread_index] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    ts_start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    duration = time.perf_counter() - ts_start
+    return summarize([latency for thread_latencies in latencies for latency in thread_latencies], duration,
+                     sum(errors))
+
+
+def summarize(latencies: List[float], duration: float, errors: int = 0) -> Dict[str, float]:
+    sorted_ms = sorted(latency * 1000 for latency in latencies)
+    return {'requests': len(sorted_ms), 'errors': errors, 'duration_s': duration,
+            'throughput_rps': len(sorted_ms) / duration if duration > 0 else float('nan'),
+            'mean_ms': statistics.fmean(sorted_ms) if sorted_ms else float('nan'),
+            'p50_ms': percentile(sorted_ms, 0.50), 'p95_ms': percentile(sorted_ms, 0.95),
+            'p99_ms': percentile(sorted_ms, 0.99), 'max_ms': sorted_ms[-1] if sorted_ms else float('nan')}
@@ -1,11 +1,97 @@
 import os
 from pathlib import Path
 
+from sqlalchemy.engine import make_url
+
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 
+def engine_options(database_uri: str) -> dict:
+    """ connection pool sizing for file-backed databases; in-memory sqlite uses a SingletonThreadPool/StaticPool,
+    which takes none of these options """
+    url = make_url(database_uri)
+    if url.get_backend_name() == 'sqlite' and (url.database in (None, '', ':memory:')
+                                               or url.query.get('mode') == 'memory'):
+        return {}
+    return {'pool_size': int(os.environ.get('DB_POOL_SIZE') or 8),
+            'max_overflow': int(os.environ.get('DB_POOL_MAX_OVERFLOW') or 16),
+            'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT') or 10)}
+
+
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY')
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URI') or 'sqlite:///' + os.path.join(basedir, 'db', 'app.sqlite')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+    # applied to every new sqlite connection, see app/util/sqlite_profile.py
+    SQLITE_PRAGMAS = {'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE') or 'WAL',
+                      'synchronous': os.environ.get('SQLITE_SYNCHRONOUS') or 'NORMAL',
+                      'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000),
+                      'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE') or -20_000),
+                      'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE') or 256 << 20),
+                      'temp_store': os.environ.get('SQLITE_TEMP_STORE') or 'MEMORY'}
     FILES_DIR = Path('./data')
+    PRINCIPAL_CACHE_SIZE = int(os.environ.get('PRINCIPAL_CACHE_SIZE') or 1024)
+    PRINCIPAL_CACHE_TTL = float(os.environ.get('PRINCIPAL_CACHE_TTL') or 30)
+    # results of bcrypt password checks, keyed by an hmac of password and hash
+    VERIFICATION_CACHE_SIZE = int(os.environ.get('VERIFICATION_CACHE_SIZE') or 1024)
+    VERIFICATION_CACHE_TTL = float(os.environ.get('VERIFICATION_CACHE_TTL') or 300)
+    # password hashing/verification runs on a bounded pool; logins beyond workers + pending are rejected
+    BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS') or 2)
+    BCRYPT_MAX_PENDING = int(os.environ.get('BCRYPT_MAX_PENDING') or 16)
+    BCRYPT_TIMEOUT = float(os.environ.get('BCRYPT_TIMEOUT') or 5)
+    # upper bound on users + scopes + valid windows in one /api/provision request
+    PROVISION_MAX_ITEMS = int(os.environ.get('PROVISION_MAX_ITEMS') or 10_000)
+    SESSION_TTL = float(os.environ.get('SESSION_TTL') or 300)
+    SESSION_MAX_SIZE = int(os.environ.get('SESSION_MAX_SIZE') or 100_000)
+    # number of worker processes; with more than one, sessions, state changes, cache invalidations and metrics are
+    # shared between the workers through the database
+    WORKERS = int(os.environ.get('WORKERS') or 1)
+    SHARED_STATE = (os.environ.get('SHARED_STATE') or str(WORKERS > 1)).lower() == 'true'
+    # retention and housekeeping jobs; with several workers they run in worker 0 only
+    MAINTENANCE_JOBS = (os.environ.get('MAINTENANCE_JOBS') or 'true').lower() == 'true'
+    SHARED_STATE_POLL_INTERVAL = float(os.environ.get('SHARED_STATE_POLL_INTERVAL') or 0.5)
+    SHARED_STATE_EVENT_RETENTION = float(os.environ.get('SHARED_STATE_EVENT_RETENTION') or 3600)
+    SHARED_STATE_WORKER_TIMEOUT = float(os.environ.get('SHARED_STATE_WORKER_TIMEOUT') or 60)
+    GET_STATES_MAX_ACTORS = int(os.environ.get('GET_STATES_MAX_ACTORS') or 64)
+    LONG_POLL_MAX_WAIT = float(os.environ.get('LONG_POLL_MAX_WAIT') or 30)
+    # every waiting long-poll holds a waitress thread; beyond LONG_POLL_MAX_WAITERS waiting requests, getState answers
+    # right away, so that the remaining threads serve everything else
+    WAITRESS_THREADS = int(os.environ.get('WAITRESS_THREADS') or 16)
+    LONG_POLL_MAX_WAITERS = int(os.environ.get('LONG_POLL_MAX_WAITERS') or max(WAITRESS_THREADS - 4, 0))
+    STREAM_KEEPALIVE = float(os.environ.get('STREAM_KEEPALIVE') or 15)
+    USAGE_WRITE_BEHIND = (os.environ.get('USAGE_WRITE_BEHIND') or 'true').lower() == 'true'
+    USAGE_FLUSH_SIZE = int(os.environ.get('USAGE_FLUSH_SIZE') or 500)
+    USAGE_FLUSH_INTERVAL = float(os.environ.get('USAGE_FLUSH_INTERVAL') or 1)
+    STATE_RETENTION_HORIZON = float(os.environ.get('STATE_RETENTION_HORIZON') or 7 * 24 * 3600)
+    STATE_RETENTION_INTERVAL = float(os.environ.get('STATE_RETENTION_INTERVAL') or 3600)
+    STATE_RETENTION_ARCHIVE = (os.environ.get('STATE_RETENTION_ARCHIVE') or 'true').lower() == 'true'
+    # raw usage rows are rolled up into hourly/daily counters once their hour has ended USAGE_ROLLUP_LAG seconds
+    # ago, the hours of the last USAGE_ROLLUP_WINDOW seconds before are counted again to include rows written late,
+    # and moved to the archive table of their month, usage_archive_YYYYMM (or deleted), USAGE_RETENTION_HORIZON
+    # seconds after their timestamp; archive tables are dropped USAGE_ARCHIVE_RETENTION seconds after their month
+    # (0 keeps them)
+    USAGE_ROLLUP_LAG = float(os.environ.get('USAGE_ROLLUP_LAG') or 300)
+    USAGE_ROLLUP_WINDOW = float(os.environ.get('USAGE_ROLLUP_WINDOW') or 24 * 3600)
+    USAGE_RETENTION_HORIZON = float(os.environ.get('USAGE_RETENTION_HORIZON') or 30 * 24 * 3600)
+    USAGE_RETENTION_INTERVAL = float(os.environ.get('USAGE_RETENTION_INTERVAL') or 3600)
+    USAGE_RETENTION_ARCHIVE = (os.environ.get('USAGE_RETENTION_ARCHIVE') or 'true').lower() == 'true'
+    USAGE_ARCHIVE_RETENTION = float(os.environ.get('USAGE_ARCHIVE_RETENTION') or 365 * 24 * 3600)
+    USAGE_REPORT_MAX_ROWS = int(os.environ.get('USAGE_REPORT_MAX_ROWS') or 10_000)
+    EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE') or 5000)
+    WEBHOOKS = (os.environ.get('WEBHOOKS') or 'true').lower() == 'true'
+    WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS') or 4)
+    WEBHOOK_MAX_PER_TARGET = int(os.environ.get('WEBHOOK_MAX_PER_TARGET') or 2)
+    WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS') or 5)
+    WEBHOOK_RETRY_BASE = float(os.environ.get('WEBHOOK_RETRY_BASE') or 1)
+    WEBHOOK_TIMEOUT = float(os.environ.get('WEBHOOK_TIMEOUT') or 5)
+    WEBHOOK_MAX_PENDING = int(os.environ.get('WEBHOOK_MAX_PENDING') or 10_000)
+    # callbacks to loopback, private, link-local or other non-public addresses are refused, except for these hosts
+    # (comma separated host names or ip addresses, as written in the callback url)
+    WEBHOOK_ALLOWED_HOSTS = {host.strip().lower() for host in (os.environ.get('WEBHOOK_ALLOWED_HOSTS') or '').split(',')
+                             if host.strip()}
+    REQUEST_LOG_FILE = os.environ.get('REQUEST_LOG_FILE') or 'app.log'
+    REQUEST_LOG_MAX_BYTES = int(os.environ.get('REQUEST_LOG_MAX_BYTES') or 10 << 20)
+    REQUEST_LOG_BACKUP_COUNT = int(os.environ.get('REQUEST_LOG_BACKUP_COUNT') or 5)
+    # fraction of requests that are logged, per endpoint; endpoints not listed are always logged
+    REQUEST_LOG_SAMPLING = {'api.get_door_state': float(os.environ.get('REQUEST_LOG_SAMPLING_GETSTATE') or 0.01)}
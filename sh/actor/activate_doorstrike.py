@@ -1,18 +1,12 @@
 import sys
-import time
-import RPi.GPIO as GPIO
 
-DOORSTRIKE = 17
+from sh.actor.gpio import DoorStrike, RPiGpio
 
 
 def main():
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setwarnings(False)
-    GPIO.setup(DOORSTRIKE, GPIO.OUT)
-    GPIO.output(DOORSTRIKE, 0)
-    time.sleep(6)
-    GPIO.output(DOORSTRIKE, 1)
-    time.sleep(4)
+    """ one pulse by hand; the actor daemon (sh.actor.daemon) keeps the pin set up and pulses it in-process """
+    gpio = RPiGpio()
+    DoorStrike(gpio).activate()
     sys.exit(0)
 
 
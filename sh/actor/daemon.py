@@ -0,0 +1,140 @@
+import datetime
+import logging
+import os
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import Callable, Optional
+
+import requests
+
+from sh.actor.gpio import DoorStrike, DOORSTRIKE, create_gpio
+
+SMTP_SEND = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'util', 'smtp_send.py')
+
+logger = logging.getLogger('doorOpener.actor')
+
+
+def mail_notify(subject: str, content: str) -> None:
+    """ sends the mail with sh/util/smtp_send.py in the background, polling goes on meanwhile """
+    threading.Thread(target=subprocess.run, args=([sys.executable, SMTP_SEND, subject, content],),
+                     daemon=True).start()
+
+
+class ActorDaemon:
+    """ polls getState of one actor over a keep-alive session and pulses the strike while the state is true. With
+    wait > 0 every poll is a long poll that the server answers as soon as the state changes (each one holds a server
+    thread under waitress, so use it with app.asgi or a large WAITRESS_THREADS), otherwise polls are interval seconds
+    apart; failed polls back off exponentially with jitter up to backoff_max """
+
+    def __init__(self, url: str, api_key: str, actor_id: str, strike: DoorStrike, actor_name: str = '',
+                 wait: float = 0, interval: float = 1, backoff_max: float = 60, connect_timeout: float = 3,
+                 notify: Optional[Callable[[str, str], None]] = None, notify_after: int = 50):
+        self.url = url.rstrip('/')
+        self.params = {'api-key': api_key, 'actor-id': actor_id}
+        if wait > 0:
+            self.params['wait'] = wait
+        self.actor_id = actor_id
+        self.actor_name = actor_name
+        self.strike = strike
+        self.wait = wait
+        self.interval = interval
+        self.backoff_max = backoff_max
+        # the server may hold a long poll for the whole wait
+        self.timeout = (connect_timeout, wait + 10)
+        self.notify = notify if notify is not None else mail_notify
+        self.notify_after = notify_after
+        self.session = requests.Session()
+        self.stop_event = threading.Event()
+        self.polls = 0
+        self.activations = 0
+        # errors counts all failed polls (as run_curl_loop.sh did), consecutive_errors drives the backoff
+        self.errors = 0
+        self.consecutive_errors = 0
+
+    def poll(self) -> Optional[bool]:
+        """ the state of the actor, None on any error """
+        self.polls += 1
+        try:
+            response = self.session.get(self.url + '/api/getState', params=self.params, timeout=self.timeout)
+            if response.status_code != 200:
+                logger.warning(f'getState: {response.status_code} {response.text[:200]}')
+                return None
+            return response.json()['state'] is True
+        except requests.RequestException as e:
+            logger.warning(f'getState: {e}')
+        except (ValueError, KeyError, TypeError):
+            logger.warning('getState: unexpected response')
+        return None
+
+    def backoff(self) -> float:
+        return min(self.backoff_max, self.interval * 2 ** min(self.consecutive_errors, 16)) * random.uniform(0.5, 1)
+
+    def timestamp(self) -> str:
+        return datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+
+    def run_once(self) -> None:
+        ts_start = time.monotonic()
+        state = self.poll()
+        if state is None:
+            self.errors += 1
+            self.consecutive_errors += 1
+            if self.errors % self.notify_after == 0:
+                self.notify(f'SERVER Error: {self.actor_name} poll error no. {self.errors}',
+                            f'ACTOR_ID: {self.actor_id} TIMESTAMP: {self.timestamp()}')
+            self.stop_event.wait(self.backoff())
+            return
+        self.consecutive_errors = 0
+        if state:
+            self.activations += 1
+            logger.info('activated')
+            self.notify(f'ACTOR info: {self.actor_name} activated', f'ACTOR_ID: {self.actor_id} TIMESTAMP: '
+                                                                     f'{self.timestamp()}')
+            self.strike.activate(self.stop_event)
+            return
+        # a long poll that came back early (server restart, no long-poll support) must not turn into a busy loop
+        elapsed = time.monotonic() - ts_start
+        if elapsed < self.interval:
+            self.stop_event.wait((self.interval - elapsed) * random.uniform(0.5, 1))
+
+    def run(self) -> None:
+        logger.info(f'polling {self.url} for actor {self.actor_id} (wait={self.wait})')
+        try:
+            while not self.stop_event.is_set():
+                self.run_once()
+        finally:
+            self.session.close()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+
+def daemon_from_env() -> ActorDaemon:
+    """ configuration from the environment (see .env_actor_example) """
+    gpio = create_gpio(os.environ.get('GPIO_BACKEND') or 'rpi')
+    strike = DoorStrike(gpio, pin=int(os.environ.get('DOORSTRIKE_PIN') or DOORSTRIKE))
+    return ActorDaemon(os.environ['URL'], os.environ['APIKEY'], os.environ['ACTORID'], strike,
+                       actor_name=os.environ.get('ACTORNAME') or '',
+                       wait=float(os.environ.get('WAIT') or 0),
+                       interval=float(os.environ.get('POLL_INTERVAL') or 1),
+                       backoff_max=float(os.environ.get('BACKOFF_MAX') or 60),
+                       notify_after=int(os.environ.get('NOTIFYAFTER') or 50))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    daemon = daemon_from_env()
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        daemon.stop()
+    finally:
+        daemon.strike.gpio.cleanup()
+
+
+if __name__ == '__main__':
+    main()
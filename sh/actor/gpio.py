@@ -0,0 +1,82 @@
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+DOORSTRIKE = 17
+LOW = 0
+HIGH = 1
+
+
+class SimulatedGpio:
+    """ keeps the pin levels in memory instead of driving hardware, for tests and machines without GPIO """
+
+    def __init__(self):
+        self.levels: Dict[int, int] = {}
+        # (time.monotonic(), pin, level) of every output call
+        self.history: List[Tuple[float, int, int]] = []
+        self._lock = threading.Lock()
+
+    def setup_output(self, pin: int, level: int) -> None:
+        with self._lock:
+            self.levels[pin] = level
+
+    def output(self, pin: int, level: int) -> None:
+        with self._lock:
+            if pin not in self.levels:
+                raise RuntimeError(f'pin {pin} is not set up as output')
+            self.levels[pin] = level
+            self.history.append((time.monotonic(), pin, level))
+
+    def cleanup(self) -> None:
+        with self._lock:
+            self.levels.clear()
+
+
+class RPiGpio:
+    """ RPi.GPIO in BCM numbering; the module is only imported here, so the daemon runs without it """
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+        self.gpio = GPIO
+
+    def setup_output(self, pin: int, level: int) -> None:
+        self.gpio.setup(pin, self.gpio.OUT, initial=level)
+
+    def output(self, pin: int, level: int) -> None:
+        self.gpio.output(pin, level)
+
+    def cleanup(self) -> None:
+        self.gpio.cleanup()
+
+
+GPIO_BACKENDS = {'rpi': RPiGpio, 'simulated': SimulatedGpio}
+
+
+def create_gpio(backend: str):
+    if backend not in GPIO_BACKENDS:
+        raise ValueError(f'unknown gpio backend: {backend}')
+    return GPIO_BACKENDS[backend]()
+
+
+class DoorStrike:
+    """ the pin is set up once; activate pulls it low for open_seconds and then keeps it high for holdoff_seconds,
+    the timing of the former activate_doorstrike.py """
+
+    def __init__(self, gpio, pin: int = DOORSTRIKE, open_seconds: float = 6, holdoff_seconds: float = 4):
+        self.gpio = gpio
+        self.pin = pin
+        self.open_seconds = open_seconds
+        self.holdoff_seconds = holdoff_seconds
+        self.gpio.setup_output(self.pin, HIGH)
+
+    def activate(self, stop_event: Optional[threading.Event] = None) -> None:
+        """ blocks for the pulse; a set stop_event cuts the waits short, the strike is released in any case """
+        stop_event = stop_event if stop_event is not None else threading.Event()
+        self.gpio.output(self.pin, LOW)
+        try:
+            stop_event.wait(self.open_seconds)
+        finally:
+            self.gpio.output(self.pin, HIGH)
+        stop_event.wait(self.holdoff_seconds)
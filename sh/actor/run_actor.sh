@@ -0,0 +1,10 @@
+#!/bin/bash
+set -a
+source /etc/doorOpener/.env_actor
+source /etc/doorOpener/.env_mail
+set +a
+
+source $SOURCEPATH/.venv/bin/activate
+
+cd $SOURCEPATH
+exec python3 -m sh.actor.daemon
@@ -26,6 +26,12 @@ def create_valid(url: str, api_key: str, user_id: str):
     return response.json()
 
 
+def provision(url: str, api_key: str, users: list, scopes: list, valid: list):
+    data = {'api-key': api_key, 'users': users, 'scopes': scopes, 'valid': valid}
+    response = requests.post(url + '/api/provision', json=data)
+    return response.json()
+
+
 def get_state(url: str, api_key: str, actor_id: str):
     data = {'api-key': api_key, 'actor-id': actor_id}
     response = requests.get(url + '/api/getState', params=data)
@@ -39,20 +45,15 @@ def set_state(url: str, api_key: str, actor_id: str):
 
 
 def main(url: str, admin_api: str, maintenance_api: str):
-    actor_data_1 = create_user(url, admin_api, 'actor1', Role.actor, None)
-    actor_data_2 = create_user(url, admin_api, 'actor2', Role.actor, None)
-
-    user_data_1 = create_user(url, admin_api, 'user1', Role.user, 'nfr21party')
-
-    scope_data_1 = create_scope(url, admin_api, user_data_1['id'], actor_data_1['id'], Mode.write)
-    scope_data_2 = create_scope(url, admin_api, user_data_1['id'], actor_data_2['id'], Mode.write)
-
-    scope_data_3 = create_scope(url, admin_api, actor_data_1['id'], actor_data_1['id'], Mode.read)
-    scope_data_4 = create_scope(url, admin_api, actor_data_2['id'], actor_data_2['id'], Mode.read)
-
-    valid_data_1 = create_valid(url, admin_api, user_data_1['id'])
-    valid_data_3 = create_valid(url, admin_api, actor_data_1['id'])
-    valid_data_4 = create_valid(url, admin_api, actor_data_2['id'])
+    users = [{'name': 'actor1', 'role': Role.actor.name}, {'name': 'actor2', 'role': Role.actor.name},
+             {'name': 'user1', 'role': Role.user.name, 'password': 'nfr21party'}]
+    scopes = [{'user-name': 'user1', 'actor-name': 'actor1', 'mode': Mode.write.name},
+              {'user-name': 'user1', 'actor-name': 'actor2', 'mode': Mode.write.name},
+              {'user-name': 'actor1', 'actor-name': 'actor1', 'mode': Mode.read.name},
+              {'user-name': 'actor2', 'actor-name': 'actor2', 'mode': Mode.read.name}]
+    valid = [{'user-name': 'user1'}, {'user-name': 'actor1'}, {'user-name': 'actor2'}]
+    provision_data = provision(url, admin_api, users, scopes, valid)
+    actor_data_1, actor_data_2, user_data_1 = provision_data['users']
 
     get_state_actor1 = get_state(url, actor_data_1['api_key'], actor_data_1['id'])
     set_state_actor1 = set_state(url, user_data_1['api_key'], actor_data_1['id'])
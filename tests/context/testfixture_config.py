@@ -11,9 +11,13 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS: bool = False
     TEMP_DIR: tempfile.TemporaryDirectory = tempfile.TemporaryDirectory()
     FILES_DIR: Path = Path(TEMP_DIR.name)
+    REQUEST_LOG_FILE: str = os.path.join(TEMP_DIR.name, 'app.log')
+    # the stand-in callback receiver of the tests
+    WEBHOOK_ALLOWED_HOSTS = {'127.0.0.1'}
 
     @classmethod
     def get_cls(cls):
         cls.TEMP_DIR: tempfile.TemporaryDirectory = tempfile.TemporaryDirectory()
         cls.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(cls.TEMP_DIR.name, 'test.sqlite')
+        cls.REQUEST_LOG_FILE = os.path.join(cls.TEMP_DIR.name, 'app.log')
         return cls
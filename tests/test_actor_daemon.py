@@ -0,0 +1,121 @@
+import secrets
+import threading
+import time
+from unittest import TestCase
+
+import waitress
+
+from app.app import create_app, shutdown_app, db
+from app.api.func import set_state
+from sh.actor.daemon import ActorDaemon
+from sh.actor.gpio import SimulatedGpio, DoorStrike, DOORSTRIKE, HIGH, LOW, create_gpio
+
+from tests.context.testfixture_config import Config
+from tests.test_fns import (TS_11_00_00, set_up_users, set_up_valid, set_up_scope, ACTOR0002_USER_ID, ACTOR0002_KEY,
+                            USER0002_USER_ID)
+
+
+def wait_for(condition, timeout: float = 10) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestDoorStrike(TestCase):
+    def test_activate(self):
+        gpio = SimulatedGpio()
+        strike = DoorStrike(gpio, open_seconds=0.05, holdoff_seconds=0.05)
+        self.assertEqual({DOORSTRIKE: HIGH}, gpio.levels)
+        ts_start = time.monotonic()
+        strike.activate()
+        self.assertGreaterEqual(time.monotonic() - ts_start, 0.1)
+        self.assertEqual([LOW, HIGH], [level for _, _, level in gpio.history])
+        self.assertGreaterEqual(gpio.history[1][0] - gpio.history[0][0], 0.05)
+
+        # a stop cuts the pulse short but releases the strike
+        stop_event = threading.Event()
+        stop_event.set()
+        DoorStrike(gpio, open_seconds=10, holdoff_seconds=10).activate(stop_event)
+        self.assertEqual(HIGH, gpio.levels[DOORSTRIKE])
+
+        self.assertRaises(RuntimeError, SimulatedGpio().output, DOORSTRIKE, LOW)
+        self.assertRaises(ValueError, create_gpio, 'parallel port')
+
+
+class TestActorDaemon(TestCase):
+    def setUp(self):
+        config = Config.get_cls()
+        config.SECRET_KEY = secrets.token_hex()
+        self.app = create_app(config_class=config)
+        set_up_users(self.app, TS_11_00_00)
+        set_up_valid(self.app, TS_11_00_00)
+        set_up_scope(self.app, TS_11_00_00)
+        self.server = waitress.create_server(self.app, host='127.0.0.1', port=0)
+        self.url = f'http://127.0.0.1:{self.server.effective_port}'
+        self.server_thread = threading.Thread(target=self.server.run, daemon=True)
+        self.server_thread.start()
+        self.notifications = []
+
+    def tearDown(self):
+        self.server.close()
+        self.server_thread.join(timeout=5)
+        shutdown_app(self.app)
+        with self.app.app_context():
+            db.session.close()
+            db.engine.dispose()
+        Config.TEMP_DIR.cleanup()
+
+    def start_daemon(self, daemon: ActorDaemon) -> threading.Thread:
+        thread = threading.Thread(target=daemon.run, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(daemon.stop)
+        return thread
+
+    def notify(self, subject: str, content: str) -> None:
+        self.notifications.append(subject)
+
+    def test_long_poll_activation(self):
+        gpio = SimulatedGpio()
+        daemon = ActorDaemon(self.url, ACTOR0002_KEY, ACTOR0002_USER_ID.hex,
+                             DoorStrike(gpio, open_seconds=0.05, holdoff_seconds=0), actor_name='ACTOR2', wait=1,
+                             notify=self.notify)
+        self.start_daemon(daemon)
+        # the daemon waits in a long poll, it does not poll again meanwhile
+        self.assertTrue(wait_for(lambda: daemon.polls == 1))
+        time.sleep(0.3)
+        self.assertEqual((1, []), (daemon.polls, gpio.history))
+
+        with self.app.app_context():
+            set_state(ACTOR0002_USER_ID, USER0002_USER_ID)
+        # the state stays true for SET_STATE_DURATION, a pulse shorter than that is repeated meanwhile
+        self.assertTrue(wait_for(lambda: len(gpio.history) >= 2))
+        self.assertEqual([LOW, HIGH], [level for _, _, level in gpio.history[:2]])
+        self.assertEqual(['ACTOR info: ACTOR2 activated'], self.notifications[:1])
+        self.assertEqual(0, daemon.errors)
+        daemon.stop()
+
+    def test_backoff(self):
+        gpio = SimulatedGpio()
+        daemon = ActorDaemon(self.url, 'no key', ACTOR0002_USER_ID.hex, DoorStrike(gpio), actor_name='ACTOR2', wait=0,
+                             interval=0.01, backoff_max=0.05, notify=self.notify, notify_after=3)
+        self.start_daemon(daemon)
+        self.assertTrue(wait_for(lambda: daemon.errors >= 3))
+        daemon.stop()
+        self.assertEqual('SERVER Error: ACTOR2 poll error no. 3', self.notifications[0])
+        self.assertEqual([], gpio.history)
+
+        daemon.consecutive_errors = 20
+        self.assertTrue(0.025 <= daemon.backoff() <= 0.05)
+
+        # without wait, polls are interval seconds apart
+        daemon = ActorDaemon(self.url, ACTOR0002_KEY, ACTOR0002_USER_ID.hex, DoorStrike(gpio), wait=0, interval=0.1,
+                             notify=self.notify)
+        self.start_daemon(daemon)
+        time.sleep(0.5)
+        daemon.stop()
+        self.assertTrue(3 <= daemon.polls <= 11, daemon.polls)
+        self.assertEqual(0, daemon.errors)
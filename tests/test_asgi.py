@@ -0,0 +1,176 @@
+import asyncio
+import datetime
+import json
+import secrets
+import threading
+from unittest import TestCase
+from urllib.parse import urlencode
+
+from app.app import db
+from app.asgi import create_asgi_app, async_database_uri
+from app.util.metrics import HTTP_REQUESTS
+from tests.context.testfixture_config import Config
+from tests.test_fns import (set_up_users, set_up_valid, set_up_scope, TS_11_00_00, TS_12_30_00, TS_12_30_01,
+                            TS_12_30_05, USER0002_KEY, ACTOR0002_KEY, ACTOR0002_USER_ID, MAINTENANCE_KEY,
+                            USER0001_KEY)
+from tests.util.asgi_client import asgi_request
+from tests.util.mock_datetime import mock_datetime_now
+
+
+class TestAsgi(TestCase):
+    def setUp(self):
+        config = Config.get_cls()
+        config.SECRET_KEY = secrets.token_hex()
+        self.asgi_app = create_asgi_app(config_class=config)
+        self.app = self.asgi_app.flask_app
+        set_up_users(self.app, TS_11_00_00)
+        set_up_valid(self.app, TS_11_00_00)
+        set_up_scope(self.app, TS_11_00_00)
+
+    def tearDown(self):
+        asyncio.run(self.asgi_app.close())
+        with self.app.app_context():
+            db.session.close()
+            db.engine.dispose()
+        Config.TEMP_DIR.cleanup()
+
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    async def request_json(self, method: str, path: str, **kwargs):
+        status, body = await asgi_request(self.asgi_app, method, path, **kwargs)
+        return status, json.loads(body)
+
+    def test_async_database_uri(self):
+        self.assertEqual('sqlite+aiosqlite:////tmp/a.sqlite', async_database_uri('sqlite:////tmp/a.sqlite'))
+        with self.assertRaises(ValueError):
+            async_database_uri('postgresql://localhost/door')
+
+    def test_get_and_set_state(self):
+        get_query = {'api-key': ACTOR0002_KEY, 'actor-id': ACTOR0002_USER_ID.hex}
+
+        async def scenario():
+            with mock_datetime_now(TS_12_30_00, datetime):
+                self.assertEqual((200, {'state': False}), await self.request_json('GET', '/api/getState',
+                                                                                  query=get_query))
+            with mock_datetime_now(TS_12_30_01, datetime):
+                self.assertEqual((200, {'msg': 'success'}), await self.request_json(
+                    'POST', '/api/setState', data={'api-key': USER0002_KEY, 'actor-id': ACTOR0002_USER_ID.hex}))
+                # json body, as sent by the web UI
+                self.assertEqual((200, {'msg': 'success'}), await self.request_json(
+                    'POST', '/api/setState', json_body={'api-key': USER0002_KEY, 'actor-id': ACTOR0002_USER_ID.hex}))
+            with mock_datetime_now(TS_12_30_05, datetime):
+                self.assertEqual((200, {'state': True}), await self.request_json('GET', '/api/getState',
+                                                                                 query=get_query))
+
+        self.run_async(scenario())
+        # same state for the sync path
+        with mock_datetime_now(TS_12_30_05, datetime):
+            response = self.app.test_client().get('/api/getState', query_string=get_query)
+            self.assertEqual({'state': True}, response.json)
+
+    def test_errors(self):
+        async def scenario():
+            self.assertEqual((403, {'msg': 'no key provided'}), await self.request_json('GET', '/api/getState'))
+            self.assertEqual((403, {'msg': 'no actor id provided'}), await self.request_json(
+                'GET', '/api/getState', query={'api-key': ACTOR0002_KEY}))
+            self.assertEqual((403, {'msg': 'permission error'}), await self.request_json(
+                'GET', '/api/getState', query={'api-key': 'unknown', 'actor-id': ACTOR0002_USER_ID.hex}))
+            self.assertEqual((403, {'msg': 'bad input error'}), await self.request_json(
+                'GET', '/api/getState', query={'api-key': ACTOR0002_KEY, 'actor-id': 'no-uuid'}))
+            with mock_datetime_now(TS_12_30_01, datetime):
+                # user0001 has no write scope on actor0002
+                self.assertEqual((403, {'msg': 'permission error'}), await self.request_json(
+                    'POST', '/api/setState', data={'api-key': USER0001_KEY, 'actor-id': ACTOR0002_USER_ID.hex}))
+
+        self.run_async(scenario())
+
+    def test_long_poll_woken_by_sync_set_state(self):
+        get_query = {'api-key': ACTOR0002_KEY, 'actor-id': ACTOR0002_USER_ID.hex, 'wait': '5'}
+
+        def set_state_on_waitress_thread():
+            data = {'api-key': USER0002_KEY, 'actor-id': ACTOR0002_USER_ID.hex}
+            self.assertEqual(200, self.app.test_client().post('/api/setState', data=data).status_code)
+
+        async def scenario():
+            with mock_datetime_now(TS_12_30_01, datetime):
+                poll = asyncio.ensure_future(self.request_json('GET', '/api/getState', query=get_query))
+                while self.asgi_app.waiters().waiting() == 0:
+                    await asyncio.sleep(0.01)
+                thread = threading.Thread(target=set_state_on_waitress_thread)
+                thread.start()
+                self.assertEqual((200, {'state': True}), await asyncio.wait_for(poll, 2))
+                thread.join()
+                self.assertEqual(0, self.asgi_app.waiters().waiting())
+
+        self.run_async(scenario())
+
+    def test_stream(self):
+        self.app.config['STREAM_KEEPALIVE'] = 0.1
+        query = urlencode({'api-key': ACTOR0002_KEY, 'actor-id': ACTOR0002_USER_ID.hex}).encode('latin-1')
+        scope = {'type': 'http', 'method': 'GET', 'path': '/api/stream', 'query_string': query, 'headers': []}
+
+        async def scenario():
+            disconnected = asyncio.Event()
+            messages = asyncio.Queue()
+
+            async def receive() -> dict:
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            with mock_datetime_now(TS_12_30_01, datetime):
+                stream = asyncio.ensure_future(self.asgi_app(scope, receive, messages.put))
+                start = await asyncio.wait_for(messages.get(), 2)
+                self.assertEqual((200, (b'content-type', b'text/event-stream; charset=utf-8')),
+                                 (start['status'], start['headers'][0]))
+                self.assertEqual(b'event: state\ndata: {"state": false}\n\n', (await messages.get())['body'])
+                self.assertEqual(b': keep-alive\n\n', (await asyncio.wait_for(messages.get(), 2))['body'])
+                # a set_state on a waitress thread is pushed without a thread waiting for it
+                data = {'api-key': USER0002_KEY, 'actor-id': ACTOR0002_USER_ID.hex}
+                await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: self.app.test_client().post('/api/setState', data=data))
+                while True:
+                    body = (await asyncio.wait_for(messages.get(), 2))['body']
+                    if body != b': keep-alive\n\n':
+                        break
+                self.assertEqual(b'event: state\ndata: {"state": true}\n\n', body)
+
+                disconnected.set()
+                await asyncio.wait_for(stream, 2)
+                self.assertEqual(0, self.asgi_app.waiters().waiting())
+
+            status, body = await asgi_request(self.asgi_app, 'GET', '/api/stream',
+                                              query={'api-key': 'unknown', 'actor-id': ACTOR0002_USER_ID.hex})
+            self.assertEqual((403, {'msg': 'permission error'}), (status, json.loads(body)))
+
+        requests_before = HTTP_REQUESTS.value(endpoint='api.stream_door_state', method='GET', status=200)
+        self.run_async(scenario())
+        self.assertEqual(requests_before + 1,
+                         HTTP_REQUESTS.value(endpoint='api.stream_door_state', method='GET', status=200))
+
+    def test_actor_health(self):
+        health_query = {'api-key': MAINTENANCE_KEY, 'actor-id': ACTOR0002_USER_ID.hex, 'timeout': '60'}
+
+        async def scenario():
+            with mock_datetime_now(TS_12_30_00, datetime):
+                self.assertEqual((200, {'health': False}), await self.request_json('GET', '/api/actorHealth',
+                                                                                   query=health_query))
+                await self.request_json('GET', '/api/getState',
+                                        query={'api-key': ACTOR0002_KEY, 'actor-id': ACTOR0002_USER_ID.hex})
+                # the heartbeat is pending in the write-behind recorder and flushed by the health check
+                self.assertEqual((200, {'health': True}), await self.request_json('GET', '/api/actorHealth',
+                                                                                  query=health_query))
+                self.assertEqual((403, {'msg': 'api key is not from maintenance user'}), await self.request_json(
+                    'GET', '/api/actorHealth', query={**health_query, 'api-key': USER0002_KEY}))
+
+        self.run_async(scenario())
+
+    def test_other_paths_served_by_flask(self):
+        async def scenario():
+            self.assertEqual((200, {'msg': 'This is the api endpoint.'}), await self.request_json('GET', '/api/'))
+            status, _ = await asgi_request(self.asgi_app, 'GET', '/api/setState')
+            self.assertEqual(405, status)
+
+        requests_before = HTTP_REQUESTS.value(endpoint='api.index_get', method='GET', status=200)
+        self.run_async(scenario())
+        self.assertEqual(requests_before + 1, HTTP_REQUESTS.value(endpoint='api.index_get', method='GET', status=200))
@@ -0,0 +1,62 @@
+import time
+from unittest import TestCase
+
+from flask import Flask
+
+from app.util.batch_recorder import BatchRecorder
+
+
+class TestBatchRecorder(TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.batches = []
+
+    def test_flush_on_size(self):
+        recorder = BatchRecorder(self.app, self.batches.append, flush_size=3, flush_interval=60)
+        recorder.start()
+        for i in range(3):
+            recorder.record(i)
+        ts_start = time.monotonic()
+        while not self.batches and time.monotonic() - ts_start < 5:
+            time.sleep(0.01)
+        self.assertEqual([[0, 1, 2]], self.batches)
+        recorder.stop()
+
+    def test_flush_on_interval(self):
+        recorder = BatchRecorder(self.app, self.batches.append, flush_size=100, flush_interval=0.05)
+        recorder.start()
+        recorder.record('a')
+        time.sleep(0.3)
+        self.assertEqual([['a']], self.batches)
+        recorder.stop()
+
+    def test_drain_on_stop(self):
+        recorder = BatchRecorder(self.app, self.batches.append, flush_size=100, flush_interval=60)
+        recorder.start()
+        recorder.record('a')
+        recorder.record('b')
+        recorder.stop()
+        self.assertEqual([['a', 'b']], self.batches)
+        self.assertEqual(2, recorder.flushed)
+
+    def test_failed_flush_keeps_records(self):
+        def failing_writer(batch):
+            raise RuntimeError('database unavailable')
+
+        recorder = BatchRecorder(self.app, failing_writer, flush_size=100, flush_interval=60)
+        recorder.record('a')
+        self.assertEqual(0, recorder.flush())
+        self.assertEqual(1, recorder.pending())
+        self.assertEqual(1, recorder.failed_flushes)
+
+        recorder.writer = self.batches.append
+        recorder.record('b')
+        self.assertEqual(2, recorder.flush())
+        self.assertEqual([['a', 'b']], self.batches)
+
+    def test_backpressure(self):
+        recorder = BatchRecorder(self.app, self.batches.append, flush_size=100, flush_interval=60, max_pending=2)
+        recorder.record('a')
+        self.assertEqual([], self.batches)
+        recorder.record('b')
+        self.assertEqual([['a', 'b']], self.batches)
@@ -0,0 +1,30 @@
+from unittest import TestCase
+
+from benchmarks.bench_api import run
+from benchmarks.bench_fleet import run as run_fleet, step_sizes
+
+
+class TestBenchmarks(TestCase):
+    def test_bench_api_smoke(self):
+        report = run(users=4, actors=2, scopes_per_user=1, valid_rows=4, state_rows=20, requests_count=8, threads=2,
+                     targets=['client', 'waitress'])
+        self.assertEqual({'client', 'waitress'}, set(report['results'].keys()))
+        for target_results in report['results'].values():
+            self.assertEqual({'getState', 'setState'}, set(target_results.keys()))
+            for result in target_results.values():
+                self.assertEqual(8, result['requests'])
+                self.assertEqual(0, result['errors'])
+                self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+                self.assertGreater(result['statements_per_request'], 0)
+
+    def test_bench_fleet_smoke(self):
+        self.assertEqual([50, 100, 200, 250], step_sizes(50, 2, 250))
+        result = run_fleet(actors=4, users=2, start=2, growth=2, refine=1, step_duration=1, poll_interval=0.2, wait=0,
+                           opens_per_door_hour=3600, max_p99_ms=10_000, max_delay_ms=None, max_error_rate=1,
+                           threads=4, connection_limit=100, log=lambda line: None)
+        self.assertEqual((4, None), (result['capacity'], result['saturation']))
+        self.assertEqual([2, 4], [step['actors'] for step in result['steps']])
+        for step in result['steps']:
+            self.assertIsNone(step['limit'])
+            self.assertGreater(step['getState']['requests'], 0)
+            self.assertEqual(0, step['getState']['errors'])
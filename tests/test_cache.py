@@ -0,0 +1,61 @@
+import time
+from unittest import TestCase
+
+from app.util.cache import LRUTTLCache
+
+
+class TestLRUTTLCache(TestCase):
+
+    def test_get_set(self):
+        cache = LRUTTLCache(maxsize=2, ttl=60)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual({'size': 1, 'maxsize': 2, 'hits': 1, 'misses': 1, 'evictions': 0}, cache.stats())
+
+    def test_lru_eviction(self):
+        cache = LRUTTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # touch 'a' so that 'b' is the least recently used entry
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(1, cache.stats()['evictions'])
+
+    def test_ttl_expiry(self):
+        cache = LRUTTLCache(maxsize=2, ttl=0.05)
+        cache.set('a', 1)
+        self.assertEqual(1, cache.get('a'))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, len(cache))
+
+    def test_invalidate(self):
+        cache = LRUTTLCache(maxsize=4, ttl=60)
+        cache.set('a', (1, 'x'))
+        cache.set('b', (2, 'y'))
+        cache.set('c', (1, 'z'))
+        cache.invalidate('b')
+        self.assertIsNone(cache.get('b'))
+        cache.invalidate_where(lambda value: value[0] == 1)
+        self.assertEqual(0, len(cache))
+
+    def test_generation(self):
+        cache = LRUTTLCache(maxsize=4, ttl=60)
+        generation = cache.generation
+        self.assertTrue(cache.set('a', 1, generation))
+        cache.invalidate('b')
+        # loaded before the invalidation: not stored
+        self.assertFalse(cache.set('a', 2, generation))
+        self.assertEqual(1, cache.get('a'))
+        self.assertTrue(cache.set('a', 2, cache.generation))
+        self.assertEqual(2, cache.get('a'))
+
+    def test_bad_parameters(self):
+        with self.assertRaises(ValueError):
+            LRUTTLCache(maxsize=0)
+        with self.assertRaises(ValueError):
+            LRUTTLCache(ttl=0)
@@ -1,17 +1,28 @@
 import datetime
 import json
 import secrets
+import threading
+import time
 import uuid
 
 from unittest import TestCase
-from sqlalchemy import select
+from unittest.mock import patch
+from sqlalchemy import select, func
 
-from app.app import create_app, db
+from app.app import create_app, shutdown_app, db
+from app.api.func import set_state, write_usage_batch, principal_cache, add_scope, health_check_actor, flush_usage, \
+    usage_row, rollup_usage
 from app.api.routes import response_permission_error, response_input_error, response_success
 from app.models.user import User, Role
 from app.models.scope import Scope, Mode
 from app.models.valid import Valid
+from app.models.usage import Usage, Type
+from app.models.callback_dead_letter import CallbackDeadLetter
+from app.util.batch_recorder import BatchRecorder
+from app.util.metrics import GET_STATE_RESULTS, SET_STATE_RESULTS, HEALTH_CHECK_RESULTS, HTTP_REQUESTS
+from app.util.notify import WaitSlots
 from app.util.util import generate_api_key, simple_hash_str
+from app.util.webhook import sign, SIGNATURE_HEADER
 
 from tests.context.testfixture_config import Config
 
@@ -20,8 +31,11 @@ from tests.test_fns import (USER0002_KEY, ACTOR0001_KEY, ACTOR0002_KEY, TS_11_00
                             TS_12_30_08, TS_12_30_09, TS_12_30_10, TS_12_30_11, TS_12_30_12, set_up_users, set_up_valid,
                             set_up_scope, set_up_state, ACTOR0002_USER_ID, ACTOR0001_USER_ID, ACTOR0003_USER_ID,
                             ACTOR0003_KEY, ADMIN_KEY, USER0006_USER_ID, MAINTENANCE_KEY, TS_12_31_00, USER0001_KEY,
-                            USER0001_USER_ID)
+                            USER0001_USER_ID, USER0002_USER_ID, USER0006_KEY, TS_16_00_00)
 from tests.util.mock_datetime import mock_datetime_now
+from tests.util.http_receiver import HttpReceiver
+from tests.util.query_budget import request_within_budget
+from tests.util.statement_counter import count_statements
 
 BUILTIN_ADMIN_KEY = None
 
@@ -45,6 +59,7 @@ class TestApiEndpoints(TestCase):
         set_up_scope(self.app, TS_11_00_00)
 
     def tearDown(self):
+        shutdown_app(self.app)
         with self.app.app_context():
             db.session.close()
             db.engine.dispose()
@@ -211,6 +226,13 @@ class TestApiEndpoints(TestCase):
             query_string = {'api-key': BUILTIN_ADMIN_KEY, 'name': 'new User', 'role': 'unknown_role'}
             response = self.app_test.get('/api/addUser', query_string=query_string, follow_redirects=True)
             self.assertEqual(404, response.status_code)
+            # bcrypt pool saturated
+            query_string = {'api-key': BUILTIN_ADMIN_KEY, 'name': 'new User', 'role': Role.user.name,
+                            'password': 'a-long-enough-password'}
+            with patch('app.api.func.run_bcrypt', side_effect=TimeoutError):
+                response = self.app_test.get('/api/addUser', query_string=query_string, follow_redirects=True)
+            self.assertEqual(503, response.status_code)
+            self.assertEqual(0, db.session.scalar(select(func.count()).where(User.name == 'new User')))
 
     def test_add_user(self):
         with (self.app.app_context()):
@@ -305,6 +327,72 @@ class TestApiEndpoints(TestCase):
             self.assertIsNone(new_valid_data[1])
             self.assertEqual(TS_12_30_07, new_valid_data[2].replace(tzinfo=datetime.timezone.utc))
 
+    def test_provision(self):
+        body = {'api-key': BUILTIN_ADMIN_KEY,
+                'users': [{'name': 'bulk user', 'role': 'user', 'password': 'secret'},
+                          {'name': 'bulk actor', 'role': 'actor', 'email': 'bulk@example.com'}],
+                'scopes': [{'user-name': 'bulk user', 'actor-name': 'bulk actor', 'mode': 'write'},
+                           {'user-id': USER0006_USER_ID.hex, 'actor-name': 'bulk actor', 'mode': 'read'}],
+                'valid': [{'user-name': 'bulk user', 'start': TS_12_30_00.isoformat(), 'end': TS_12_31_00.isoformat()}]}
+        response = self.app_test.post('/api/provision', json=body)
+        self.assertEqual(200, response.status_code, response.json)
+        self.assertEqual(['ok'] * 5, [r['status'] for kind in ('users', 'scopes', 'valid')
+                                      for r in response.json[kind]])
+        user_result, actor_result = response.json['users']
+        self.assertEqual('-has been set-', user_result['password'])
+
+        with self.app.app_context():
+            user = db.session.get(User, uuid.UUID(user_result['id']))
+            actor = db.session.get(User, uuid.UUID(actor_result['id']))
+            self.assertEqual(('bulk user', Role.user), (user.name, user.role))
+            self.assertEqual(simple_hash_str(user_result['api_key']), user.api_key)
+            self.assertIsNotNone(user.password)
+            self.assertEqual(('bulk actor', Role.actor, 'bulk@example.com'), (actor.name, actor.role, actor.email))
+            scopes = db.session.execute(select(Scope.user_id, Scope.mode).where(Scope.actor_id == actor.id)).all()
+            self.assertEqual({(user.id, Mode.write), (USER0006_USER_ID, Mode.read)}, set(scopes))
+            valid = db.session.execute(select(Valid.start, Valid.end).where(Valid.user_id == user.id)).one()
+            self.assertEqual(TS_12_30_00, valid.start.replace(tzinfo=datetime.timezone.utc))
+
+        # the new user can set the state of the new actor right away
+        with mock_datetime_now(TS_12_30_01, datetime):
+            response = self.app_test.post('/api/setState', data={'api-key': user_result['api_key'],
+                                                                'actor-id': actor_result['id']})
+        self.assertEqual(200, response.status_code)
+
+    def test_provision_invalid_items(self):
+        with self.app.app_context():
+            user_count = db.session.execute(select(func.count()).select_from(User)).scalar_one()
+        body = {'api-key': BUILTIN_ADMIN_KEY,
+                'users': [{'name': 'bulk user', 'role': 'user'}, {'name': 'bulk user', 'role': 'user'},
+                          {'name': 'another user', 'role': 'unknown'}],
+                'scopes': [{'user-name': 'bulk user', 'actor-id': USER0006_USER_ID.hex, 'mode': 'write'},
+                           {'user-name': 'bulk user', 'actor-name': 'nobody', 'mode': 'write'}],
+                'valid': [{'user-name': 'bulk user', 'start': TS_12_31_00.isoformat(), 'end': TS_12_30_00.isoformat()},
+                          {'user-id': 'no uuid'}]}
+        response = self.app_test.post('/api/provision', json=body)
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(['ok', 'error', 'error'], [r['status'] for r in response.json['users']])
+        self.assertIn('name already taken', response.json['users'][1]['msg'])
+        self.assertIn('unknown role', response.json['users'][2]['msg'])
+        self.assertIn('not an actor', response.json['scopes'][0]['msg'])
+        self.assertIn('unknown actor', response.json['scopes'][1]['msg'])
+        self.assertIn('end must be after start', response.json['valid'][0]['msg'])
+        self.assertEqual('error', response.json['valid'][1]['status'])
+        with self.app.app_context():
+            self.assertEqual(user_count, db.session.execute(select(func.count()).select_from(User)).scalar_one())
+
+        # existing names are rejected as well
+        body = {'api-key': BUILTIN_ADMIN_KEY, 'users': [{'name': '_builtin_admin', 'role': 'admin'}]}
+        self.assertEqual(400, self.app_test.post('/api/provision', json=body).status_code)
+
+    def test_provision_permission(self):
+        body = {'api-key': USER0001_KEY, 'users': [{'name': 'bulk user', 'role': 'user'}]}
+        self.assertEqual(403, self.app_test.post('/api/provision', json=body).status_code)
+        self.assertEqual(403, self.app_test.post('/api/provision', json={'users': []}).status_code)
+        self.assertEqual(400, self.app_test.post('/api/provision', data='no json').status_code)
+        body = {'api-key': BUILTIN_ADMIN_KEY, 'users': {'name': 'bulk user'}}
+        self.assertEqual(400, self.app_test.post('/api/provision', json=body).status_code)
+
     def test_new_user_new_actor_new_scope_new_valid(self):
         with (self.app.app_context()):
             with mock_datetime_now(TS_12_29_00, datetime):
@@ -462,3 +550,424 @@ class TestApiEndpoints(TestCase):
                 response_json = response.json.copy()
                 self.assertEqual(200, response.status_code)
                 self.assertEqual({'health': False}, response_json)
+
+    def test_fleet_health(self):
+        with mock_datetime_now(TS_12_30_01, datetime):
+            self.app_test.get('/api/getState', query_string={'api-key': ACTOR0001_KEY, 'actor-id': ACTOR0001_USER_ID})
+        with mock_datetime_now(TS_12_30_05, datetime):
+            self.app_test.get('/api/getState', query_string={'api-key': ACTOR0002_KEY, 'actor-id': ACTOR0002_USER_ID})
+
+        with mock_datetime_now(TS_12_30_12, datetime):
+            query_string = {'api-key': MAINTENANCE_KEY, 'timeout': 10}
+            response = request_within_budget(self, self.app, self.app_test, 'GET', '/api/fleetHealth',
+                                             query_string=query_string)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual({'health': {ACTOR0001_USER_ID.hex: False, ACTOR0002_USER_ID.hex: True,
+                                         ACTOR0003_USER_ID.hex: False}, 'healthy': 1, 'unhealthy': 2}, response.json)
+
+            # per-actor timeout and a filtered set of actors; other users than actors are left out
+            query_string = {'api-key': MAINTENANCE_KEY, 'timeout': 10,
+                            'actor-id': [ACTOR0001_USER_ID.hex, ACTOR0002_USER_ID.hex, USER0001_USER_ID.hex],
+                            'actor-timeout': f'{ACTOR0001_USER_ID.hex}:20'}
+            response = self.app_test.get('/api/fleetHealth', query_string=query_string)
+            self.assertEqual({ACTOR0001_USER_ID.hex: True, ACTOR0002_USER_ID.hex: True}, response.json['health'])
+
+            for query_string in [{'api-key': MAINTENANCE_KEY, 'timeout': 0},
+                                 {'api-key': MAINTENANCE_KEY, 'timeout': 10, 'actor-timeout': 'no uuid:10'},
+                                 {'api-key': MAINTENANCE_KEY, 'timeout': 10,
+                                  'actor-timeout': f'{ACTOR0001_USER_ID.hex}:-1'}]:
+                response = self.app_test.get('/api/fleetHealth', query_string=query_string)
+                self.assertEqual(response_input_error().json, response.json)
+            response = self.app_test.get('/api/fleetHealth', query_string={'api-key': USER0001_KEY, 'timeout': 10})
+            self.assertEqual(403, response.status_code)
+
+    def test_usage_report(self):
+        with self.app.app_context():
+            write_usage_batch([{**usage_row(USER0001_USER_ID, ACTOR0001_USER_ID, Type.setState), 'timestamp': ts}
+                               for ts in [TS_11_00_00, TS_12_29_00, TS_12_30_00]])
+            with mock_datetime_now(TS_16_00_00, datetime):
+                rollup_usage()
+        self.app.config['USAGE_REPORT_MAX_ROWS'] = 1
+        query_string = {'api-key': BUILTIN_ADMIN_KEY, 'period': 'hour', 'user-id': USER0001_USER_ID.hex}
+        response = self.app_test.get('/api/usageReport', query_string=query_string)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'period': 'hour', 'truncated': True,
+                          'rows': [{'bucket': '2024-02-20T11:00:00+00:00', 'user-id': USER0001_USER_ID.hex,
+                                    'actor-id': ACTOR0001_USER_ID.hex, 'type': 'setState', 'count': 1}]},
+                         response.json)
+        response = self.app_test.get('/api/usageReport', query_string={**query_string, 'start': '2024-02-20T12:00'})
+        self.assertEqual(2, response.json['rows'][0]['count'])
+
+        self.assertEqual(403, self.app_test.get('/api/usageReport', query_string={'api-key': USER0001_KEY}).status_code)
+        response = self.app_test.get('/api/usageReport', query_string={**query_string, 'period': 'week'})
+        self.assertEqual(404, response.status_code)
+        response = self.app_test.get('/api/usageReport', query_string={**query_string, 'user-id': 'no uuid'})
+        self.assertEqual(response_input_error().json, response.json)
+
+    def test_export(self):
+        with self.app.app_context():
+            write_usage_batch([{**usage_row(USER0001_USER_ID, ACTOR0001_USER_ID, Type.setState), 'timestamp': ts}
+                               for ts in [TS_11_00_00, TS_12_29_00, TS_12_30_00]])
+        self.app.config['EXPORT_PAGE_SIZE'] = 2
+        query_string = {'api-key': BUILTIN_ADMIN_KEY, 'start': '2024-02-20T12:00'}
+        response = self.app_test.get('/api/export', query_string=query_string)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/x-ndjson', response.mimetype)
+        self.assertEqual('attachment; filename=usage.ndjson', response.headers['Content-Disposition'])
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(['2024-02-20T12:29:00+00:00', '2024-02-20T12:30:00+00:00'], [r['timestamp'] for r in rows])
+
+        response = self.app_test.get('/api/export', query_string={**query_string, 'table': 'state', 'format': 'csv'})
+        self.assertEqual(('text/csv', 'id,user_id,begin,end,created_at,updated_at\n'),
+                         (response.mimetype, response.get_data(as_text=True)))
+
+        self.assertEqual(403, self.app_test.get('/api/export', query_string={'api-key': USER0001_KEY}).status_code)
+        response = self.app_test.get('/api/export', query_string={**query_string, 'table': 'user'})
+        self.assertEqual(404, response.status_code)
+        response = self.app_test.get('/api/export', query_string={**query_string, 'format': 'xml'})
+        self.assertEqual(404, response.status_code)
+        response = self.app_test.get('/api/export', query_string={**query_string, 'end': 'tomorrow'})
+        self.assertEqual(response_input_error().json, response.json)
+
+    def test_callback(self):
+        receiver = HttpReceiver()
+        self.addCleanup(receiver.close)
+        data = {'api-key': ACTOR0002_KEY, 'actor-id': ACTOR0002_USER_ID.hex, 'url': receiver.url + '/door'}
+        response = self.app_test.post('/api/registerCallback', data=data)
+        self.assertEqual(200, response.status_code)
+        secret = response.json['secret']
+
+        self.assertEqual(200, self.app_test.post('/api/setState', data={'api-key': USER0002_KEY,
+                                                                        'actor-id': ACTOR0002_USER_ID}).status_code)
+        self.assertTrue(receiver.wait_for_requests(1))
+        request = receiver.requests[0]
+        self.assertEqual('/door', request.path)
+        self.assertEqual(sign(secret, request.body), request.headers[SIGNATURE_HEADER])
+        payload = json.loads(request.body)
+        self.assertEqual((ACTOR0002_USER_ID.hex, True), (payload['actor-id'], payload['state']))
+        self.assertLess(datetime.datetime.fromisoformat(payload['begin']),
+                        datetime.datetime.fromisoformat(payload['end']))
+
+        # undeliverable pushes end up as dead letters
+        receiver.statuses = [404]
+        self.app_test.post('/api/setState', data={'api-key': USER0002_KEY, 'actor-id': ACTOR0002_USER_ID})
+        self.assertTrue(receiver.wait_for_requests(2))
+        self.app.extensions['webhook_dispatcher'].stop()
+        with self.app.app_context():
+            dead_letter = db.session.execute(select(CallbackDeadLetter)).scalar_one()
+        self.assertEqual((ACTOR0002_USER_ID, 1, 'http status 404'),
+                         (dead_letter.actor_id, dead_letter.attempts, dead_letter.error))
+
+        # only the actor itself or an admin
+        response = self.app_test.post('/api/registerCallback', data={**data, 'api-key': USER0002_KEY})
+        self.assertEqual(response_permission_error().json, response.json)
+        response = self.app_test.post('/api/registerCallback', json={**data, 'api-key': ADMIN_KEY})
+        self.assertNotEqual(secret, response.json['secret'])
+        for url in ['ftp://example.com', 'http://localhost/door', 'http://169.254.169.254/latest/meta-data']:
+            response = self.app_test.post('/api/registerCallback', data={**data, 'url': url})
+            self.assertEqual(response_input_error().json, response.json)
+
+        self.assertEqual(200, self.app_test.post('/api/removeCallback', data=data).status_code)
+        self.assertEqual(404, self.app_test.post('/api/removeCallback', data=data).status_code)
+
+    def test_principal_cache_stats(self):
+        query_string = {'api-key': MAINTENANCE_KEY}
+        response = self.app_test.get('/api/principalCacheStats', query_string=query_string, follow_redirects=True)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'size', 'maxsize', 'hits', 'misses', 'evictions'}, set(response.json.keys()))
+
+        query_string = {'api-key': ACTOR0001_KEY}
+        response = self.app_test.get('/api/principalCacheStats', query_string=query_string, follow_redirects=True)
+        self.assertEqual(403, response.status_code)
+
+    def test_get_state_long_polling(self):
+        with mock_datetime_now(TS_12_30_01, datetime):
+            # no state change: the request is held until the timeout expires
+            query_string = {'api-key': ACTOR0002_KEY, 'actor-id': ACTOR0002_USER_ID, 'wait': 0.2}
+            ts_start = time.monotonic()
+            response = self.app_test.get('/api/getState', query_string=query_string, follow_redirects=True)
+            self.assertGreaterEqual(time.monotonic() - ts_start, 0.2)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual({'state': False}, response.json)
+
+            # a set_state from another thread wakes up the waiting request
+            def open_door():
+                time.sleep(0.2)
+                with self.app.app_context():
+                    set_state(ACTOR0002_USER_ID, USER0002_USER_ID)
+
+            thread = threading.Thread(target=open_door)
+            thread.start()
+            query_string = {'api-key': ACTOR0002_KEY, 'actor-id': ACTOR0002_USER_ID, 'wait': 10}
+            ts_start = time.monotonic()
+            response = self.app_test.get('/api/getState', query_string=query_string, follow_redirects=True)
+            thread.join()
+            self.assertLess(time.monotonic() - ts_start, 5)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual({'state': True}, response.json)
+
+            self.assertEqual(0, self.app.extensions['wait_slots'].waiting())
+            # all long-poll slots taken: answered right away
+            self.app.extensions['wait_slots'] = WaitSlots(0)
+            query_string = {'api-key': ACTOR0001_KEY, 'actor-id': ACTOR0001_USER_ID, 'wait': 10}
+            ts_start = time.monotonic()
+            response = self.app_test.get('/api/getState', query_string=query_string, follow_redirects=True)
+            self.assertLess(time.monotonic() - ts_start, 5)
+            self.assertEqual({'state': False}, response.json)
+
+            for wait in ['-1', 'abc', 'nan']:
+                query_string = {'api-key': ACTOR0002_KEY, 'actor-id': ACTOR0002_USER_ID, 'wait': wait}
+                response = self.app_test.get('/api/getState', query_string=query_string, follow_redirects=True)
+                self.assertEqual(response_input_error().status_code, response.status_code)
+                self.assertEqual(response_input_error().json, response.json)
+
+    def test_get_states(self):
+        # a controller key with read scopes on two actors
+        with self.app.app_context():
+            add_scope(USER0001_USER_ID, ACTOR0001_USER_ID, Mode.read)
+            add_scope(USER0001_USER_ID, ACTOR0002_USER_ID, Mode.read)
+        with mock_datetime_now(TS_12_30_01, datetime):
+            with self.app.app_context():
+                set_state(ACTOR0001_USER_ID, USER0001_USER_ID)
+            query_string = {'api-key': USER0001_KEY,
+                            'actor-id': [ACTOR0001_USER_ID.hex, ACTOR0002_USER_ID.hex, ACTOR0003_USER_ID.hex,
+                                         ACTOR0001_USER_ID.hex]}
+            response = request_within_budget(self, self.app, self.app_test, 'GET', '/api/getStates',
+                                             query_string=query_string)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual({'states': {ACTOR0001_USER_ID.hex: True, ACTOR0002_USER_ID.hex: False,
+                                         ACTOR0003_USER_ID.hex: 'forbidden'}}, response.json)
+
+            # heartbeats are recorded for the permitted actors only
+            with self.app.app_context():
+                self.assertTrue(health_check_actor(ACTOR0001_USER_ID, 10))
+                self.assertTrue(health_check_actor(ACTOR0002_USER_ID, 10))
+                self.assertFalse(health_check_actor(ACTOR0003_USER_ID, 10))
+
+        with mock_datetime_now(TS_12_30_03, datetime):
+            # the heartbeat rows are updated, not inserted again
+            self.app_test.get('/api/getStates', query_string=query_string)
+            with self.app.app_context():
+                flush_usage()
+                heartbeats = db.session.execute(select(Usage.user_id, Usage.timestamp)
+                                                .where(Usage.type == Type.last_getState)).all()
+            self.assertEqual(2, len(heartbeats))
+            self.assertEqual({ACTOR0001_USER_ID, ACTOR0002_USER_ID}, {user_id for user_id, _ in heartbeats})
+
+        with mock_datetime_now(TS_12_30_12, datetime):
+            # a set_state on any of the actors wakes up a waiting request
+            def open_door():
+                time.sleep(0.2)
+                with self.app.app_context():
+                    set_state(ACTOR0002_USER_ID, USER0002_USER_ID)
+
+            thread = threading.Thread(target=open_door)
+            thread.start()
+            ts_start = time.monotonic()
+            response = self.app_test.get('/api/getStates', query_string={**query_string, 'wait': 10})
+            thread.join()
+            self.assertLess(time.monotonic() - ts_start, 5)
+            self.assertEqual({ACTOR0001_USER_ID.hex: False, ACTOR0002_USER_ID.hex: True,
+                              ACTOR0003_USER_ID.hex: 'forbidden'}, response.json['states'])
+
+        with mock_datetime_now(TS_16_00_00, datetime):
+            # all long-poll slots taken: answered right away
+            self.app.extensions['wait_slots'] = WaitSlots(0)
+            ts_start = time.monotonic()
+            response = self.app_test.get('/api/getStates', query_string={**query_string, 'wait': 10})
+            self.assertLess(time.monotonic() - ts_start, 5)
+            self.assertNotIn(True, response.json['states'].values())
+
+            # invalid users, keys and ids
+            query_string = {'api-key': USER0006_KEY, 'actor-id': ACTOR0001_USER_ID.hex}
+            self.assertEqual(403, self.app_test.get('/api/getStates', query_string=query_string).status_code)
+            query_string = {'api-key': USER0001_KEY, 'actor-id': 'no uuid'}
+            self.assertEqual(response_input_error().json,
+                             self.app_test.get('/api/getStates', query_string=query_string).json)
+            self.assertEqual(403, self.app_test.get('/api/getStates',
+                                                    query_string={'api-key': USER0001_KEY}).status_code)
+
+    def test_stream(self):
+        self.app.config['STREAM_KEEPALIVE'] = 0.1
+        with mock_datetime_now(TS_12_30_01, datetime):
+            query_string = {'api-key': ACTOR0001_KEY, 'actor-id': ACTOR0002_USER_ID}
+            response = self.app_test.get('/api/stream', query_string=query_string, follow_redirects=True)
+            self.assertEqual(response_permission_error().status_code, response.status_code)
+
+            query_string = {'api-key': ACTOR0002_KEY, 'actor-id': ACTOR0002_USER_ID}
+            response = self.app_test.get('/api/stream', query_string=query_string, buffered=False)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual('text/event-stream', response.mimetype)
+            chunks = response.iter_encoded()
+            self.assertEqual(b'event: state\ndata: {"state": false}\n\n', next(chunks))
+            self.assertEqual(b': keep-alive\n\n', next(chunks))
+
+            with self.app.app_context():
+                set_state(ACTOR0002_USER_ID, USER0002_USER_ID)
+            self.assertEqual(b'event: state\ndata: {"state": true}\n\n', next(chunks))
+            self.assertEqual(1, self.app.extensions['wait_slots'].waiting())
+            response.close()
+            self.assertEqual(0, self.app.extensions['wait_slots'].waiting())
+
+            # all long-poll slots taken
+            self.app.extensions['wait_slots'] = WaitSlots(0)
+            response = self.app_test.get('/api/stream', query_string=query_string)
+            self.assertEqual(503, response.status_code)
+            self.app.extensions['wait_slots'] = WaitSlots(1)
+
+        with mock_datetime_now(TS_12_30_02, datetime):
+            # the keep-alives update the heartbeat of the actor
+            query_string = {'api-key': MAINTENANCE_KEY, 'actor-id': ACTOR0002_USER_ID, 'timeout': 1}
+            response = self.app_test.get('/api/actorHealth', query_string=query_string, follow_redirects=True)
+            self.assertEqual({'health': True}, response.json)
+
+    def test_statement_count(self):
+        set_up_state(self.app, TS_11_00_00)
+        # replace the background recorder by one that is only flushed explicitly
+        shutdown_app(self.app)
+        usage_recorder = BatchRecorder(self.app, write_usage_batch)
+        self.app.extensions['usage_recorder'] = usage_recorder
+        with self.app.app_context():
+            engine = db.engine
+        with mock_datetime_now(TS_12_30_02, datetime):
+            query_string = {'api-key': ACTOR0001_KEY, 'actor-id': ACTOR0001_USER_ID}
+            # warm up the principal cache and create the heartbeat row
+            self.app_test.get('/api/getState', query_string=query_string, follow_redirects=True)
+            usage_recorder.flush()
+
+            # authorization query, the heartbeat is written behind
+            with count_statements(engine) as statements:
+                response = self.app_test.get('/api/getState', query_string=query_string, follow_redirects=True)
+            self.assertEqual({'state': False}, response.json)
+            self.assertEqual(1, len(statements), statements)
+
+        with mock_datetime_now(TS_12_30_04, datetime):
+            # authorization query, heartbeat and getState_true usage are written behind
+            with count_statements(engine) as statements:
+                response = self.app_test.get('/api/getState', query_string=query_string, follow_redirects=True)
+            self.assertEqual({'state': True}, response.json)
+            self.assertEqual(1, len(statements), statements)
+
+            # authorization query + state insert, the setState usage is written behind
+            data = {'api-key': USER0001_KEY, 'actor-id': ACTOR0001_USER_ID}
+            self.app_test.post('/api/setState', data=data, follow_redirects=True)
+            with count_statements(engine) as statements:
+                response = self.app_test.post('/api/setState', data=data, follow_redirects=True)
+            self.assertEqual(response_success().json, response.json)
+            self.assertEqual(2, len(statements), statements)
+
+            # a flush writes heartbeats and usage rows with a fixed number of statements
+            for _ in range(10):
+                self.app_test.get('/api/getState', query_string=query_string, follow_redirects=True)
+            with count_statements(engine) as statements:
+                usage_recorder.flush()
+            self.assertEqual(3, len(statements), statements)
+            self.assertEqual(0, usage_recorder.pending())
+
+    def test_request_log(self):
+        self.app.config['REQUEST_LOG_SAMPLING'] = {'api.get_door_state': 0.0}
+        with mock_datetime_now(TS_12_30_01, datetime):
+            query_string = {'api-key': ACTOR0001_KEY, 'actor-id': ACTOR0001_USER_ID}
+            self.app_test.get('/api/getState', query_string=query_string, follow_redirects=True)
+            query_string = {'api-key': MAINTENANCE_KEY, 'actor-id': ACTOR0001_USER_ID, 'timeout': 10}
+            self.app_test.get('/api/actorHealth', query_string=query_string, follow_redirects=True)
+            # requests ending in an unhandled exception are logged as well
+            self.app.config['PROPAGATE_EXCEPTIONS'] = True
+            with patch('app.api.routes.health_check_actor', side_effect=RuntimeError('broken')):
+                with self.assertRaises(RuntimeError):
+                    self.app_test.get('/api/actorHealth', query_string=query_string, follow_redirects=True)
+
+        # stopping the listener drains the queue
+        self.app.extensions['background_jobs'][0].stop()
+        with open(self.app.config['REQUEST_LOG_FILE'], encoding='utf-8') as file:
+            records = [json.loads(line) for line in file]
+        access_records = [r for r in records if r['logger'] == 'doorOpener.access']
+        self.assertEqual(['api.check_actor_health'] * 2, [r['endpoint'] for r in access_records])
+        self.assertEqual([200, 500], [r['status'] for r in access_records])
+        self.assertEqual([None, "RuntimeError('broken')"], [r['error'] for r in access_records])
+        self.assertEqual('<redacted>', access_records[0]['args']['api-key'])
+        self.assertGreater(access_records[0]['sql_statements'], 0)
+        self.assertNotIn(MAINTENANCE_KEY, ''.join(json.dumps(r) for r in records))
+
+    def test_metrics(self):
+        get_state_true = GET_STATE_RESULTS.value(result='true')
+        set_state_grant = SET_STATE_RESULTS.value(result='grant')
+        set_state_denial = SET_STATE_RESULTS.value(result='denial')
+        health_checks = HEALTH_CHECK_RESULTS.value(result='healthy')
+        requests_ok = HTTP_REQUESTS.value(endpoint='api.get_door_state', method='GET', status=200)
+        with mock_datetime_now(TS_12_30_01, datetime):
+            data = {'api-key': USER0002_KEY, 'actor-id': ACTOR0002_USER_ID}
+            self.app_test.post('/api/setState', data=data, follow_redirects=True)
+            data = {'api-key': USER0002_KEY, 'actor-id': ACTOR0001_USER_ID}
+            self.app_test.post('/api/setState', data=data, follow_redirects=True)
+            query_string = {'api-key': ACTOR0002_KEY, 'actor-id': ACTOR0002_USER_ID}
+            self.app_test.get('/api/getState', query_string=query_string, follow_redirects=True)
+            query_string = {'api-key': MAINTENANCE_KEY, 'actor-id': ACTOR0002_USER_ID, 'timeout': 10}
+            self.app_test.get('/api/actorHealth', query_string=query_string, follow_redirects=True)
+
+        self.assertEqual(1, GET_STATE_RESULTS.value(result='true') - get_state_true)
+        self.assertEqual(1, SET_STATE_RESULTS.value(result='grant') - set_state_grant)
+        self.assertEqual(1, SET_STATE_RESULTS.value(result='denial') - set_state_denial)
+        self.assertEqual(1, HEALTH_CHECK_RESULTS.value(result='healthy') - health_checks)
+        self.assertEqual(1, HTTP_REQUESTS.value(endpoint='api.get_door_state', method='GET', status=200) - requests_ok)
+
+        response = self.app_test.get('/api/metrics', query_string={'api-key': MAINTENANCE_KEY})
+        self.assertEqual(200, response.status_code)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', response.text)
+        self.assertIn('http_requests_in_flight{endpoint="api.metrics"} 1', response.text)
+        self.assertIn('door_set_state_total{result="grant"}', response.text)
+
+        response = self.app_test.get('/api/metrics', query_string={'api-key': ACTOR0001_KEY})
+        self.assertEqual(403, response.status_code)
+
+    def test_query_budgets(self):
+        with mock_datetime_now(TS_12_30_01, datetime):
+            for method, path, kwargs in [
+                    ('GET', '/api/', {}),
+                    ('POST', '/api/setState', {'data': {'api-key': USER0002_KEY, 'actor-id': ACTOR0002_USER_ID}}),
+                    ('GET', '/api/getState', {'query_string': {'api-key': ACTOR0002_KEY,
+                                                               'actor-id': ACTOR0002_USER_ID}}),
+                    ('GET', '/api/actorHealth', {'query_string': {'api-key': MAINTENANCE_KEY,
+                                                                  'actor-id': ACTOR0002_USER_ID, 'timeout': 10}}),
+                    ('GET', '/api/principalCacheStats', {'query_string': {'api-key': MAINTENANCE_KEY}}),
+                    ('GET', '/api/metrics', {'query_string': {'api-key': MAINTENANCE_KEY}}),
+                    ('GET', '/api/addUser', {'query_string': {'api-key': ADMIN_KEY, 'name': 'budget',
+                                                              'role': 'user'}}),
+                    ('GET', '/api/addValid', {'query_string': {'api-key': ADMIN_KEY, 'user-id': USER0006_USER_ID}}),
+                    ('GET', '/api/addScope', {'query_string': {'api-key': ADMIN_KEY, 'user-id': USER0006_USER_ID,
+                                                               'actor-id': ACTOR0002_USER_ID, 'mode': 'write'}}),
+                    ('GET', '/api/regenerateApiKey', {'query_string': {'api-key': USER0001_KEY}}),
+                    ('GET', '/api/usageReport', {'query_string': {'api-key': ADMIN_KEY, 'period': 'hour',
+                                                                  'actor-id': ACTOR0002_USER_ID}}),
+                    ('POST', '/api/provision', {'json': {
+                        'api-key': ADMIN_KEY, 'users': [{'name': 'budget actor', 'role': 'actor'}],
+                        'scopes': [{'user-id': USER0006_USER_ID.hex, 'actor-name': 'budget actor', 'mode': 'read'}],
+                        'valid': [{'user-id': USER0006_USER_ID.hex}]}}),
+                    ('POST', '/api/registerCallback', {'data': {'api-key': ACTOR0002_KEY, 'actor-id': ACTOR0002_USER_ID,
+                                                                'url': 'http://127.0.0.1/door'}}),
+                    ('POST', '/api/removeCallback', {'data': {'api-key': ACTOR0002_KEY,
+                                                              'actor-id': ACTOR0002_USER_ID}}),
+            ]:
+                # measure with a cold principal cache
+                principal_cache().clear()
+                response = request_within_budget(self, self.app, self.app_test, method, path, **kwargs)
+                self.assertEqual(200, response.status_code, path)
+
+        # exceeding the declared budget fails
+        view = self.app.view_functions['api.get_door_state']
+        budget = view.query_budget
+        view.query_budget = 0
+        try:
+            with self.assertRaises(AssertionError):
+                query_string = {'api-key': ACTOR0002_KEY, 'actor-id': ACTOR0002_USER_ID}
+                request_within_budget(self, self.app, self.app_test, 'GET', '/api/getState', query_string=query_string)
+        finally:
+            view.query_budget = budget
+
+    def test_sql_stats_header(self):
+        query_string = {'api-key': ACTOR0002_KEY, 'actor-id': ACTOR0002_USER_ID}
+        response = self.app_test.get('/api/getState', query_string=query_string)
+        self.assertNotIn('X-SQL-Stats', response.headers)
+        self.app.config['SQL_DEBUG_HEADER'] = True
+        response = self.app_test.get('/api/getState', query_string=query_string)
+        self.assertRegex(response.headers['X-SQL-Stats'], r'^statements=1; time_ms=\d+\.\d{3}$')
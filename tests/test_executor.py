@@ -0,0 +1,35 @@
+import threading
+from unittest import TestCase
+
+from app.util.executor import BoundedExecutor
+
+
+class TestBoundedExecutor(TestCase):
+    def test_run(self):
+        executor = BoundedExecutor(max_workers=2, max_pending=2)
+        self.assertEqual(5, executor.run(lambda a, b: a + b, 2, 3))
+        executor.stop()
+
+    def test_backpressure(self):
+        executor = BoundedExecutor(max_workers=1, max_pending=1)
+        release = threading.Event()
+        running = executor.submit(release.wait)
+        queued = executor.submit(release.wait)
+        # one running and one queued task: further submissions are rejected immediately
+        with self.assertRaises(TimeoutError):
+            executor.submit(release.wait)
+        self.assertEqual(1, executor.rejected)
+        release.set()
+        self.assertTrue(running.result(timeout=1))
+        self.assertTrue(queued.result(timeout=1))
+        # slots are released once tasks are done
+        self.assertEqual(1, executor.run(lambda: 1))
+        executor.stop()
+
+    def test_timeout(self):
+        executor = BoundedExecutor(max_workers=1, max_pending=0)
+        release = threading.Event()
+        with self.assertRaises(TimeoutError):
+            executor.run(release.wait, timeout=0.05)
+        release.set()
+        executor.stop()
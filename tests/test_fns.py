@@ -1,15 +1,23 @@
 import datetime
+import json
 import uuid
-from unittest import TestCase
+from unittest import TestCase, mock
 
 import flask
 from sqlalchemy import select
 
-from app.app import create_app, db, User, Valid, State
+from app.app import create_app, shutdown_app, db, User, Valid, State
 from app.api.func import get_state, set_state, add_user, add_scope, add_valid, assert_password_properties, \
-    set_user_password, check_password, add_usage, health_check_actor, regenerate_api_key
+    set_user_password, check_password, add_usage, health_check_actor, regenerate_api_key, get_user_id_from_api_key, \
+    get_principal_from_api_key, principal_cache, get_authorization, Authorization, sanitize_state_db, \
+    rebuild_actor_state_store, actor_state_store, write_usage_batch, usage_row, rollup_usage, archive_usage, \
+    usage_retention, usage_report, remember_principal, drop_usage_archives, bcrypt_pool
 from app.models.scope import Mode, Scope
-from app.models.usage import Type
+from app.models.state_archive import StateArchive
+from app.models.usage import Type, Usage
+from app.models.usage_archive import usage_archive_table, usage_archive_tables
+from app.export import export, export_rows
+from app.models.usage_rollup import Period
 from app.models.user import Role
 from app.util.util import simple_hash_str, hash_salt_pw_str, generate_api_key, check_pw, check_pw_str
 from tests.context.testfixture_config import Config
@@ -271,6 +279,8 @@ def set_up_state(app: flask.app.Flask, timestamp: datetime.datetime) -> None:
             for valid in state_list:
                 db.session.add(valid)
                 db.session.commit()
+            # rows are inserted directly, as if they were present at startup
+            rebuild_actor_state_store()
 
 
 class TestApiFunctions(TestCase):
@@ -290,6 +300,7 @@ class TestApiFunctions(TestCase):
         set_up_scope(self.app, TS_11_00_00)
 
     def tearDown(self):
+        shutdown_app(self.app)
         with self.app.app_context():
             db.session.close()
             db.engine.dispose()
@@ -371,6 +382,192 @@ class TestApiFunctions(TestCase):
                     with self.assertRaises(PermissionError):
                         get_state(ACTOR0001_USER_ID, unknown_id)
 
+    def test_get_authorization(self):
+        set_up_state(self.app, TS_11_00_00)
+        with self.app.app_context():
+            with mock_datetime_now(TS_12_30_04, datetime):
+                self.assertEqual(Authorization(True, True, True, True),
+                                 get_authorization(ACTOR0001_USER_ID, ACTOR0001_USER_ID, Mode.read))
+                self.assertEqual(Authorization(True, True, False, True),
+                                 get_authorization(ACTOR0001_USER_ID, ACTOR0001_USER_ID, Mode.write))
+                self.assertEqual(Authorization(True, True, False, True),
+                                 get_authorization(ACTOR0001_USER_ID, ACTOR0002_USER_ID, Mode.read))
+                self.assertEqual(Authorization(True, True, True, True),
+                                 get_authorization(USER0001_USER_ID, ACTOR0001_USER_ID, Mode.write))
+                # USER0006 has a valid row with end <= start and no scopes
+                self.assertEqual(Authorization(False, False, False, True),
+                                 get_authorization(USER0006_USER_ID, ACTOR0002_USER_ID, Mode.write))
+            with mock_datetime_now(TS_12_30_02, datetime):
+                self.assertEqual(Authorization(True, True, True, False),
+                                 get_authorization(ACTOR0001_USER_ID, ACTOR0001_USER_ID, Mode.read))
+
+    def test_sanitize_state_db_archive(self):
+        set_up_state(self.app, TS_11_00_00)
+        with self.app.app_context():
+            with mock_datetime_now(TS_12_31_00, datetime):
+                result = sanitize_state_db(datetime.timedelta(seconds=30), archive=True, chunk_size=2)
+            self.assertEqual(3, result['rows'])
+            self.assertTrue(result['archived'])
+            self.assertEqual([STATE04_ID], list(db.session.execute(select(State.id)).scalars()))
+            self.assertEqual({STATE01_ID, STATE02_ID, STATE03_ID},
+                             set(db.session.execute(select(StateArchive.id)).scalars()))
+
+            # open-ended states are never pruned, the actor stays active
+            with mock_datetime_now(TS_16_00_00, datetime):
+                self.assertEqual(0, sanitize_state_db(datetime.timedelta(seconds=0))['rows'])
+                self.assertTrue(get_state(ACTOR0002_USER_ID, ACTOR0002_USER_ID))
+
+    def test_sanitize_state_db_delete(self):
+        set_up_state(self.app, TS_11_00_00)
+        with self.app.app_context():
+            with mock_datetime_now(TS_12_30_02, datetime):
+                result = sanitize_state_db(datetime.timedelta(seconds=0), archive=False)
+                self.assertEqual(2, result['rows'])
+                self.assertFalse(result['archived'])
+                self.assertEqual({STATE01_ID, STATE04_ID}, set(db.session.execute(select(State.id)).scalars()))
+                self.assertEqual([], list(db.session.execute(select(StateArchive.id)).scalars()))
+
+    def set_up_usage(self) -> None:
+        rows = [(USER0001_USER_ID, ACTOR0001_USER_ID, Type.setState, datetime.datetime(2024, 2, 20, 10, 15)),
+                (USER0001_USER_ID, ACTOR0001_USER_ID, Type.setState, datetime.datetime(2024, 2, 20, 10, 45)),
+                (ACTOR0001_USER_ID, ACTOR0001_USER_ID, Type.getState_true, datetime.datetime(2024, 2, 20, 10, 20)),
+                (USER0001_USER_ID, ACTOR0001_USER_ID, Type.setState, datetime.datetime(2024, 2, 20, 11, 5)),
+                (USER0001_USER_ID, ACTOR0002_USER_ID, Type.setState, datetime.datetime(2024, 2, 21, 0, 1)),
+                (ACTOR0001_USER_ID, ACTOR0001_USER_ID, Type.last_getState, datetime.datetime(2024, 2, 20, 10, 10))]
+        with self.app.app_context():
+            write_usage_batch([{**usage_row(user_id, actor_id, usage_type), 'timestamp': ts}
+                               for user_id, actor_id, usage_type, ts in rows])
+
+    def test_rollup_usage(self):
+        self.set_up_usage()
+        with self.app.app_context():
+            # the hour of 00:01 has not ended yet
+            with mock_datetime_now(datetime.datetime(2024, 2, 21, 0, 10, tzinfo=datetime.timezone.utc), datetime):
+                self.assertEqual({'hour': 2, 'day': 1}, rollup_usage(datetime.timedelta(minutes=5)))
+                self.assertEqual({'hour': 0, 'day': 0}, rollup_usage(datetime.timedelta(minutes=5)))
+            self.assertEqual([{'bucket': '2024-02-20T10:00:00+00:00', 'user-id': ACTOR0001_USER_ID.hex,
+                               'actor-id': ACTOR0001_USER_ID.hex, 'type': 'getState_true', 'count': 1},
+                              {'bucket': '2024-02-20T10:00:00+00:00', 'user-id': USER0001_USER_ID.hex,
+                               'actor-id': ACTOR0001_USER_ID.hex, 'type': 'setState', 'count': 2},
+                              {'bucket': '2024-02-20T11:00:00+00:00', 'user-id': USER0001_USER_ID.hex,
+                               'actor-id': ACTOR0001_USER_ID.hex, 'type': 'setState', 'count': 1}],
+                             sorted(usage_report(Period.hour), key=lambda r: (r['bucket'], r['type'])))
+            daily = usage_report(Period.day, user_id=USER0001_USER_ID)
+            self.assertEqual([('2024-02-20T00:00:00+00:00', 'setState', 3)],
+                             [(r['bucket'], r['type'], r['count']) for r in daily])
+            self.assertEqual([], usage_report(Period.hour, start=TS_11_00_00 + datetime.timedelta(hours=1)))
+
+            with mock_datetime_now(datetime.datetime(2024, 2, 22, 0, 10, tzinfo=datetime.timezone.utc), datetime):
+                self.assertEqual({'hour': 1, 'day': 1}, rollup_usage(datetime.timedelta(minutes=5)))
+            self.assertEqual([('2024-02-21T00:00:00+00:00', 1)],
+                             [(r['bucket'], r['count']) for r in usage_report(Period.day, actor_id=ACTOR0002_USER_ID)])
+
+            # a row written late for an hour that has already been rolled up is counted by the next rollup
+            write_usage_batch([{**usage_row(USER0001_USER_ID, ACTOR0002_USER_ID, Type.setState),
+                                'timestamp': datetime.datetime(2024, 2, 21, 0, 30)}])
+            with mock_datetime_now(datetime.datetime(2024, 2, 22, 0, 20, tzinfo=datetime.timezone.utc), datetime):
+                self.assertEqual({'hour': 0, 'day': 0}, rollup_usage(datetime.timedelta(minutes=5)))
+            self.assertEqual([('2024-02-21T00:00:00+00:00', 2)],
+                             [(r['bucket'], r['count']) for r in usage_report(Period.hour, actor_id=ACTOR0002_USER_ID)])
+            self.assertEqual([('2024-02-21T00:00:00+00:00', 2)],
+                             [(r['bucket'], r['count']) for r in usage_report(Period.day, actor_id=ACTOR0002_USER_ID)])
+
+    def test_archive_usage(self):
+        self.set_up_usage()
+        with self.app.app_context():
+            write_usage_batch([{**usage_row(USER0001_USER_ID, ACTOR0001_USER_ID, Type.setState),
+                                'timestamp': datetime.datetime(2024, 1, 31, 23, 30)}])
+            # nothing is archived before it has been rolled up
+            with mock_datetime_now(datetime.datetime(2024, 2, 21, 0, 10, tzinfo=datetime.timezone.utc), datetime):
+                self.assertEqual(0, archive_usage(datetime.timedelta(0))['rows'])
+                rollup_usage(datetime.timedelta(minutes=5))
+                # the rows of the day before the last rolled up hour are counted again by the next rollup
+                self.assertEqual({'rows': 1, 'archived': True}, archive_usage(datetime.timedelta(0), archive=True))
+                self.app.config['USAGE_ROLLUP_WINDOW'] = 0
+                result = archive_usage(datetime.timedelta(0), archive=True, chunk_size=2)
+            self.assertEqual({'rows': 4, 'archived': True}, result)
+            # one table per month
+            self.assertEqual(['usage_archive_202401', 'usage_archive_202402'],
+                             [table.name for table in usage_archive_tables(db.engine)])
+            self.assertEqual(4, len(list(db.session.execute(select(usage_archive_table(datetime.date(2024, 2, 1)).c.id))
+                                         .scalars())))
+            rows = list(export_rows('usage_archive', page_size=2))
+            self.assertEqual(5, len(rows))
+            self.assertEqual(sorted((row[4], row[0]) for row in rows), [(row[4], row[0]) for row in rows])
+            # the heartbeat and the row of the open hour stay
+            self.assertEqual({Type.last_getState, Type.setState},
+                             set(db.session.execute(select(Usage.type)).scalars()))
+            self.assertEqual(2, len(list(db.session.execute(select(Usage.id)).scalars())))
+
+            self.app.config['USAGE_RETENTION_HORIZON'] = 0
+            self.app.config['USAGE_ARCHIVE_RETENTION'] = 0
+            with mock_datetime_now(datetime.datetime(2024, 2, 22, 0, 10, tzinfo=datetime.timezone.utc), datetime):
+                result = usage_retention()
+                self.assertEqual((1, 1, 1, True, 0), (result['hours'], result['days'], result['rows'],
+                                                      result['archived'], result['dropped']))
+                self.assertEqual([Type.last_getState], list(db.session.execute(select(Usage.type)).scalars()))
+
+                # whole months are dropped once they ended more than the retention ago
+                self.assertEqual([], drop_usage_archives(datetime.timedelta(days=30)))
+                self.assertEqual(['usage_archive_202401'], drop_usage_archives(datetime.timedelta(days=20)))
+            self.assertEqual(['usage_archive_202402'], [table.name for table in usage_archive_tables(db.engine)])
+            self.assertEqual(5, len(list(export_rows('usage_archive'))))
+
+    def test_export_rows(self):
+        self.set_up_usage()
+        with self.app.app_context():
+            # two rows with the same timestamp are split across pages
+            write_usage_batch([{**usage_row(USER0002_USER_ID, ACTOR0002_USER_ID, Type.setState),
+                                'timestamp': datetime.datetime(2024, 2, 20, 10, 45)}])
+            expected = sorted(db.session.execute(select(Usage.timestamp, Usage.id)).all())
+            rows = list(export_rows('usage', page_size=2))
+            self.assertEqual(expected, [(row[4], row[0]) for row in rows])
+
+            rows = list(export_rows('usage', start=TS_11_00_00, end=datetime.datetime(2024, 2, 21), page_size=1))
+            self.assertEqual([(USER0001_USER_ID, Type.setState)], [(row[1], row[3]) for row in rows])
+
+            lines = ''.join(export('usage', 'csv', start=datetime.datetime(2024, 2, 21))).splitlines()
+            self.assertEqual(2, len(lines))
+            self.assertEqual('id,user_id,actor_id,type,timestamp,created_at,updated_at', lines[0])
+            self.assertEqual([USER0001_USER_ID.hex, ACTOR0002_USER_ID.hex, 'setState', '2024-02-21T00:01:00+00:00'],
+                             lines[1].split(',')[1:5])
+            self.assertRaises(ValueError, export, 'user', 'csv')
+            self.assertRaises(ValueError, export, 'usage', 'xml')
+
+        set_up_state(self.app, TS_12_30_00)
+        with self.app.app_context():
+            # the state without begin comes first, it has no place in a time range
+            rows = [json.loads(line) for line in export('state', 'ndjson', page_size=1)]
+            self.assertEqual([STATE03_ID.hex, STATE02_ID.hex, STATE01_ID.hex, STATE04_ID.hex], [r['id'] for r in rows])
+            self.assertEqual((None, '2024-02-20T12:30:01+00:00'), (rows[0]['begin'], rows[0]['end']))
+            rows = list(export_rows('state', start=TS_12_30_00))
+            self.assertEqual([STATE01_ID, STATE04_ID], [row[0] for row in rows])
+
+    def test_actor_state_store(self):
+        with self.app.app_context():
+            with mock_datetime_now(TS_12_30_01, datetime):
+                set_state(ACTOR0002_USER_ID, USER0002_USER_ID)
+                self.assertTrue(actor_state_store().is_active(ACTOR0002_USER_ID, TS_12_30_01))
+
+                # reads are answered from memory, the State table is only the durable log
+                db.session.query(State).delete()
+                db.session.commit()
+                self.assertTrue(get_state(ACTOR0002_USER_ID, ACTOR0002_USER_ID))
+
+                # a rebuild only knows the State rows
+                rebuild_actor_state_store()
+                self.assertFalse(get_state(ACTOR0002_USER_ID, ACTOR0002_USER_ID))
+
+            with mock_datetime_now(TS_12_30_11, datetime):
+                set_state(ACTOR0002_USER_ID, USER0002_USER_ID)
+            # on startup, only states which have not ended yet are loaded
+            with mock_datetime_now(TS_12_30_12, datetime):
+                store = rebuild_actor_state_store()
+                self.assertEqual(1, len(store))
+            with mock_datetime_now(TS_12_31_00, datetime):
+                store = rebuild_actor_state_store()
+                self.assertEqual(0, len(store))
+
     def test_add_user(self):
         with (self.app.app_context()):
             properties = [User.id, User.api_key, User.name, User.role]
@@ -496,6 +693,41 @@ class TestApiFunctions(TestCase):
             self.assertEqual(1, len(query_result))
             self.assertEqual(simple_hash_str(new_api_key), hashed_api_key)
 
+    def test_principal_cache(self):
+        with (self.app.app_context()):
+            stats_ex_ante = principal_cache().stats()
+            self.assertEqual((ACTOR0001_USER_ID, Role.actor), get_principal_from_api_key(ACTOR0001_KEY))
+            self.assertEqual((ACTOR0001_USER_ID, Role.actor), get_principal_from_api_key(ACTOR0001_KEY))
+            self.assertEqual(ACTOR0001_USER_ID, get_user_id_from_api_key(ACTOR0001_KEY))
+            stats_ex_post = principal_cache().stats()
+            self.assertEqual(1, stats_ex_post['misses'] - stats_ex_ante['misses'])
+            self.assertEqual(2, stats_ex_post['hits'] - stats_ex_ante['hits'])
+
+            # unknown keys are not cached
+            self.assertIsNone(get_user_id_from_api_key(generate_api_key()))
+            self.assertEqual(stats_ex_post['size'], principal_cache().stats()['size'])
+
+    def test_principal_cache_invalidation(self):
+        with (self.app.app_context()):
+            self.assertEqual(USER0001_USER_ID, get_user_id_from_api_key(USER0001_KEY))
+            new_api_key = regenerate_api_key(USER0001_USER_ID)["api_key"]
+            self.assertIsNone(get_user_id_from_api_key(USER0001_KEY))
+            self.assertEqual(USER0001_USER_ID, get_user_id_from_api_key(new_api_key))
+
+            result_json = add_user('new User', Role.user)
+            self.assertEqual(uuid.UUID(result_json['id']), get_user_id_from_api_key(result_json['api_key']))
+
+    def test_principal_cache_invalidation_race(self):
+        def regenerate_then_remember(key_hash, principals, generation):
+            # the lookup has read the old row, the api key is regenerated before it caches the row
+            regenerate_api_key(USER0001_USER_ID)
+            return remember_principal(key_hash, principals, generation)
+
+        with (self.app.app_context()):
+            with mock.patch('app.api.func.remember_principal', regenerate_then_remember):
+                self.assertEqual((USER0001_USER_ID, Role.user), get_principal_from_api_key(USER0001_KEY))
+            self.assertIsNone(get_principal_from_api_key(USER0001_KEY))
+
     def test_set_password(self):
         with (self.app.app_context()):
             new_password = """'.-;#Absdu23923"asLk"""
@@ -517,6 +749,13 @@ class TestApiFunctions(TestCase):
             set_user_password(USER0001_USER_ID, new_password)
             self.assertTrue(check_password(USER0001_USER_ID, new_password))
             self.assertFalse(check_password(USER0001_USER_ID, new_password + 'x'))
+            # cached results do not go through the bcrypt pool
+            with mock.patch.object(bcrypt_pool(), 'run', side_effect=TimeoutError) as run_mock:
+                self.assertTrue(check_password(USER0001_USER_ID, new_password))
+                self.assertFalse(check_password(USER0001_USER_ID, new_password + 'x'))
+                run_mock.assert_not_called()
+                with self.assertRaises(TimeoutError):
+                    check_password(USER0001_USER_ID, new_password + 'y')
 
     def test_health_check_actor(self):
         with (self.app.app_context()):
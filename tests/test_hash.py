@@ -1,9 +1,10 @@
 import random
 import string
-from unittest import TestCase
+from unittest import TestCase, mock
 
 from app.api.func import assert_password_properties
-from app.util.util import hash_salt_pw_str, check_pw_str
+from app.util.util import hash_salt_pw_str, check_pw_str, verification_cache_key, verification_cache, \
+    init_verification_cache
 
 
 class TestApiFunctions(TestCase):
@@ -25,3 +26,25 @@ class TestApiFunctions(TestCase):
             self.assertTrue(check_pw_str(password, hashed_salted_pw), f'mismatch: "{password=}", "{hashed_salted_pw=}"')
             self.assertFalse(check_pw_str(password, hash_salt_pw_str(prior_password)))
             prior_password = password
+
+    def test_verification_cache(self):
+        init_verification_cache(maxsize=1024, ttl=300)
+        password = 'Ab1!verification'
+        hashed_salted_pw = hash_salt_pw_str(password)
+        self.assertTrue(check_pw_str(password, hashed_salted_pw))
+        self.assertFalse(check_pw_str(password + 'x', hashed_salted_pw))
+        self.assertEqual(2, len(verification_cache()))
+        # cached results are keyed by an hmac, the plaintext password is not kept
+        key = verification_cache_key(password, hashed_salted_pw)
+        self.assertTrue(verification_cache().get(key))
+        self.assertNotIn(password, key)
+        # a new hash (e.g. after a password change) is verified again, not answered from the cache
+        self.assertNotEqual(key, verification_cache_key(password, hash_salt_pw_str(password)))
+        with mock.patch('app.util.util.checkpw') as checkpw_mock:
+            self.assertTrue(check_pw_str(password, hashed_salted_pw))
+            checkpw_mock.assert_not_called()
+        # the bound of the cache is configurable
+        init_verification_cache(maxsize=1, ttl=300)
+        check_pw_str(password, hashed_salted_pw)
+        check_pw_str(password + 'x', hashed_salted_pw)
+        self.assertEqual(1, len(verification_cache()))
@@ -0,0 +1,71 @@
+import threading
+from unittest import TestCase
+
+from app.util.metrics import MetricsRegistry
+
+
+class TestMetrics(TestCase):
+
+    def test_counter_threads(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('test_total', 'test counter', ['result'])
+
+        def work():
+            for _ in range(1000):
+                counter.inc(result='ok')
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc(2, result='failed')
+        self.assertEqual(4000, counter.value(result='ok'))
+        self.assertIn('test_total{result="ok"} 4000', registry.expose())
+        self.assertIn('test_total{result="failed"} 2', registry.expose())
+
+        with self.assertRaises(ValueError):
+            counter.inc(status='ok')
+
+    def test_gauge(self):
+        registry = MetricsRegistry()
+        gauge = registry.gauge('in_flight', 'test gauge')
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(1, gauge.value())
+        self.assertIn('# TYPE in_flight gauge\nin_flight 1', registry.expose())
+
+    def test_histogram(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram('latency_seconds', 'test histogram', ['endpoint'], buckets=[0.1, 1])
+        for value in [0.05, 0.5, 0.5, 5]:
+            histogram.observe(value, endpoint='a"b')
+        exposition = registry.expose()
+        self.assertIn('latency_seconds_bucket{endpoint="a\\"b",le="0.1"} 1', exposition)
+        self.assertIn('latency_seconds_bucket{endpoint="a\\"b",le="1"} 3', exposition)
+        self.assertIn('latency_seconds_bucket{endpoint="a\\"b",le="+Inf"} 4', exposition)
+        self.assertIn('latency_seconds_sum{endpoint="a\\"b"} 6.05', exposition)
+        self.assertIn('latency_seconds_count{endpoint="a\\"b"} 4', exposition)
+
+    def test_duplicate_name(self):
+        registry = MetricsRegistry()
+        registry.counter('test_total', 'test counter')
+        with self.assertRaises(ValueError):
+            registry.gauge('test_total', 'test gauge')
+
+    def test_merge_snapshots(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('test_total', 'test counter', ['result'])
+        histogram = registry.histogram('test_seconds', 'test histogram', buckets=(0.1, 1.0))
+        counter.inc(result='ok')
+        histogram.observe(0.05)
+        # snapshot of another worker process, as published through the database
+        other = {'test_total': [[['ok'], 2.0], [['failed'], 1.0]], 'test_seconds': [[[], [[0, 1, 0], 0.5, 1]]]}
+        exposition = registry.expose([other])
+        self.assertIn('test_total{result="ok"} 3', exposition)
+        self.assertIn('test_total{result="failed"} 1', exposition)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', exposition)
+        self.assertIn('test_seconds_bucket{le="1"} 2', exposition)
+        self.assertIn('test_seconds_count 2', exposition)
+        self.assertEqual([[['ok'], 1.0]], registry.snapshot()['test_total'])
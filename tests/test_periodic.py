@@ -0,0 +1,33 @@
+import time
+from unittest import TestCase
+
+from flask import Flask, current_app
+
+from app.util.periodic import PeriodicJob
+
+
+class TestPeriodicJob(TestCase):
+    def test_periodic_job(self):
+        app = Flask(__name__)
+        results = []
+
+        def job():
+            results.append(current_app.name)
+            return len(results)
+
+        periodic_job = PeriodicJob(app, job, interval=0.05)
+        periodic_job.start()
+        time.sleep(0.3)
+        periodic_job.stop()
+        runs = periodic_job.runs
+        self.assertGreaterEqual(runs, 2)
+        self.assertEqual(runs, periodic_job.last_result)
+        self.assertEqual(app.name, results[0])
+
+        # no more runs after stop
+        time.sleep(0.1)
+        self.assertEqual(runs, periodic_job.runs)
+
+    def test_bad_interval(self):
+        with self.assertRaises(ValueError):
+            PeriodicJob(Flask(__name__), lambda: None, interval=0)
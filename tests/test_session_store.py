@@ -0,0 +1,85 @@
+import threading
+from unittest import TestCase
+
+from app.util.session_store import SessionStore
+
+
+class FakeClock:
+    def __init__(self):
+        self.ts = 1000.0
+
+    def __call__(self) -> float:
+        return self.ts
+
+
+class TestSessionStore(TestCase):
+
+    def test_expiry(self):
+        clock = FakeClock()
+        store = SessionStore(ttl=10, maxsize=10, clock=clock)
+        store.add('a')
+        clock.ts += 5
+        store.add('b')
+        self.assertIn('a', store)
+        clock.ts += 5
+        self.assertNotIn('a', store)
+        self.assertIn('b', store)
+        self.assertEqual(1, len(store))
+        self.assertEqual(1, store.stats()['expired'])
+
+    def test_sliding_renewal(self):
+        clock = FakeClock()
+        store = SessionStore(ttl=10, maxsize=10, clock=clock)
+        store.add('a')
+        for _ in range(5):
+            clock.ts += 8
+            self.assertTrue(store.touch('a'))
+        clock.ts += 10
+        self.assertFalse(store.touch('a'))
+        self.assertFalse(store.touch('unknown'))
+        self.assertEqual(0, len(store))
+
+    def test_stale_heap_entries_are_compacted(self):
+        store = SessionStore(ttl=10, maxsize=10, clock=FakeClock())
+        store.add('a')
+        for _ in range(1000):
+            store.touch('a')
+        self.assertLessEqual(store.stats()['heap'], 2 + 64)
+
+    def test_max_size_eviction(self):
+        clock = FakeClock()
+        store = SessionStore(ttl=10, maxsize=2, clock=clock)
+        store.add('a')
+        clock.ts += 1
+        store.add('b')
+        clock.ts += 1
+        # renewing 'a' makes 'b' the session closest to expiry
+        store.touch('a')
+        store.add('c')
+        self.assertIn('a', store)
+        self.assertNotIn('b', store)
+        self.assertIn('c', store)
+        self.assertEqual(1, store.stats()['evictions'])
+
+    def test_discard(self):
+        store = SessionStore(ttl=10, maxsize=2, clock=FakeClock())
+        store.add('a')
+        store.discard('a')
+        self.assertNotIn('a', store)
+        self.assertFalse(store.touch('a'))
+
+    def test_threads(self):
+        store = SessionStore(ttl=60, maxsize=1000)
+
+        def worker(offset: int):
+            for i in range(500):
+                store.add(offset + i)
+                store.touch(offset + i // 2)
+
+        threads = [threading.Thread(target=worker, args=(n * 500,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1000, len(store))
+        self.assertEqual(1000, store.stats()['evictions'])
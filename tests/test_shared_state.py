@@ -0,0 +1,151 @@
+import datetime
+import secrets
+import time
+import uuid
+from unittest import TestCase
+
+from sqlalchemy import select
+
+from app.app import create_app, shutdown_app, db
+from app.api.func import regenerate_api_key, principal_cache, sync_shared_state, publish_worker_metrics, \
+    other_worker_metrics, shared_state_housekeeping
+from app.models.change_event import ChangeEvent
+from app.models.user import Role
+from app.util.session_store import DbSessionStore
+from app.util.util import simple_hash_str
+from tests.context.testfixture_config import Config
+from tests.test_fns import (set_up_users, set_up_valid, set_up_scope, TS_11_00_00, TS_12_30_00, TS_12_30_01,
+                            TS_12_30_05, USER0002_KEY, USER0002_USER_ID, ACTOR0002_KEY, ACTOR0002_USER_ID)
+from tests.util.mock_datetime import mock_datetime_now
+
+
+class TestSharedState(TestCase):
+    """ two apps on one database stand in for two worker processes """
+
+    def setUp(self):
+        config = Config.get_cls()
+        config.SECRET_KEY = secrets.token_hex()
+        # the background sync is disabled, the tests sync explicitly
+        self.shared_config = type('SharedConfig', (config,), {'SHARED_STATE': True,
+                                                              'SHARED_STATE_POLL_INTERVAL': 3600})
+        self.app_a = create_app(config_class=self.shared_config)
+        set_up_users(self.app_a, TS_11_00_00)
+        set_up_valid(self.app_a, TS_11_00_00)
+        set_up_scope(self.app_a, TS_11_00_00)
+        self.app_b = create_app(config_class=self.shared_config)
+
+    def tearDown(self):
+        for app in (self.app_a, self.app_b):
+            shutdown_app(app)
+            with app.app_context():
+                db.session.close()
+                db.engine.dispose()
+        Config.TEMP_DIR.cleanup()
+
+    def get_state_b(self) -> dict:
+        query_string = {'api-key': ACTOR0002_KEY, 'actor-id': ACTOR0002_USER_ID}
+        return self.app_b.test_client().get('/api/getState', query_string=query_string).json
+
+    def test_state_change_is_seen_by_other_worker(self):
+        with mock_datetime_now(TS_12_30_00, datetime):
+            self.assertEqual({'state': False}, self.get_state_b())
+        with mock_datetime_now(TS_12_30_01, datetime):
+            data = {'api-key': USER0002_KEY, 'actor-id': ACTOR0002_USER_ID}
+            response = self.app_a.test_client().post('/api/setState', data=data)
+            self.assertEqual(200, response.status_code)
+        with mock_datetime_now(TS_12_30_05, datetime):
+            # not before the next sync
+            self.assertEqual({'state': False}, self.get_state_b())
+            with self.app_b.app_context():
+                self.assertEqual(1, sync_shared_state())
+            self.assertEqual({'state': True}, self.get_state_b())
+        # events are applied once
+        with self.app_b.app_context():
+            self.assertEqual(0, sync_shared_state())
+
+    def test_api_key_invalidation(self):
+        with self.app_a.app_context():
+            regenerate_api_key(USER0002_USER_ID)
+        # entry cached by worker b before the change event arrives
+        principal_cache().set(simple_hash_str(USER0002_KEY), (USER0002_USER_ID, Role.user))
+        with self.app_b.app_context():
+            self.assertEqual(1, sync_shared_state())
+        self.assertIsNone(principal_cache().get(simple_hash_str(USER0002_KEY)))
+
+    def test_own_events_are_skipped(self):
+        with self.app_a.app_context():
+            regenerate_api_key(USER0002_USER_ID)
+            self.assertEqual(0, sync_shared_state())
+
+    def test_worker_metrics(self):
+        with self.app_a.app_context():
+            publish_worker_metrics()
+        with self.app_b.app_context():
+            snapshots = other_worker_metrics()
+            self.assertEqual(1, len(snapshots))
+            self.assertIn('http_requests_total', snapshots[0])
+            # b does not see its own snapshot
+            publish_worker_metrics()
+            self.assertEqual(1, len(other_worker_metrics()))
+
+    def test_housekeeping(self):
+        with self.app_a.app_context():
+            regenerate_api_key(USER0002_USER_ID)
+            regenerate_api_key(USER0002_USER_ID)
+            db.session.query(ChangeEvent).update({'created_at': time.time() - 7200})
+            db.session.commit()
+            shared_state_housekeeping()
+            # the newest event is kept
+            self.assertEqual([2], db.session.execute(select(ChangeEvent.seq)).scalars().all())
+
+    def test_seq_is_not_reused(self):
+        with self.app_a.app_context():
+            regenerate_api_key(USER0002_USER_ID)
+        with self.app_b.app_context():
+            self.assertEqual(1, sync_shared_state())
+            db.session.query(ChangeEvent).delete()
+            db.session.commit()
+        with self.app_a.app_context():
+            regenerate_api_key(USER0002_USER_ID)
+        principal_cache().set(simple_hash_str(USER0002_KEY), (USER0002_USER_ID, Role.user))
+        with self.app_b.app_context():
+            self.assertEqual(1, sync_shared_state())
+        self.assertIsNone(principal_cache().get(simple_hash_str(USER0002_KEY)))
+
+    def test_db_session_store(self):
+        store_a = DbSessionStore(self.app_a, ttl=60, maxsize=2)
+        store_b = DbSessionStore(self.app_b, ttl=60, maxsize=2)
+        session_ids = [uuid.uuid4() for _ in range(3)]
+        store_a.add(session_ids[0])
+        self.assertIn(session_ids[0], store_b)
+        self.assertTrue(store_b.touch(session_ids[0]))
+        self.assertFalse(store_b.touch(session_ids[1]))
+        store_a.add(session_ids[1])
+        store_a.add(session_ids[2])
+        self.assertEqual(3, len(store_b))
+        # maxsize is enforced by trim, the session closest to expiry goes first
+        self.assertEqual(1, store_b.trim())
+        self.assertNotIn(session_ids[0], store_a)
+        self.assertEqual(2, len(store_a))
+        store_b.discard(session_ids[1])
+        self.assertNotIn(session_ids[1], store_a)
+        expired_store = DbSessionStore(self.app_a, ttl=0.01, maxsize=2)
+        expired_store.add(session_ids[0])
+        time.sleep(0.02)
+        self.assertNotIn(session_ids[0], store_b)
+
+    def test_maintenance_jobs(self):
+        self.assertIn('state_retention', self.app_a.extensions)
+        self.assertIn('usage_retention', self.app_a.extensions)
+        # the other workers leave the retention jobs to the first one
+        worker_config = type('WorkerConfig', (self.shared_config,), {'MAINTENANCE_JOBS': False})
+        app_c = create_app(config_class=worker_config)
+        try:
+            self.assertNotIn('state_retention', app_c.extensions)
+            self.assertNotIn('usage_retention', app_c.extensions)
+            self.assertEqual(len(self.app_a.extensions['background_jobs']) - 3,
+                             len(app_c.extensions['background_jobs']))
+        finally:
+            shutdown_app(app_c)
+            with app_c.app_context():
+                db.engine.dispose()
@@ -0,0 +1,53 @@
+import secrets
+from unittest import TestCase
+
+from sqlalchemy import create_engine, text
+
+from app.app import create_app, shutdown_app, db
+from app.util.sqlite_profile import pragma_statements
+from config import engine_options
+from tests.context.testfixture_config import Config
+
+
+class TestSqliteProfile(TestCase):
+
+    def test_pragma_statements(self):
+        self.assertEqual(['PRAGMA journal_mode=WAL', 'PRAGMA cache_size=-2000'],
+                         pragma_statements({'journal_mode': 'WAL', 'cache_size': -2000}))
+        with self.assertRaises(ValueError):
+            pragma_statements({'writable_schema': 1})
+        with self.assertRaises(ValueError):
+            pragma_statements({'journal_mode': 'WAL; DROP TABLE user'})
+
+    def test_engine_options(self):
+        self.assertEqual({'pool_size', 'max_overflow', 'pool_timeout'}, set(engine_options('sqlite:////tmp/a.sqlite')))
+        for uri in ['sqlite://', 'sqlite:///:memory:', 'sqlite:///file:door?mode=memory&cache=shared&uri=true']:
+            self.assertEqual({}, engine_options(uri), uri)
+            # the options are accepted by the in-memory pools
+            create_engine(uri, **engine_options(uri)).dispose()
+
+    def test_profile_applied_on_connect(self):
+        config = Config.get_cls()
+        config.SECRET_KEY = secrets.token_hex()
+        profile_config = type('ProfileConfig', (config,), {'SQLITE_PRAGMAS': {
+            'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': 1234, 'cache_size': -4000,
+            'temp_store': 'MEMORY'}})
+        app = create_app(config_class=profile_config)
+        try:
+            with app.app_context():
+                # every pooled connection gets the profile, not only the first one
+                connections = [db.engine.connect() for _ in range(3)]
+                for connection in connections:
+                    self.assertEqual('wal', connection.execute(text('PRAGMA journal_mode')).scalar())
+                    self.assertEqual(1, connection.execute(text('PRAGMA synchronous')).scalar())
+                    self.assertEqual(1234, connection.execute(text('PRAGMA busy_timeout')).scalar())
+                    self.assertEqual(-4000, connection.execute(text('PRAGMA cache_size')).scalar())
+                    self.assertEqual(2, connection.execute(text('PRAGMA temp_store')).scalar())
+                for connection in connections:
+                    connection.close()
+        finally:
+            shutdown_app(app)
+            with app.app_context():
+                db.session.close()
+                db.engine.dispose()
+            Config.TEMP_DIR.cleanup()
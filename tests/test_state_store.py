@@ -0,0 +1,58 @@
+import datetime
+import uuid
+from unittest import TestCase
+
+from app.util.state_store import ActorStateStore
+
+TS_12_00_00 = datetime.datetime(2024, 2, 20, 12, 0, 0, tzinfo=datetime.timezone.utc)
+ACTOR_ID = uuid.UUID('1dad0dc3-f862-4b41-9608-2ee1fa3050c2')
+
+
+def ts(seconds: int) -> datetime.datetime:
+    return TS_12_00_00 + datetime.timedelta(seconds=seconds)
+
+
+class TestActorStateStore(TestCase):
+
+    def test_is_active(self):
+        store = ActorStateStore()
+        self.assertFalse(store.is_active(ACTOR_ID, ts(0)))
+        store.add(ACTOR_ID, ts(0), ts(10))
+        self.assertFalse(store.is_active(ACTOR_ID, ts(-1)))
+        self.assertTrue(store.is_active(ACTOR_ID, ts(0)))
+        self.assertTrue(store.is_active(ACTOR_ID, ts(10)))
+        self.assertFalse(store.is_active(ACTOR_ID, ts(11)))
+        self.assertFalse(store.is_active(uuid.uuid4(), ts(5)))
+
+    def test_active_map(self):
+        store = ActorStateStore()
+        other_id = uuid.uuid4()
+        store.add(ACTOR_ID, ts(0), ts(10))
+        store.add(other_id, ts(20), ts(30))
+        self.assertEqual({ACTOR_ID: True, other_id: False}, store.active_map([ACTOR_ID, other_id], ts(5)))
+        self.assertEqual({}, store.active_map([], ts(5)))
+
+    def test_open_ended_and_naive(self):
+        store = ActorStateStore()
+        store.add(ACTOR_ID, None, ts(10).replace(tzinfo=None))
+        self.assertTrue(store.is_active(ACTOR_ID, ts(-3600)))
+        self.assertFalse(store.is_active(ACTOR_ID, ts(11)))
+        store.add(ACTOR_ID, ts(20), None)
+        self.assertTrue(store.is_active(ACTOR_ID, ts(3600)))
+
+    def test_end_before_begin_never_matches(self):
+        store = ActorStateStore()
+        store.add(ACTOR_ID, ts(10), ts(0))
+        store.add(ACTOR_ID, ts(10), ts(10))
+        self.assertFalse(store.is_active(ACTOR_ID, ts(5)))
+        self.assertFalse(store.is_active(ACTOR_ID, ts(10)))
+        self.assertEqual(0, len(store))
+
+    def test_prune(self):
+        store = ActorStateStore()
+        store.add(ACTOR_ID, ts(0), ts(10))
+        store.add(ACTOR_ID, ts(100), ts(110), prune_before=ts(40))
+        self.assertEqual(1, len(store))
+        store.add(ACTOR_ID, ts(200), None)
+        self.assertEqual(1, store.prune(ts(1000)))
+        self.assertTrue(store.is_active(ACTOR_ID, ts(1000)))
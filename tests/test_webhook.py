@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+from unittest import TestCase, mock
+
+from flask import Flask, current_app
+
+from app.util.webhook import WebhookDispatcher, sign, target_error, SIGNATURE_HEADER
+
+from tests.util.http_receiver import HttpReceiver
+
+
+class TestWebhookDispatcher(TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.receiver = HttpReceiver()
+        self.dead_letters = []
+        self.resolved = []
+
+    def tearDown(self):
+        self.receiver.close()
+
+    def resolve(self, key):
+        self.resolved.append(current_app.name)
+        return (f'{self.receiver.url}/push/{key}', f'secret-{key}') if key != 'unknown' else None
+
+    def dispatcher(self, **kwargs) -> WebhookDispatcher:
+        kwargs.setdefault('allowed_hosts', {'127.0.0.1'})
+        dispatcher = WebhookDispatcher(self.app, self.resolve, self.dead_letters.extend, **kwargs)
+        dispatcher.start()
+        self.addCleanup(dispatcher.stop)
+        return dispatcher
+
+    def wait_until(self, condition, timeout: float = 10) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_push(self):
+        dispatcher = self.dispatcher(workers=1)
+        for i in range(3):
+            self.assertTrue(dispatcher.push('door', {'state': True, 'i': i}))
+            self.assertTrue(self.receiver.wait_for_requests(i + 1))
+        self.assertTrue(dispatcher.push('unknown', {'state': True}))
+        self.assertTrue(self.wait_until(lambda: dispatcher.pending() == 0 and len(self.resolved) == 4))
+
+        self.assertEqual(3, dispatcher.delivered)
+        self.assertEqual([self.app.name] * 4, self.resolved)
+        request = self.receiver.requests[0]
+        self.assertEqual(('/push/door', {'state': True, 'i': 0}), (request.path, json.loads(request.body)))
+        self.assertEqual(sign('secret-door', request.body), request.headers[SIGNATURE_HEADER])
+        # one keep-alive connection
+        self.assertEqual(1, len({request.client_port for request in self.receiver.requests}))
+
+    def test_retry_and_dead_letter(self):
+        dispatcher = self.dispatcher(workers=2, max_attempts=3, retry_base=0.01)
+        self.receiver.statuses = [500, 429, 200]
+        dispatcher.push('door', {'state': True})
+        self.assertTrue(self.receiver.wait_for_requests(3))
+        self.assertTrue(self.wait_until(lambda: dispatcher.delivered == 1))
+        self.assertEqual(2, dispatcher.retried)
+
+        # server errors until the attempts are used up, client errors are not retried
+        self.receiver.statuses = [500, 500, 503, 404]
+        dispatcher.push('door', {'state': True})
+        self.assertTrue(self.wait_until(lambda: len(self.dead_letters) == 1))
+        dispatcher.push('door', {'state': True})
+        self.assertTrue(self.wait_until(lambda: len(self.dead_letters) == 2))
+        self.assertEqual([(3, 'http status 503'), (1, 'http status 404')],
+                         [(job.attempts, job.error) for job in self.dead_letters])
+        self.assertEqual(f'{self.receiver.url}/push/door', self.dead_letters[0].url)
+        self.assertEqual(2, dispatcher.dead_lettered)
+
+        # redirects are not followed
+        self.receiver.statuses = [307]
+        dispatcher.push('door', {'state': True})
+        self.assertTrue(self.wait_until(lambda: len(self.dead_letters) == 3))
+        self.assertEqual('http status 307', self.dead_letters[2].error)
+        self.assertEqual(['/push/door'], [request.path for request in self.receiver.requests[-1:]])
+
+        # a push is not retried past its expiry
+        self.receiver.statuses = [500]
+        dispatcher.push('door', {'state': True}, expires=time.time())
+        self.assertTrue(self.wait_until(lambda: len(self.dead_letters) == 4))
+        self.assertEqual((1, 'expired, http status 500'), (self.dead_letters[3].attempts, self.dead_letters[3].error))
+
+    def test_unreachable_target(self):
+        receiver_url = self.receiver.url
+        self.receiver.close()
+        self.resolve = lambda key: (receiver_url, 'secret')
+        dispatcher = self.dispatcher(workers=1, max_attempts=2, retry_base=0.01, timeout=1)
+        dispatcher.push('door', {'state': True})
+        self.assertTrue(self.wait_until(lambda: len(self.dead_letters) == 1))
+        self.assertEqual(2, self.dead_letters[0].attempts)
+        self.assertTrue(self.dead_letters[0].error.startswith('ConnectionError'))
+
+    def test_forbidden_target(self):
+        for url in ['http://localhost/', 'http://127.0.0.1:8080/', 'http://10.1.2.3/', 'https://192.168.0.1/',
+                    'http://169.254.169.254/latest/meta-data', 'http://[::1]/', 'http://[::ffff:127.0.0.1]/',
+                    'http://100.64.0.1/', 'ftp://example.com/', 'http://:80/', 'http://127.0.0.1:99999/']:
+            self.assertIsNotNone(target_error(url), url)
+        self.assertIsNone(target_error('http://93.184.216.34/door'))
+        self.assertIsNone(target_error('http://127.0.0.1:8080/', {'127.0.0.1'}))
+
+        # checked again on every push
+        dispatcher = self.dispatcher(workers=1, allowed_hosts=())
+        dispatcher.push('door', {'state': True})
+        self.assertTrue(self.wait_until(lambda: len(self.dead_letters) == 1))
+        self.assertEqual('forbidden target, non-public address: 127.0.0.1', self.dead_letters[0].error)
+        self.assertEqual([], self.receiver.requests)
+
+        # the dns answer changes after the check (dns rebinding): the connection is refused by its peer address
+        with mock.patch('app.util.webhook.target_error', return_value=None):
+            dispatcher.push('door', {'state': True})
+            self.assertTrue(self.wait_until(lambda: len(self.dead_letters) == 2))
+        self.assertEqual('forbidden target, non-public address: 127.0.0.1', self.dead_letters[1].error)
+        self.assertEqual(1, self.dead_letters[1].attempts)
+        self.assertEqual([], self.receiver.requests)
+
+    def test_per_target_limit(self):
+        self.receiver.delay = 0.1
+        dispatcher = self.dispatcher(workers=4, max_per_target=2)
+        for i in range(6):
+            dispatcher.push(f'door{i}', {'state': True})
+        self.assertTrue(self.receiver.wait_for_requests(6))
+        self.assertEqual(2, self.receiver.max_concurrent)
+
+    def test_queue_limit_and_stop(self):
+        release = threading.Event()
+        self.resolve = lambda key: release.wait(5) and None
+        dispatcher = self.dispatcher(workers=1, max_pending=2)
+        results = [dispatcher.push('door', {'state': True}) for _ in range(4)]
+        # the first one may already be taken by the worker
+        self.assertEqual([True, True], results[:2])
+        self.assertFalse(results[-1])
+        release.set()
+        dispatcher.stop()
+        self.assertFalse(dispatcher.push('door', {'state': True}))
+        self.assertGreaterEqual(dispatcher.dropped, 2)
+
+        with self.assertRaises(ValueError):
+            WebhookDispatcher(self.app, self.resolve, self.dead_letters.extend, max_per_target=0)
@@ -0,0 +1,47 @@
+import asyncio
+import json
+from typing import Optional, Tuple
+from urllib.parse import urlencode
+
+
+async def asgi_request(app, method: str, path: str, query: Optional[dict] = None, data: Optional[dict] = None,
+                       json_body: Optional[dict] = None) -> Tuple[int, bytes]:
+    """Sends one http request to an ASGI app without a server.
+
+    Returns:
+        The status code and the body of the response.
+    """
+    headers = []
+    body = b''
+    if json_body is not None:
+        body = json.dumps(json_body).encode('utf-8')
+        headers.append((b'content-type', b'application/json'))
+    elif data is not None:
+        body = urlencode(data).encode('utf-8')
+        headers.append((b'content-type', b'application/x-www-form-urlencoded'))
+    headers.append((b'content-length', str(len(body)).encode('latin-1')))
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method, 'scheme': 'http',
+             'path': path, 'raw_path': path.encode('latin-1'), 'root_path': '',
+             'query_string': urlencode(query or {}).encode('latin-1'), 'headers': headers,
+             'client': ('127.0.0.1', 50000), 'server': ('127.0.0.1', 80)}
+    request_sent = False
+    disconnected = asyncio.Event()
+    response = {'status': None, 'body': b''}
+
+    async def receive() -> dict:
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message: dict) -> None:
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            response['body'] += message.get('body', b'')
+
+    await app(scope, receive, send)
+    disconnected.set()
+    return response['status'], response['body']
@@ -0,0 +1,70 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, NamedTuple
+
+
+class ReceivedRequest(NamedTuple):
+    path: str
+    headers: dict
+    body: bytes
+    client_port: int
+
+
+class HttpReceiver:
+    """ local stand-in for a callback receiver: records every POST and answers with the queued statuses (200 once
+    the queue is empty) after delay seconds, redirects point to /redirected; keeps connections alive """
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.statuses: List[int] = []
+        self.requests: List[ReceivedRequest] = []
+        self.concurrent = 0
+        self.max_concurrent = 0
+        self._lock = threading.Lock()
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with receiver._lock:
+                    receiver.concurrent += 1
+                    receiver.max_concurrent = max(receiver.max_concurrent, receiver.concurrent)
+                    status = receiver.statuses.pop(0) if receiver.statuses else 200
+                time.sleep(receiver.delay)
+                with receiver._lock:
+                    receiver.concurrent -= 1
+                    receiver.requests.append(ReceivedRequest(self.path, dict(self.headers), body,
+                                                             self.client_address[1]))
+                self.send_response(status)
+                if 300 <= status < 400:
+                    self.send_header('Location', '/redirected')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def wait_for_requests(self, count: int, timeout: float = 10) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if len(self.requests) >= count:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def close(self) -> None:
+        if not self._thread.is_alive():
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join(timeout=5)
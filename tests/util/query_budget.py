@@ -0,0 +1,26 @@
+from unittest import TestCase
+
+import flask
+from flask.testing import FlaskClient
+
+from app.util.sql_stats import SQL_STATS_HEADER
+
+
+def request_within_budget(test_case: TestCase, app: flask.app.Flask, client: FlaskClient, method: str, path: str,
+                          **kwargs):
+    """Sends a request and fails ``test_case`` if the view executes more SQL statements than its declared
+    ``query_budget`` (or declares none).
+
+    Returns:
+        The response of the request.
+    """
+    app.config['SQL_DEBUG_HEADER'] = True
+    response = client.open(path, method=method, **kwargs)
+    endpoint, _ = app.url_map.bind('localhost').match(path, method=method)
+    budget = getattr(app.view_functions[endpoint], 'query_budget', None)
+    test_case.assertIsNotNone(budget, f'no query budget declared for {endpoint}')
+    stats = dict(part.strip().split('=') for part in response.headers[SQL_STATS_HEADER].split(';'))
+    statements = int(stats['statements'])
+    test_case.assertLessEqual(statements, budget,
+                              f'{method} {path} ({endpoint}) executed {statements} statements, budget is {budget}')
+    return response
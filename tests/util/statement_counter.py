@@ -0,0 +1,27 @@
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+@contextmanager
+def count_statements(engine: Engine) -> Iterator[List[str]]:
+    """Collects every SQL statement executed on ``engine`` by the current thread within the context.
+
+    Returns:
+        A list that is filled with the statements while the context is active.
+    """
+    statements = []
+    thread_id = threading.get_ident()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == thread_id:
+            statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)